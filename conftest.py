@@ -0,0 +1,2 @@
+# Makes pytest put the repository root on sys.path, so the tests import raidcore
+# from the source tree also when run as plain "pytest"
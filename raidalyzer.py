@@ -1,17 +1,116 @@
 import os
 import sys
-import json
-import math
 import time
+import multiprocessing
 
+import numpy as np
 import tkinter as tk
 import matplotlib.pyplot as plt
 
-from datetime import datetime
 from tkinter import ttk, filedialog, font, messagebox
 
+from raidcore import VERSION, AnalysisWorker, IndexWorker, IndexedAnalysisEngine, RaidAnalysisEngine, SamplingAnalysisEngine, check_checkpoint, detect_layout, detect_offsets, find_data_sector, format_checkpoint, format_layouts, format_offsets, indexes_available, layout_signals, load_checkpoint
+from raidcore.pyramid import RAW_VIEW_SECTORS, raw_view
+
+class EntropyMapView:
+    # Zoomable, pannable entropy map of the whole analyzed range from the entropy
+    # pyramid of a full analysis: per image the mean entropy with its min-max band
+    # and the zero fraction. Zoom with the mouse wheel or the toolbar, every change
+    # of the visible range is drawn from the pyramid level that fits the width, only
+    # a range of up to RAW_VIEW_SECTORS sectors is read from the images.
+    def __init__(self, engine):
+        self.engine = engine
+        self.pyramid = engine.pyramid
+        self.offsets = engine.disk_offsets or [0 for x in engine.files]
+        self.start = engine.analysis_start_sector
+        self.end = self.start + min(engine.offset, self.pyramid.end_sector())
+        files = len(engine.files)
+
+        self.fig, axes = plt.subplots(nrows=files, ncols=1, figsize=(12, 2 * files), sharex=True, squeeze=False)
+        self.fig.canvas.manager.set_window_title("Entropy map")
+        self.axes = axes[:, 0]
+        self.lines, self.zero_lines, self.bands = [], [], []
+        self.rendering = False
+        for i, (ax, filename) in enumerate(zip(self.axes, engine.filenames)):
+            zero_ax = ax.twinx()
+            zero_ax.set_ylim(0, 1.05)
+            zero_ax.set_ylabel('Zero', fontsize=9)
+            self.zero_lines.append(zero_ax.plot([], [], color='gray', linewidth=1, drawstyle='steps-post')[0])
+            self.lines.append(ax.plot([], [], color=f'C{i}', linewidth=1.5, drawstyle='steps-post')[0])
+            self.bands.append(None)
+
+            ax.set_title(f"FILE: {filename}", fontsize=10, loc='left', fontweight='bold')
+            ax.set_ylabel('Entropy', fontsize=9)
+            ax.set_ylim(0, 8.4)
+            ax.set_autoscalex_on(False)
+            zero_ax.set_autoscalex_on(False)
+            ax.grid(True, which='both', linestyle='--', alpha=0.5)
+
+        self.axes[-1].set_xlabel('Sector', fontsize=10)
+        self.fig.tight_layout()
+        self.axes[0].callbacks.connect('xlim_changed', self.render)
+        self.fig.canvas.mpl_connect('scroll_event', self.zoom)
+
+
+    def is_open(self):
+        return plt.fignum_exists(self.fig.number)
+
+
+    def show_range(self, first, last):
+        # Sectors first to last, clipped to the analyzed range
+        first, last = max(first, self.start), min(last, self.end)
+        self.axes[0].set_xlim(first, max(last, first + 1))
+        self.fig.canvas.draw_idle()
+
+
+    def zoom(self, event):
+        # Wheel up zooms in around the mouse position, down zooms out
+        if event.xdata is None:
+            return
+        first, last = self.axes[0].get_xlim()
+        factor = 0.5 if event.button == 'up' else 2.0
+        self.show_range(event.xdata - (event.xdata - first) * factor, event.xdata + (last - event.xdata) * factor)
+
+
+    def render(self, ax=None):
+        # Adding the band changes the limits of the twin axes again
+        if self.rendering:
+            return
+        self.rendering = True
+        try:
+            self.draw_range()
+        finally:
+            self.rendering = False
+
+
+    def draw_range(self):
+        first, last = self.axes[0].get_xlim()
+        first, last = max(int(first) - self.start, 0), max(int(last) + 1 - self.start, 0)
+        width = max(int(self.axes[0].bbox.width), 1)
+
+        for i, ax in enumerate(self.axes):
+            if last - first <= RAW_VIEW_SECTORS:
+                try:
+                    edges, low, mean, high, zero = raw_view(self.engine.files[i], self.start + self.offsets[i], first, last, self.engine.bs)
+                except OSError:
+                    edges, low, mean, high, zero = self.pyramid.view(i, first, last, width)
+            else:
+                edges, low, mean, high, zero = self.pyramid.view(i, first, last, width)
+
+            # Steps from every bin start, the last value again at the end of the last bin
+            x = np.minimum(edges + self.start, self.end) if len(mean) else edges[:0]
+            low, mean, high, zero = (np.append(values, values[-1:]) for values in (low, mean, high, zero))
+            self.lines[i].set_data(x, mean)
+            self.zero_lines[i].set_data(x, zero)
+            if self.bands[i] is not None:
+                self.bands[i].remove()
+            self.bands[i] = ax.fill_between(x, low, high, step='post', color=f'C{i}', alpha=0.25, linewidth=0)
+        self.fig.canvas.draw_idle()
+
+
 class RaidAlyzerApp(tk.Tk):
-    VERSION = "3.0.8"
+    VERSION = VERSION
+    CHECKPOINT_FILE = "raidalyzer.ckpt"
 
     def __init__(self):
         super().__init__()
@@ -33,29 +132,30 @@ class RaidAlyzerApp(tk.Tk):
         self.bs = 512                     # Check sector by sector 
         self.analysis_block_size = 10000  # Analze a 10.000 blocks before updating output
         self.analysis_start_sector = 0    # Start offset in sectors
+        self.analysis_processes = os.cpu_count() or 1  # Worker processes for a full analysis
+        self.ui_refresh_ms = 250          # Poll the analysis worker 4 times a second
+        self.show_timers = tk.BooleanVar(value=False)  # Show the stage timers panel
+        self.profile_run = tk.BooleanVar(value=False)  # Run the analysis under cProfile
 
         # Shared runtime status data
         self.files = []
         self.filenames = []
-        self.stats = []
-        self.mirrors = []
-        self.parity = []
-
-        self.handles = []
-        self.max_sectors = 0
-        self.start_time = 0
-        self.first_analysis_block = False
-        self.analysis_block_entropy = {}
-        self.run_only_one_block = False
+        self.disk_offsets = None          # Extra start offset in sectors of each image, see detect_offsets()
 
-        self.offset = 0
-
-        self.last_parity_check_pattern = ""
-        self.parity_check_log = None
+        # Headless analysis engine of the running (or last) analysis and its worker thread
+        self.engine = None
+        self.worker = None
         self.analysis_running = False
+        self.last_snapshot = None
+        self.poll_job = None
+
+        # Background builder of the sector indexes (see raidcore/index.py)
+        self.index_worker = None
+        self.index_job = None
 
-        self.first_potential_bootsector_found_on = ""
-        self.first_potential_efi_part_found_on = ""
+        # Last full analysis of the opened images with its entropy pyramid, and the open map
+        self.map_engine = None
+        self.entropy_map = None
 
         # Main frame
         main_frame = ttk.Frame(self)
@@ -78,6 +178,12 @@ class RaidAlyzerApp(tk.Tk):
         self.stop_btn = ttk.Button(btn_frame, text="Stop analysis", command=self.stop_analysis, state=tk.DISABLED)
         self.stop_btn.pack(side=tk.LEFT, padx=5)
 
+        self.sample_btn = ttk.Button(btn_frame, text="Quick sample", command=self.start_sampling, state=tk.DISABLED)
+        self.sample_btn.pack(side=tk.LEFT, padx=5)
+
+        self.index_btn = ttk.Button(btn_frame, text="Build index", command=self.build_index, state=tk.DISABLED)
+        self.index_btn.pack(side=tk.LEFT, padx=5)
+
         # Offset label and entry
         ttk.Label(btn_frame, text="Offset (sectors):").pack(side=tk.LEFT, padx=5)
         self.offset_entry = ttk.Entry(btn_frame, width=10)
@@ -97,6 +203,15 @@ class RaidAlyzerApp(tk.Tk):
         self.find_data_btn = ttk.Button(btn_frame, text="Find data sectors", command=self.find_data_sectors, state=tk.DISABLED)
         self.find_data_btn.pack(side=tk.LEFT, padx=5)
 
+        self.layout_btn = ttk.Button(btn_frame, text="Detect layout", command=self.detect_layout, state=tk.DISABLED)
+        self.layout_btn.pack(side=tk.LEFT, padx=5)
+
+        self.offsets_btn = ttk.Button(btn_frame, text="Detect offsets", command=self.detect_offsets, state=tk.DISABLED)
+        self.offsets_btn.pack(side=tk.LEFT, padx=5)
+
+        ttk.Checkbutton(btn_frame, text="Timers", variable=self.show_timers, command=self.toggle_timers).pack(side=tk.LEFT, padx=5)
+        ttk.Checkbutton(btn_frame, text="Profile", variable=self.profile_run).pack(side=tk.LEFT, padx=5)
+
         # Textboxes frame
         text_frame = ttk.Frame(main_frame)
         text_frame.pack(fill=tk.BOTH, expand=True, pady=10)
@@ -119,17 +234,23 @@ class RaidAlyzerApp(tk.Tk):
         self.text2 = tk.Text(main_frame, wrap=tk.NONE, font=mono_font, width=30, height=15, state=tk.DISABLED)
         self.text2.pack(fill=tk.BOTH, expand=True, pady=10)
 
+        # Stage timers panel, only packed while shown
+        self.timers_label = ttk.Label(main_frame, text="Stage timers")
+        self.text4 = tk.Text(main_frame, wrap=tk.NONE, font=mono_font, width=30, height=12, state=tk.DISABLED)
+
         # Statusbar
         self.statusbar = ttk.Label(self, text="Ready", relief=tk.SUNKEN, anchor=tk.W)
         self.statusbar.pack(side=tk.BOTTOM, fill=tk.X)
 
 
     def open_images(self):
-        files = filedialog.askopenfilenames(filetypes=[("Image Files", "*.img;*.dd;*.bin")])
+        files = filedialog.askopenfilenames(filetypes=[("Image Files", "*.img;*.dd;*.bin;*.raw;*.001;*.gz;*.xz;*.bz2"), ("All Files", "*")])
+        self.cancel_index()
         self.listbox.delete(0, tk.END)
         self.files.clear()
         self.filenames.clear()
-        self.handles.clear()
+        self.disk_offsets = None
+        self.map_engine = None
 
         for file in files:
             self.listbox.insert(tk.END, file)
@@ -139,8 +260,12 @@ class RaidAlyzerApp(tk.Tk):
         # Enable start button if files are selected
         if self.files:
             self.start_btn.config(state=tk.NORMAL)
+            self.sample_btn.config(state=tk.NORMAL)
+            self.index_btn.config(state=tk.NORMAL)
             self.check_entropy_btn.config(state=tk.NORMAL)
             self.find_data_btn.config(state=tk.NORMAL)
+            self.layout_btn.config(state=tk.NORMAL)
+            self.offsets_btn.config(state=tk.NORMAL)
             self.check_prev_btn.config(state=tk.NORMAL)
             self.check_next_btn.config(state=tk.NORMAL)
 
@@ -153,61 +278,171 @@ class RaidAlyzerApp(tk.Tk):
         self.statusbar.config(text="Searching first sector with a entropy above 2.5 on the first disk image...")
         self.statusbar.update_idletasks()
 
-        with open(self.files[0], 'rb') as f:
-            sector_index = 0
-            while True:
-                data = f.read(self.bs)
-                if not data:
-                    break
-                
-                entropy = self.calc_entropy(data)
-                
-                if entropy > 2.5:
-                    self.offset_entry.delete(0, tk.END)
-                    self.offset_entry.insert(0, str(sector_index))
-                    self.statusbar.config(text=f"Found sector #{sector_index} with entropy {entropy:.2f} at {self.files[0]}")
-                    self.find_data_btn.config(state=tk.NORMAL)
-                    return
-                
-                sector_index += 1
-
-
-    def start_analysis(self, offset=0, run_only_one_block=False):
-        # Open all files and store handles
-        for file in self.files:
-            f = open(file, 'rb')
-            f.seek(offset * self.bs)
-
-            self.handles.append(f)
-
-            if self.max_sectors == 0:
-                self.max_sectors = os.path.getsize(file) // self.bs
-            else:
-                self.max_sectors = min(self.max_sectors, os.path.getsize(file) // self.bs)
+        found = find_data_sector(self.files[0], bs=self.bs, threshold=2.5)
+        if found is not None:
+            sector_index, entropy = found
+            self.offset_entry.delete(0, tk.END)
+            self.offset_entry.insert(0, str(sector_index))
+            self.statusbar.config(text=f"Found sector #{sector_index} with entropy {entropy:.2f} at {self.files[0]}")
+            self.find_data_btn.config(state=tk.NORMAL)
+
+
+    def start_analysis(self, offset=0, run_only_one_block=False, engine=None):
+        # Run the engine in a worker thread which posts its progress to a queue
+        if engine is None:
+            engine = self.create_engine()
+            if not run_only_one_block:
+                engine.checkpoint_path = RaidAlyzerApp.CHECKPOINT_FILE
+                offset = self.offer_resume(engine, offset)
+        if self.profile_run.get():
+            engine.profile_path = f"raidalyzer_profile_{time.strftime('%Y%m%d_%H%M%S')}.prof"
+        self.engine = engine
+        self.worker = AnalysisWorker(self.engine)
+        self.last_snapshot = None
+        self.poll_job = None
+        self.worker.start(offset=offset, run_only_one_block=run_only_one_block)
 
         # Update status and buttons
         self.analysis_running = True
-        self.start_time = time.time()
-
-        # Reset analysis variables
-        self.offset = 0
         self.analysis_start_sector = offset
-        self.run_only_one_block = run_only_one_block
-        self.first_analysis_block = True
-        self.analysis_block_entropy = [[] for x in range(len(self.files))]
-        self.last_parity_check_pattern = ""
-        self.parity_check_log = open("parity_check.log", "w")
-
-        self.stats.clear()
-        self.mirrors.clear()
-        self.parity.clear()
 
         # Disable start button during analysis
         self.start_btn.config(state=tk.DISABLED)
+        self.sample_btn.config(state=tk.DISABLED)
         self.stop_btn.config(state=tk.NORMAL)
 
-        # Analysis loop (non-blocking)
-        self.after(1, self.analysis_step)
+        # Poll the worker at a fixed rate (non-blocking)
+        self.poll_job = self.after(self.ui_refresh_ms, self.poll_worker)
+
+
+    def offer_resume(self, engine, offset):
+        # Offer to continue an unfinished analysis of the same images from its checkpoint
+        path = engine.checkpoint_path
+        if not os.path.exists(path):
+            return offset
+
+        try:
+            checkpoint = load_checkpoint(path)
+            check_checkpoint(checkpoint, engine)
+        except (OSError, ValueError):
+            return offset
+
+        if checkpoint["state"]["reached_end"]:
+            return offset
+
+        if messagebox.askyesno("Resume analysis", f"{format_checkpoint(checkpoint)}.\n\nResume this analysis?"):
+            engine.resume_from(path)
+            return checkpoint["settings"]["start_sector"]
+        return offset
+
+
+    def detect_layout(self):
+        # Rank stripe size, parity rotation and disk order hypotheses from the offset on
+        if self.analysis_running:
+            self.stop_analysis()
+
+        try:
+            offset = int(self.offset_entry.get())
+        except ValueError:
+            messagebox.showerror("Invalid Offset", "Offset must be a number, running analysis from offset 0.")
+            offset = 0
+
+        self.statusbar.config(text="Testing stripe sizes, parity rotations and disk orders...")
+        self.statusbar.update_idletasks()
+
+        entropy, parity = layout_signals(self.files, bs=self.bs, start_sector=offset, offsets=self.disk_offsets)
+        hypotheses = detect_layout(entropy, parity, bs=self.bs)
+        self.statusbar.config(text=f"Layout detection from sector {offset} complete.")
+
+        # Show the ranking in its own window
+        window = tk.Toplevel(self)
+        window.title("Layout detection")
+        text = tk.Text(window, wrap=tk.NONE, font=font.Font(family="Consolas", size=10), width=140, height=15)
+        text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        text.insert(tk.END, format_layouts(hypotheses, self.filenames) if hypotheses else "Not enough sectors to test any stripe size.")
+        text.config(state=tk.DISABLED)
+
+
+    def detect_offsets(self):
+        # Find a different start offset of each image and offer to use it for the analysis
+        if self.analysis_running:
+            self.stop_analysis()
+
+        self.statusbar.config(text="Correlating the images to find their start offsets...")
+        self.statusbar.update_idletasks()
+
+        result = detect_offsets(self.files, bs=self.bs)
+        text = format_offsets(result, self.filenames)
+        self.statusbar.config(text="Offset detection complete.")
+
+        if messagebox.askyesno("Offset detection", text + "\nUse these offsets for the analysis?"):
+            self.disk_offsets = result["offsets"] if any(result["offsets"]) else None
+            self.statusbar.config(text="Offsets in use: " + ", ".join(str(offset) for offset in result["offsets"]))
+
+
+    def create_engine(self):
+        # Answer from the sector indexes when all images have an up to date one
+        if indexes_available(self.files, self.bs):
+            engine = IndexedAnalysisEngine(self.files, bs=self.bs, analysis_block_size=self.analysis_block_size)
+        else:
+            engine = RaidAnalysisEngine(self.files, bs=self.bs, analysis_block_size=self.analysis_block_size, processes=self.analysis_processes)
+        engine.disk_offsets = self.disk_offsets
+        return engine
+
+
+    def build_index(self):
+        # Build the missing sector indexes in the background, a second click cancels
+        if self.index_worker is not None:
+            self.cancel_index()
+            self.statusbar.config(text="Building index cancelled.")
+            return
+
+        self.index_worker = IndexWorker(self.files, bs=self.bs)
+        self.index_worker.start()
+        self.index_btn.config(text="Cancel index")
+        self.index_job = self.after(self.ui_refresh_ms, self.poll_index_worker)
+
+
+    def poll_index_worker(self):
+        self.index_job = None
+        worker = self.index_worker
+        if worker is None:
+            return
+
+        if worker.is_alive():
+            if not self.analysis_running:
+                self.statusbar.config(text=f"Building index: {worker.fraction() * 100:.1f}%")
+            self.index_job = self.after(self.ui_refresh_ms, self.poll_index_worker)
+            return
+
+        self.index_worker = None
+        self.index_btn.config(text="Build index")
+        if worker.errors:
+            messagebox.showerror("Building index failed", str(worker.errors[0]))
+        elif not self.analysis_running:
+            self.statusbar.config(text="Index ready, the analysis is answered from the index now.")
+
+
+    def cancel_index(self):
+        if self.index_job is not None:
+            self.after_cancel(self.index_job)
+            self.index_job = None
+
+        if self.index_worker is not None:
+            self.index_worker.cancel()
+            self.index_worker.join()
+            self.index_worker = None
+            self.index_btn.config(text="Build index")
+
+
+    def start_sampling(self):
+        # Estimate the results from sampled stripes, refined until about +/-1% or stopped
+        if self.analysis_running:
+            self.stop_analysis()
+
+        engine = SamplingAnalysisEngine(self.files, bs=self.bs, precision=1.0)
+        engine.disk_offsets = self.disk_offsets
+        self.start_analysis(engine=engine)
 
 
     def check_entropy(self):
@@ -222,10 +457,30 @@ class RaidAlyzerApp(tk.Tk):
             messagebox.showerror("Invalid Offset", "Offset must be a number, running analysis from offset 0.")
             offset = 0
 
+        # After a full analysis the block is shown on the entropy map without reading the images
+        if self.map_engine is not None:
+            self.show_entropy_map(offset)
+            return
+
         # Run analysis for one block only
         self.start_analysis(offset=offset, run_only_one_block=True)
 
 
+    def show_entropy_map(self, offset):
+        # A new map shows the whole range unless an offset within it is entered, an
+        # open one moves to the analysis block from offset (e.g. with << and >>)
+        if self.entropy_map is not None and self.entropy_map.is_open() and self.entropy_map.engine is self.map_engine:
+            self.entropy_map.show_range(offset, offset + self.analysis_block_size)
+            return
+
+        self.entropy_map = EntropyMapView(self.map_engine)
+        if offset > self.map_engine.analysis_start_sector:
+            self.entropy_map.show_range(offset, offset + self.analysis_block_size)
+        else:
+            self.entropy_map.show_range(self.entropy_map.start, self.entropy_map.end)
+        plt.show()
+
+
     def check_next_block(self):
         try:
             offset = int(self.offset_entry.get())
@@ -254,367 +509,122 @@ class RaidAlyzerApp(tk.Tk):
         self.check_entropy()
 
 
-    def analysis_step(self):
-        if self.analysis_running:
-            for _ in range(self.analysis_block_size):
-                if not self.analysis_running: 
-                    break
-                self.read_next_data_block()
-
-            # Calculate average entropy for actual analysis block
-            if self.first_analysis_block:
-                block_avg = 0.0
-                for i in range(len(self.files)):
-                    block_avg += sum(self.analysis_block_entropy[i]) / len(self.analysis_block_entropy[i])
-                block_avg /= len(self.files)
-
-                # Stop if some block with higher entropy found
-                if block_avg > 25:
-                    self.first_analysis_block = False
-
-                # Reset entropy data for next block
-                elif not self.run_only_one_block:
-                    self.analysis_block_entropy = [[] for x in range(len(self.files))]
-
-            
-            # Update UI after each block
-            self.statusbar.config(text=f"Processed {self.offset} / {self.max_sectors} sectors: {self.offset * 100 / self.max_sectors:.1f}% ({self.offset / (time.time() - self.start_time):.1f} sectors/sec.)")
-            self.update_output()
-
-            # If only one block run requested, stop analysis
-            if self.run_only_one_block:
-                self.stop_analysis()
-                return
-
-            # Schedule next step
-            self.after(1, self.analysis_step)
+    def poll_worker(self):
+        self.poll_job = None
+        if self.worker is None:
+            return
 
+        # Only the latest progress snapshot is rendered
+        finished = False
+        for event, snapshot in self.worker.events():
+            if event == "progress":
+                self.render_snapshot(snapshot)
+            elif event == "finished":
+                self.render_snapshot(snapshot)
+                finished = True
+
+        if finished:
+            self.worker.join()
+            self.analysis_finished()
         else:
-            self.update_output()
-
-
-    def read_next_data_block(self):
-        # Read a block of data from each file
-        data_blocks = {}
-        for i, handle in enumerate(self.handles):
-            data = handle.read(self.bs)
-
-            if self.first_potential_bootsector_found_on == "" and data[-2:] == b'\x55\xAA':
-                self.first_potential_bootsector_found_on = f"Bootsector signature found in file: {self.filenames[i]} at sector {self.offset}"
-            
-            if self.first_potential_efi_part_found_on == "" and data[:8].decode(errors='ignore') == "EFI PART":
-                self.first_potential_efi_part_found_on = f"EFI PART header found in file:      {self.filenames[i]} at sector {self.offset}"
-
-            if not data:
-                self.analysis_running = False
-                self.statusbar.config(text="Reached end of one or more files.")
-                self.stop_analysis()
-                self.update_output()
-                return
-            
-            data_blocks[self.filenames[i]] = data
-
-        # Initialize statistics for first data block
-        if self.offset == 0:
-            for handle in self.handles:
-                self.stats.append({
-                    'zero_blocks': 0,
-                    'pattern_blocks': 0,
-                    'entropy': 0.0,
-                })
-
-                self.mirrors.append([0 for x in range(len(self.handles))])
-
-            self.parity = [0 for x in range(len(self.handles) + 1)]
-
-        # Calculate statistics for each block
-        self.offset += 1
-        
-        # Process the data blocks (placeholder for actual analysis logic)
-        self.process_data_blocks(data_blocks)
-
-
-    def calc_entropy(self, data):
-        if not data:
-            return 0.0
-        freq = [0] * 256
-        for b in data:
-            freq[b] += 1
-        entropy = 0.0
-        for count in freq:
-            if count:
-                p = count / len(data)
-                entropy -= p * math.log2(p)
-        return entropy
-
-
-    def check_parity(self, data_blocks):
-        parity_block = bytearray(data_blocks.pop(0))                  # Remove first block for parity comparison
-        parity_block = int.from_bytes(parity_block, byteorder='big')  # Convert to integer for XOR comparison
-        xor_result = 0                                                # Initialize empty XOR result
-
-        for block in data_blocks:
-            block_int = int.from_bytes(block, byteorder='big')        # Convert block to integer
-            xor_result ^= block_int                                   # XOR each block
-
-        return int(parity_block == xor_result)                        # Return 1 if parity matches
-    
-
-    def process_data_blocks(self, data_block_dict):
-        # Update statistics for each data block
-        data_blocks = list(data_block_dict.values())
-
-        for i in range(len(data_blocks)):
-            entropy = 0.0
-
-            if data_blocks[i] == b'\x00' * self.bs:
-                self.stats[i]['zero_blocks'] += 1
-            
-            elif data_blocks[i] == bytes([data_blocks[i][0] for x in range(self.bs)]):
-                self.stats[i]['pattern_blocks'] += 1
-
-            # Calculate entropy only for non-zero, non-pattern blocks
-            else:
-                entropy = self.calc_entropy(data_blocks[i])
-                self.stats[i]['entropy'] += entropy
-
-            if self.first_analysis_block:
-                self.analysis_block_entropy[i].append(int(entropy*10 + 1))
-
-        # Update mirror status for each data block
-        for i in range(len(data_blocks)):
-            for j in range(len(data_blocks)):
-                if i != j and data_blocks[i] == data_blocks[j]:
-                    self.mirrors[i][j] += 1
-
-        # Update parity status for all data block
-        res = self.check_parity(data_blocks.copy())
-        self.parity[0] += res
-
-        # Check for new pattern
-        one_combination_checked_out = False
-        if res == 1:
-            one_combination_checked_out = True
-            parity_check_pattern = " + ".join(data_block_dict.keys())
-            if self.last_parity_check_pattern != parity_check_pattern:
-                self.parity_check_log.write(f"{self.offset};{parity_check_pattern}\n")
-                self.last_parity_check_pattern = parity_check_pattern
-
-        # Check parity for all combinations of blocks with one block missing
-        for i in range(len(data_blocks)):
-            new_data_blocks = data_block_dict.copy()
-            del(new_data_blocks[self.filenames[i]])                 # Remove one block for parity calculation
-            res = self.check_parity(list(new_data_blocks.values())) 
-            self.parity[i+1] += res                                 # Update i+1 as 0 is full parity
-            
-            if res == 1:
-                one_combination_checked_out = True
-                parity_check_pattern = " + ".join(new_data_blocks.keys())
-                if self.last_parity_check_pattern != parity_check_pattern:
-                    self.parity_check_log.write(f"{self.offset};{parity_check_pattern}\n")
-                    self.last_parity_check_pattern = parity_check_pattern
-
-        if not one_combination_checked_out:
-            parity_check_pattern = "NO_MATCH"
-            if self.last_parity_check_pattern != parity_check_pattern:
-                self.parity_check_log.write(f"{self.offset};{parity_check_pattern}\n")
-                self.last_parity_check_pattern = parity_check_pattern
+            self.poll_job = self.after(self.ui_refresh_ms, self.poll_worker)
+
+
+    def toggle_timers(self):
+        if self.show_timers.get():
+            self.timers_label.pack(fill=tk.X, expand=False, pady=(0, 5))
+            self.text4.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
+            if self.last_snapshot is not None:
+                self.set_text(self.text4, self.last_snapshot["timers"])
+        else:
+            self.timers_label.pack_forget()
+            self.text4.pack_forget()
+
+
+    def set_text(self, widget, text):
+        widget.config(state=tk.NORMAL)
+        widget.delete(1.0, tk.END)
+        widget.insert(tk.END, text)
+        widget.config(state=tk.DISABLED)
+
+
+    def render_snapshot(self, snapshot):
+        # Skip rendering if nothing changed since the last update
+        if snapshot == self.last_snapshot:
+            return
+
+        wall, cpu = time.perf_counter(), time.thread_time()
+        last = self.last_snapshot or {}
+        self.last_snapshot = snapshot
+
+        self.statusbar.config(text=snapshot["status"])
+
+        widgets = [(self.text1, "stats"), (self.text2, "mirrors"), (self.text3, "parity")]
+        if self.show_timers.get():
+            widgets.append((self.text4, "timers"))
+
+        for widget, key in widgets:
+            if snapshot[key] != last.get(key):
+                self.set_text(widget, snapshot[key])
+
+        # The render time shows up in the next snapshot
+        if self.engine is not None:
+            self.engine.timers.add("ui_render", time.perf_counter() - wall, time.thread_time() - cpu)
 
 
     def update_output(self):
-        # Update statistics textbox
-        stats = " #  FILE                   ZERO %  PATTERN %  ENTROPY\n"
-        for idx in range(len(self.filenames)):
-            file = self.filenames[idx]
-            zero_percent = (self.stats[idx]['zero_blocks'] / self.offset) * 100
-            pattern_percent = (self.stats[idx]['pattern_blocks'] / self.offset) * 100
-            entropy = self.stats[idx]['entropy'] / self.offset
-            stats += f"{idx:>2}  {file[:20]:<20}  {zero_percent:>5.1f} %  {pattern_percent:>7.1f} %  {entropy:>7.1f}\n" 
-
-        stats += "\n---\n\n"
-
-        # Check for first potential bootsector and EFI PART findings
-        if self.first_potential_bootsector_found_on != "":
-            stats += f"{self.first_potential_bootsector_found_on}\n"
-
-        if self.first_potential_efi_part_found_on != "":
-            stats += f"{self.first_potential_efi_part_found_on}\n"
-        
-        self.text1.config(state=tk.NORMAL)
-        self.text1.delete(1.0, tk.END)
-        self.text1.insert(tk.END, stats)
-        self.text1.config(state=tk.DISABLED)
-
-        # Update mirrors textbox
-        mirrors = " " * 22 # 20 spaces for index column + 2 spaces as padding
-        for file in self.filenames:
-            file = file[:20]
-            mirrors += f"{file:>20}  "
-        mirrors += "\n"
-
-        for i in range(len(self.files)):
-            file = self.filenames[i][:20]
-            mirrors += f"{file:>20}  "
-            for j in range(len(self.files)):
-                if i == j:
-                    mirrors += " " * 17 + "---  "
-                else:
-                    mirrors += f"{self.mirrors[i][j]*100/self.offset:>19.0f}%  "
-            mirrors += "\n"
-
-        self.text2.config(state=tk.NORMAL)
-        self.text2.delete(1.0, tk.END)
-        self.text2.insert(tk.END, mirrors)
-        self.text2.config(state=tk.DISABLED)
-
-        # Update parity textbox
-        file = "ALL FILES"
-        parity = f"{file:<28}  {self.parity[0]*100/self.offset:>3.0f}%\n"
-        for i in range(len(self.filenames)):
-            file = self.filenames[i][:20]
-            parity += f"WITHOUT {file:<20}  {self.parity[i+1]*100/self.offset:>3.0f}%\n"
-
-        self.text3.config(state=tk.NORMAL)
-        self.text3.delete(1.0, tk.END)
-        self.text3.insert(tk.END, parity)
-        self.text3.config(state=tk.DISABLED)
-
-        # Update
-        self.statusbar.update_idletasks()
-        self.text1.update_idletasks()
-        self.text2.update_idletasks()
-        self.text3.update_idletasks()
-
-
-    def create_entropy_graph(self, entropy_data):
-        entropy_data = {self.filenames[i]: entropy_data[i] for i in range(len(self.files))}
-        json_entropy_data = json.dumps(entropy_data)
-
-        return """
-        <style>
-            .disk-row {
-                background-color: #1e1e1e;
-                margin-bottom: 15px;
-                padding: 10px;
-                border-radius: 4px;
-            }
-            .disk-header {
-                font-family: 'Consolas', monospace;
-                color: #4bc0c0;
-                font-size: 12px;
-                margin-bottom: 5px;
-            }
-            /* This rule is what stops the "endless growth" */
-            .chart-wrapper {
-                height: 120px; 
-                position: relative;
-                width: 100%;
-            }
-        </style>
-
-        <div id="chartsContainer"></div>
-
-        <script>
-        const raidData = """ + json_entropy_data + """;
-        const container = document.getElementById('chartsContainer');
-
-        Object.entries(raidData).forEach(([filename, values]) => {
-            const row = document.createElement('div');
-            row.className = 'disk-row';
-            
-            const header = document.createElement('div');
-            header.className = 'disk-header';
-            header.innerHTML = `FILE: ${filename}`;
-            
-            const wrapper = document.createElement('div');
-            wrapper.className = 'chart-wrapper';
-
-            const canvas = document.createElement('canvas');
-            
-            // CORRECT HIERARCHY:
-            wrapper.appendChild(canvas); // Put canvas in wrapper
-            row.appendChild(header);      // Put header in row
-            row.appendChild(wrapper);     // Put wrapper in row
-            container.appendChild(row);   // Put row in main container
-
-            new Chart(canvas, {
-                type: 'line',
-                data: {
-                    labels: values.map((_, i) => i),
-                    datasets: [{
-                        label: 'Entropy',
-                        data: values,
-                        borderColor: '#ff6384',
-                        backgroundColor: 'rgba(255, 99, 132, 0.1)',
-                        borderWidth: 1.5,
-                        fill: true,
-                        pointRadius: 1,
-                        tension: 0.1
-                    }]
-                },
-                options: {
-                    responsive: true,
-                    maintainAspectRatio: false, // Allows the chart to respect the 120px height
-                    scales: {
-                        y: {
-                            beginAtZero: true,
-                            max: 100,
-                            ticks: { color: '#888', font: { size: 10 } },
-                            grid: { color: '#333' }
-                        },
-                        x: {
-                            ticks: { color: '#888', font: { size: 10 } },
-                            grid: { color: '#333' }
-                        }
-                    },
-                    plugins: {
-                        legend: { display: false }
-                    }
-                }
-            });
-        });
-        </script>
-        """
-        
+        if self.engine is not None:
+            self.render_snapshot(self.engine.snapshot())
+
 
     def stop_analysis(self):
-        self.update_output()
+        # Cooperative cancel, the worker reports "finished" which writes the report
+        if self.worker is not None and self.worker.is_alive():
+            self.worker.cancel()
+            self.worker.join()
+            self.poll_worker()
 
-        # Close all file handles
-        if not self.parity_check_log is None:
-            self.parity_check_log.close()
-            self.parity_check_log = None
 
-        for handle in self.handles:
-            handle.close()
+    def analysis_finished(self):
+        engine = self.engine
+        worker = self.worker
+        self.worker = None
+
+        if self.poll_job is not None:
+            self.after_cancel(self.poll_job)
+            self.poll_job = None
+
+        self.update_output()
+
+        if worker.error is not None:
+            messagebox.showerror("Analysis failed", str(worker.error))
 
-        self.parity_check_log = None
-        self.handles.clear()
-        
         # Stop analysis flag and activate start button
         self.analysis_running = False
         self.start_btn.config(state=tk.NORMAL)
+        self.sample_btn.config(state=tk.NORMAL)
         self.stop_btn.config(state=tk.DISABLED)
+
         self.statusbar.config(text="Writing report")
         self.statusbar.update_idletasks()
 
         # Skip report generation for one-block analysis
-        if self.run_only_one_block:
+        if engine.run_only_one_block:
             self.statusbar.config(text="Analysis complete.")
             self.statusbar.update_idletasks()
 
             # Open graph in watplotlib
-            num_files = len(self.files)
-    
+            num_files = len(engine.files)
+
             fig, axes = plt.subplots(nrows=num_files, ncols=1, figsize=(12, 2 * num_files), sharex=True)
             fig.canvas.manager.set_window_title("Entropy graph")
             if num_files == 1:
                 axes = [axes]
 
-            for i, (filename, values) in enumerate(zip(self.filenames, self.analysis_block_entropy)):
+            for i, (filename, values) in enumerate(zip(engine.filenames, engine.analysis_block_entropy)):
                 ax = axes[i]
                 ax.plot(values, label=filename, color=f'C{i}', linewidth=1.5)
-                
+
                 # Formatting each individual subplot
                 ax.set_title(f"FILE: {filename}", fontsize=10, loc='left', fontweight='bold')
                 ax.set_ylabel('Entropy (%)', fontsize=9)
@@ -623,98 +633,35 @@ class RaidAlyzerApp(tk.Tk):
 
             # Global X-axis label at the bottom
             plt.xlabel('Sector Index / Block Offset', fontsize=10)
-            
+
             # Adjust layout to prevent titles and labels from overlapping
             plt.tight_layout()
             plt.show()
 
             return
 
+        # The entropy map of the analyzed range is shown by "Check entropy" from now on
+        if engine.pyramid is not None and len(engine.pyramid) and engine.files == self.files:
+            self.map_engine = engine
+
         # Write HTML report
-        report_file = f"raidalyzer_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
-
-        with open(report_file, "w") as report:
-            h1 = f"RaidAlyzer v{RaidAlyzerApp.VERSION} Report"
-            report.write("<!DOCTYPE html>\n")
-            report.write("<html lang=\"en\">\n")
-            report.write("<head>\n")
-            report.write(f"<title>{h1}</title>\n")
-
-            # Styles
-            report.write("<script src=\"https://cdn.jsdelivr.net/npm/chart.js\"></script>\n")
-            report.write("<style>\n")
-            report.write("body { font-family: monospace; background-color: #1e1e1e; color: #ffffff; padding: 20px; } \n")
-            report.write("h2 { color: #4bc0c0; } \n")
-            report.write(".chart-container { width: 90%; margin: auto; background-color: #2d2d2d; padding: 20px; border-radius: 8px; box-shadow: 0 4px 15px rgba(0,0,0,0.5); } \n")
-            report.write(".disk-row { background-color: #1e1e1e; margin-bottom: 15px; padding: 10px; border-radius: 4px; border-left: 4px solid #4bc0c0; } \n")
-            report.write(".disk-header { font-size: 0.9em; color: #4bc0c0; margin-bottom: 5px; display: flex; justify-content: space-between; } \n")
-            report.write(".chart-wrapper { height: 120px; position: relative; width: 100%; } \n")
-            report.write("</style>\n")
-            report.write("</head>\n")
-
-            # Body
-            report.write("<body>\n")
-            report.write(f"<h1>{h1}</h1>\n")
-            report.write("<hr><br><br>\n\n")
-            report.write(f"<h2>Analyzed files:</h2><hr><br>\n")
-            report.write("<ul>\n")
-            for file in self.filenames:
-                report.write(f"<li>{file}</li>\n")
-            report.write("</ul><br><br>\n\n")
-
-            report.write(f"<b>Start sector:</b> {self.analysis_start_sector}<br><br><hr><br>\n\n")
-
-            report.write("<h2>Statistics:</h2><hr><br>\n")
-            report.write("<pre>\n")
-            report.write(self.text1.get(1.0, tk.END))
-            report.write("</pre><br><br>\n\n")
-
-            report.write("<h2>Mirror Analysis:</h2><hr><br>\n")
-            report.write("<pre>\n")
-            report.write(self.text2.get(1.0, tk.END))
-            report.write("</pre><br><br>\n\n")
-
-            report.write("<h2>Parity Analysis:</h2><hr><br>\n")
-            report.write("<pre>\n")
-            report.write(self.text3.get(1.0, tk.END))
-            report.write("</pre><br><br>\n\n")
-
-            # create entropy graph from first analysis block
-            report.write("<h2>Entropy graph for first block potentially containing data:</h2><hr><br>\n")
-            report.write(self.create_entropy_graph(self.analysis_block_entropy))
-            report.write("<br><br>\n\n")
-
-            report.write("<h2>Parity Check Log:</h2><hr><br>\n")
-            report.write("<pre>\n")
-
-            parity_check_log = []
-            with open("parity_check.log", "r") as logfile:
-                for line in logfile:
-                    parity_check_log.append(line.strip().split(";"))
-                    if len(parity_check_log) > 999:
-                        break
-            
-            # Add another log line and adding the last sector of the read data
-            if len(parity_check_log) < 1000:
-                parity_check_log.append([str(self.offset), "..."])
-
-            # Write ranges to report
-            for i in range(len(parity_check_log) - 1):
-                from_sec = int(parity_check_log[i][0])
-                to_sec = int(parity_check_log[i+1][0]) - 1
-                # Ensure to_sec is not less than from_sec
-                if to_sec < from_sec:
-                    to_sec = from_sec
-                pattern = parity_check_log[i][1].strip()
-
-                report.write(f"{from_sec} - {to_sec} : {pattern}\n")
-
-            report.write("</pre>\n")
-
-        self.statusbar.config(text=f"Analysis complete. Report written to: {report_file}")
+        report_file = engine.write_report()
+
+        if engine.profile_path is not None:
+            self.statusbar.config(text=f"Analysis complete. Report written to: {report_file}, profile to: {engine.profile_path}")
+        else:
+            self.statusbar.config(text=f"Analysis complete. Report written to: {report_file}")
         self.statusbar.update_idletasks()
 
 
 if __name__ == "__main__":
+    # Needed for the shard worker processes of the frozen executable
+    multiprocessing.freeze_support()
+
+    # Any command line arguments run the headless CLI (e.g. "raidalyzer analyze img1 img2 ...")
+    if len(sys.argv) > 1:
+        from raidcore.cli import main
+        sys.exit(main(sys.argv[1:]))
+
     app = RaidAlyzerApp()
     app.mainloop()
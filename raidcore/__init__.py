@@ -0,0 +1,19 @@
+from .assemble import ArrayAssembler, ArrayVolume, open_volume, write_volume
+from .checkpoint import check_checkpoint, format_checkpoint, load_checkpoint
+from .classify import calc_entropy, classify_sectors
+from .compressed import CompressedImage, build_chunk_index
+from .engine import VERSION, RaidAnalysisEngine, find_data_sector
+from .export import ImageExporter, rebuild_plan, stitch_plan
+from .index import IndexWorker, MultiIndexReader, SectorIndex, build_index, load_index
+from .indexed import IndexedAnalysisEngine, indexes_available
+from .layout import detect_layout, format_layouts, layout_signals
+from .offsets import detect_offsets, format_offsets
+from .paritylog import ParityRunLog, load_parity_runs, read_parity_log
+from .heatmap import RegionHeatmap, load_heatmap
+from .pyramid import EntropyPyramid, load_pyramid
+from .reader import ImageReader, MultiImageReader, PrefetchImageReader
+from .report import write_html_report
+from .shard import ShardedAnalysis
+from .signatures import SIGNATURE_NAMES, SIGNATURES, SignatureHits, scan_signatures
+from .worker import AnalysisWorker
+from .sampling import SamplingAnalysisEngine
@@ -0,0 +1,282 @@
+import io
+import os
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .layout import RAID5_LAYOUTS, layout_rows, raid6_rows
+from .reader import ImageReader
+
+
+# Levels the volume can be reassembled from, with the fewest members each needs
+ASSEMBLE_LEVELS = {"RAID0": 1, "RAID1": 2, "RAID5": 3, "RAID6": 4, "RAID10": 4}
+
+
+def level_rows(level, layout, disks):
+    # Rotation period of the level as (data positions (period, data disks) in
+    # logical order, Q position per row or None), RAID10 as md near=2 pairs
+    if level == "RAID1":
+        return np.zeros((1, 1), dtype=np.intp), None
+    if level == "RAID10":
+        return np.arange(0, disks, 2, dtype=np.intp)[None], None
+    if level == "RAID6":
+        rows = raid6_rows(layout, disks)
+        return np.array([data for p, q, data in rows], dtype=np.intp), np.array([q for p, q, data in rows], dtype=np.intp)
+    return np.array([data for parity, data in layout_rows(level, layout, disks)], dtype=np.intp), None
+
+
+class ArrayAssembler:
+    # Maps the logical sectors of a RAID volume to the member images and reads
+    # them as whole rows of chunks: each member's part of consecutive rows is one
+    # contiguous range, read by one thread per member at the same time. A missing
+    # member (None in files) is rebuilt for all rows of a batch at once: by XOR
+    # of the others for RAID5 and for RAID6 (leaving out each row's Q block),
+    # from its mirror for RAID1/10. The rows are then de-striped with one gather.
+    #
+    # files are in array position order, e.g. the disk order of the layout
+    # command. Logical sector 0 is sector start_sector + offsets[i] of image i.
+    def __init__(self, files, level="RAID5", stripe_size=65536, layout="left-symmetric", bs=512,
+                 start_sector=0, offsets=None, batch_size=32 << 20):
+        if level not in ASSEMBLE_LEVELS:
+            raise ValueError(f"Unknown RAID level: {level}")
+        if level in ("RAID5", "RAID6") and layout not in RAID5_LAYOUTS:
+            raise ValueError(f"Unknown parity rotation: {layout}")
+        if len(files) < ASSEMBLE_LEVELS[level] or (level == "RAID10" and len(files) % 2):
+            raise ValueError(f"{level} needs at least {ASSEMBLE_LEVELS[level]} disks" + (" in pairs" if level == "RAID10" else ""))
+        if stripe_size % bs:
+            raise ValueError("The stripe size must be a multiple of the sector size")
+
+        self.files = list(files)
+        self.level = level
+        self.layout = layout if level in ("RAID5", "RAID6") else ""
+        self.bs = bs
+        self.chunk = stripe_size // bs
+        self.start_sector = start_sector
+        self.offsets = list(offsets) if offsets is not None else [0 for x in self.files]
+        self.disks = len(self.files)
+
+        self.missing = [i for i, file in enumerate(self.files) if file is None]
+        if len(self.missing) > 1 or (self.missing and level == "RAID0"):
+            raise ValueError(f"{level} can't be reassembled with {len(self.missing)} missing members")
+        if self.missing and level == "RAID10" and self.files[self.missing[0] ^ 1] is None:
+            raise ValueError("Both members of a RAID10 mirror are missing")
+
+        self.data_positions, self.q_positions = level_rows(level, layout, self.disks)
+        self.period, self.data_disks = self.data_positions.shape
+
+        self.readers = [None for x in self.files]
+        try:
+            for i, file in enumerate(self.files):
+                if file is not None:
+                    self.readers[i] = ImageReader(file, bs=bs)
+        except OSError:
+            self.close()
+            raise
+
+        # Whole rows only, up to the end of the shortest member
+        self.rows = min(max(reader.sectors - start_sector - offset, 0) // self.chunk
+                        for reader, offset in zip(self.readers, self.offsets) if reader is not None)
+        self.sectors = self.rows * self.data_disks * self.chunk
+        self.size = self.sectors * bs
+
+        # Rows read at once, about batch_size bytes of volume data
+        self.batch_rows = max(batch_size // (self.data_disks * self.chunk * bs), 1)
+        self.batches = -(-self.rows // self.batch_rows)
+
+        self.lock = threading.Lock()            # One batch is read at a time, the readers are shared
+        self.pool = ThreadPoolExecutor(max(self.disks - len(self.missing), 1))
+
+
+    def close(self):
+        for reader in self.readers:
+            if reader is not None:
+                reader.close()
+        self.readers = []
+        if getattr(self, "pool", None) is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+    def read_member(self, i, first_row, out):
+        # Member i's chunks of the rows from first_row into out, zeros past its end
+        done = self.readers[i].readinto(self.start_sector + self.offsets[i] + first_row * self.chunk, out)
+        out[done:] = 0
+
+
+    def rebuild_missing(self, members, residues):
+        # Fill the missing member's rows which hold data
+        m = self.missing[0]
+        rows = np.flatnonzero(np.isin(residues, np.flatnonzero((self.data_positions == m).any(axis=1))))
+        if len(rows) == 0:
+            return
+        if self.level in ("RAID1", "RAID10"):
+            members[m] = members[m ^ 1 if self.level == "RAID10" else (m + 1) % self.disks]
+            return
+
+        # XOR of the others in place for all rows, also where it isn't needed:
+        # that is cheaper than gathering the rows
+        words = members.view(np.uint64) if self.bs % 8 == 0 else members
+        present = [i for i in range(self.disks) if i != m]
+        np.bitwise_xor(words[present[0]], words[present[1]], out=words[m])
+        for i in present[2:]:
+            words[m] ^= words[i]
+        if self.q_positions is not None:
+            # Q is no part of the XOR parity, take it out again
+            q = self.q_positions[residues[rows]]
+            words[m, rows] ^= words[q, rows]
+
+
+    def read_batch(self, batch):
+        # Volume data of a batch of rows as a (sectors, bs) array
+        first_row = batch * self.batch_rows
+        count = min(self.batch_rows, self.rows - first_row)
+        members = np.empty((self.disks, count, self.chunk, self.bs), dtype=np.uint8)
+        with self.lock:
+            futures = [self.pool.submit(self.read_member, i, first_row, members[i].reshape(-1, self.bs))
+                       for i in range(self.disks) if self.readers[i] is not None]
+            for future in futures:
+                future.result()
+
+        residues = (first_row + np.arange(count)) % self.period
+        if self.missing:
+            self.rebuild_missing(members, residues)
+
+        rows = np.arange(count)[:, None]
+        return members[self.data_positions[residues], rows].reshape(-1, self.bs)
+
+
+    def locate(self, sector):
+        # (member position, member sector) of a logical sector of the volume
+        chunk, within = divmod(sector, self.chunk)
+        row, k = divmod(chunk, self.data_disks)
+        position = int(self.data_positions[row % self.period, k])
+        return position, self.start_sector + self.offsets[position] + row * self.chunk + within
+
+
+class ArrayVolume(io.RawIOBase):
+    # Read-only file-like view of the reassembled volume, for tools which scan a
+    # volume. Batches of rows are kept in a small LRU cache, and while the reads
+    # are sequential the next batch is read ahead in the background.
+    def __init__(self, assembler, cache_batches=4, close_assembler=False):
+        super().__init__()
+        self.assembler = assembler
+        self.close_assembler = close_assembler
+        self.cache_batches = max(cache_batches, 2)
+        self.cache = OrderedDict()
+        self.position = 0
+        self.last_batch = -1                    # Reading from the start counts as sequential
+        self.prefetch = ThreadPoolExecutor(1)
+        self.ahead = {}                         # Batch read ahead: future
+
+
+    def readable(self):
+        return True
+
+
+    def seekable(self):
+        return True
+
+
+    def tell(self):
+        return self.position
+
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.assembler.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return self.position
+
+
+    def batch(self, index):
+        data = self.cache.get(index)
+        if data is not None:
+            self.cache.move_to_end(index)
+        else:
+            future = self.ahead.pop(index, None)
+            data = future.result() if future is not None else self.assembler.read_batch(index)
+            self.cache[index] = data
+            while len(self.cache) > self.cache_batches:
+                self.cache.popitem(last=False)
+
+        # Sequential reading: read the following batch ahead
+        following = index + 1
+        if self.last_batch == index - 1 and following < self.assembler.batches and following not in self.cache and following not in self.ahead:
+            self.ahead = {following: self.prefetch.submit(self.assembler.read_batch, following)}
+        self.last_batch = index
+        return data
+
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        batch_bytes = self.assembler.batch_rows * self.assembler.data_disks * self.assembler.chunk * self.assembler.bs
+        done = 0
+        while done < len(view) and self.position < self.assembler.size:
+            index, within = divmod(self.position, batch_bytes)
+            data = self.batch(index).reshape(-1)
+            count = min(len(view) - done, len(data) - within)
+            view[done:done + count] = data[within:within + count]
+            done += count
+            self.position += count
+        return done
+
+
+    def close(self):
+        if not self.closed:
+            self.prefetch.shutdown(wait=True)
+            self.ahead = {}
+            self.cache.clear()
+            if self.close_assembler:
+                self.assembler.close()
+        super().close()
+
+
+def open_volume(files, level="RAID5", stripe_size=65536, layout="left-symmetric", bs=512, start_sector=0, offsets=None,
+                batch_size=32 << 20, cache_batches=4):
+    # Buffered binary file of the reassembled volume, closing it closes the images
+    assembler = ArrayAssembler(files, level=level, stripe_size=stripe_size, layout=layout, bs=bs,
+                               start_sector=start_sector, offsets=offsets, batch_size=batch_size)
+    return io.BufferedReader(ArrayVolume(assembler, cache_batches=cache_batches, close_assembler=True), buffer_size=1 << 20)
+
+
+def write_volume(assembler, path, progress=None, cancel_event=None):
+    # Write the flat volume image, reading the next batch while one is written.
+    # A new or regular output file is truncated to its size and all-zero chunks
+    # are left as holes. Returns the sectors written, None if cancelled.
+    sparse = not os.path.exists(path) or os.path.isfile(path)
+    chunk_bytes = assembler.chunk * assembler.bs
+    volume = ArrayVolume(assembler, cache_batches=2)
+    try:
+        with open(path, "wb" if sparse else "r+b", buffering=0) as out:
+            if sparse:
+                out.truncate(assembler.size)
+
+            position = 0
+            for index in range(assembler.batches):
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                data = volume.batch(index).reshape(-1, chunk_bytes)
+
+                # Write the runs of chunks with data, or everything to a device
+                keep = data.any(axis=1) if sparse else np.ones(len(data), dtype=bool)
+                edges = np.flatnonzero(np.diff(np.concatenate(([False], keep, [False])).astype(np.int8)))
+                for first, last in zip(edges[::2].tolist(), edges[1::2].tolist()):
+                    view = memoryview(data[first:last].reshape(-1))
+                    out.seek(position + first * chunk_bytes)
+                    while len(view):
+                        view = view[out.write(view):]
+
+                position += data.size
+                if progress is not None:
+                    progress(position // assembler.bs, assembler.sectors)
+    finally:
+        volume.close()
+
+    return assembler.sectors
@@ -0,0 +1,2 @@
+from .synthetic import LEVELS, generate_raid, raid6_rows
+from .timing import SCENARIOS, STAGES, format_benchmark, run_benchmark, scenario_kwargs, time_engine, time_stages
@@ -0,0 +1,158 @@
+import os
+
+import numpy as np
+
+from ..layout import RAID5_LAYOUTS, layout_rows, raid6_rows
+from ..parity import as_words
+from ..raid6 import q_syndrome
+
+
+LEVELS = ["RAID0", "RAID1", "RAID5", "RAID6", "RAID10"]
+
+# Byte values of the "text" chunks, about 6 bits of entropy per byte
+TEXT_ALPHABET = np.frombuffer(b"etaoinshrdlucmfwypvbgkjqxz ETAOINSHRDLU.,;:-_0123456789\n\t()[]{}", dtype=np.uint8)
+
+
+def data_chunks(rng, rows, count, chunk, bs, zero_fraction, text_fraction, run_chunks=8):
+    # (rows, count, chunk, bs) array of data chunks in logical order, each random,
+    # text-like or zero. Like files, the kinds come in runs of about run_chunks
+    # chunks, so consecutive chunks usually continue the same kind of content.
+    data = rng.integers(0, 256, (rows, count, chunk, bs), dtype=np.uint8)
+    runs = rows * count // run_chunks + 1
+    kinds = rng.choice(3, size=runs, p=[zero_fraction, text_fraction, 1 - zero_fraction - text_fraction])
+    kind = np.repeat(kinds, rng.geometric(1 / run_chunks, runs))
+    kind = np.resize(kind, rows * count).reshape(rows, count)
+    data[kind == 1] = TEXT_ALPHABET[data[kind == 1] % len(TEXT_ALPHABET)]
+    data[kind == 0] = 0
+    return data
+
+
+def stripe_rows(level, layout, disks, first_row, data):
+    # Member contents (disks, rows, chunk, bs) of the given rows from their data chunks
+    rows, count, chunk, bs = data.shape
+    out = np.empty((disks, rows, chunk, bs), dtype=np.uint8)
+    residues = (first_row + np.arange(rows)) % disks
+
+    if level == "RAID0":
+        out[:] = data.transpose(1, 0, 2, 3)
+    elif level == "RAID1":
+        out[:] = data[:, 0][None]
+    elif level == "RAID10":
+        for pair in range(disks // 2):
+            out[2 * pair] = data[:, pair]
+            out[2 * pair + 1] = data[:, pair]
+    elif level == "RAID5":
+        for residue, (parity, positions) in enumerate(layout_rows("RAID5", layout, disks)):
+            selected = residues == residue
+            block = data[selected]
+            for k, position in enumerate(positions):
+                out[position, selected] = block[:, k]
+            out[parity, selected] = np.bitwise_xor.reduce(block, axis=1)
+    elif level == "RAID6":
+        for residue, (parity, q, positions) in enumerate(raid6_rows(layout, disks)):
+            selected = residues == residue
+            block = data[selected]
+            for k, position in enumerate(positions):
+                out[position, selected] = block[:, k]
+            out[parity, selected] = np.bitwise_xor.reduce(block, axis=1)
+            words = [as_words(block[:, k]) for k in range(len(positions))]
+            out[q, selected] = q_syndrome(words).view(np.uint8).reshape(block[:, 0].shape)
+    else:
+        raise ValueError(f"Unknown RAID level: {level}")
+
+    return out
+
+
+def data_disks(level, disks):
+    # Number of data chunks per row
+    return {"RAID0": disks, "RAID1": 1, "RAID10": disks // 2, "RAID5": disks - 1, "RAID6": disks - 2}[level]
+
+
+def generate_raid(directory, level="RAID5", disks=4, sectors=1 << 17, stripe_size=65536, layout="left-symmetric",
+                  bs=512, offset=0, zero_regions=(), missing=None, stitch=None, seed=0, zero_fraction=0.1,
+                  text_fraction=0.3, prefix="disk", write_size=8 << 20):
+    # Write a synthetic RAID member set to directory and return its description.
+    #
+    # Each member holds offset (an int, or one per disk) sectors of random metadata
+    # followed by sectors data sectors (rounded down to whole chunks) in md layout.
+    # The data chunks are random, text-like or zero, zero_regions are (start, count)
+    # ranges of data sectors which are zero on every member. The file of the missing
+    # member is not written. stitch=(disk, sector) simulates an interrupted rebuild:
+    # the member is only valid before the sector, an extra "rebuilt" image of it only
+    # from the sector on, random data stands in for the invalid part of both.
+    if level not in LEVELS:
+        raise ValueError(f"Unknown RAID level: {level}")
+    if level in ("RAID5", "RAID6") and layout not in RAID5_LAYOUTS:
+        raise ValueError(f"Unknown parity rotation: {layout}")
+    minimum = {"RAID0": 1, "RAID1": 2, "RAID10": 4, "RAID5": 3, "RAID6": 4}[level]
+    if disks < minimum or (level == "RAID10" and disks % 2):
+        raise ValueError(f"{level} needs at least {minimum} disks" + (" in pairs" if level == "RAID10" else ""))
+    if stitch is not None and stitch[0] == missing:
+        raise ValueError("The stitched member can not be missing")
+
+    chunk = stripe_size // bs
+    rows = sectors // chunk
+    offsets = list(offset) if isinstance(offset, (list, tuple)) else [offset for x in range(disks)]
+    rng = np.random.default_rng(seed)
+
+    os.makedirs(directory, exist_ok=True)
+    paths = [os.path.join(directory, f"{prefix}{i}.img") for i in range(disks)]
+    stitch_path = os.path.join(directory, f"{prefix}{stitch[0]}_rebuilt.img") if stitch is not None else None
+
+    handles = {}
+    try:
+        for i, path in enumerate(paths):
+            if i != missing:
+                handles[i] = open(path, "wb")
+        if stitch is not None:
+            handles["stitch"] = open(stitch_path, "wb")
+
+        # Metadata area in front of the data
+        for key, handle in handles.items():
+            count = offsets[stitch[0] if key == "stitch" else key]
+            handle.write(rng.integers(0, 256, count * bs, dtype=np.uint8).tobytes())
+
+        batch_rows = max(write_size // stripe_size, 1)
+        for first_row in range(0, rows, batch_rows):
+            count = min(batch_rows, rows - first_row)
+            data = data_chunks(rng, count, data_disks(level, disks), chunk, bs, zero_fraction, text_fraction)
+            out = stripe_rows(level, layout, disks, first_row, data).reshape(disks, count * chunk, bs)
+
+            first = first_row * chunk
+            for start, length in zero_regions:
+                a, b = max(start - first, 0), min(start + length - first, count * chunk)
+                if a < b:
+                    out[:, a:b] = 0
+
+            rebuilt = None
+            if stitch is not None:
+                disk, sector = stitch
+                split = min(max(sector - first, 0), count * chunk)
+                rebuilt = out[disk].copy()
+                rebuilt[:split] = rng.integers(0, 256, rebuilt[:split].shape, dtype=np.uint8)
+                out[disk, split:] = rng.integers(0, 256, out[disk, split:].shape, dtype=np.uint8)
+
+            for key, handle in handles.items():
+                handle.write((rebuilt if key == "stitch" else out[key]).tobytes())
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+    files = [path for i, path in enumerate(paths) if i != missing]
+    if stitch_path is not None:
+        files.append(stitch_path)
+
+    return {
+        "files": files,
+        "level": level,
+        "disks": disks,
+        "layout": layout if level in ("RAID5", "RAID6") else "",
+        "stripe_size": stripe_size,
+        "sector_size": bs,
+        "sectors": rows * chunk,
+        "offsets": offsets,
+        "zero_regions": [list(region) for region in zero_regions],
+        "missing": missing,
+        "stitch": list(stitch) if stitch is not None else None,
+        "seed": seed,
+    }
@@ -0,0 +1,216 @@
+import os
+import time
+import shutil
+import platform
+import tempfile
+
+import numpy as np
+
+from ..classify import batch_entropy, classify_sectors
+from ..engine import VERSION, RaidAnalysisEngine
+from ..mirrors import mirror_counts
+from ..parity import parity_matches
+from ..raid6 import q_matches, q_subsets
+from ..reader import MultiImageReader
+from ..signatures import scan_signatures
+from .synthetic import generate_raid
+
+
+# Benchmark scenarios, zero regions and the stitch point are given as fractions of
+# the data sectors and converted by scenario_kwargs()
+SCENARIOS = {
+    "raid0": {"level": "RAID0", "disks": 4},
+    "raid1": {"level": "RAID1", "disks": 2},
+    "raid5": {"level": "RAID5", "disks": 4, "layout": "left-symmetric"},
+    "raid6": {"level": "RAID6", "disks": 6, "layout": "left-symmetric"},
+    "raid10": {"level": "RAID10", "disks": 4},
+    "raid5-offset-zeros": {"level": "RAID5", "disks": 5, "layout": "right-asymmetric", "offset": 2048, "zero_regions": [(0.25, 0.25)]},
+    "raid5-missing": {"level": "RAID5", "disks": 5, "layout": "left-asymmetric", "missing": 2},
+    "raid5-stitched": {"level": "RAID5", "disks": 4, "layout": "left-symmetric", "stitch": (3, 0.4)},
+}
+
+# Stages timed on every batch, in pipeline order
+STAGES = ["read", "classify", "entropy", "mirrors", "parity", "raid6", "signatures"]
+
+
+def scenario_kwargs(name, sectors, stripe_size=65536, bs=512, seed=0):
+    # generate_raid() arguments of a scenario with sectors data sectors per member
+    kwargs = dict(SCENARIOS[name])
+    kwargs.update(sectors=sectors, stripe_size=stripe_size, bs=bs, seed=seed)
+    kwargs["zero_regions"] = [(int(start * sectors), int(count * sectors)) for start, count in kwargs.get("zero_regions", [])]
+    if "stitch" in kwargs:
+        disk, fraction = kwargs["stitch"]
+        kwargs["stitch"] = (disk, int(fraction * sectors))
+    return kwargs
+
+
+def rate(seconds, sectors, bs):
+    # Timing entry of a stage which processed the given number of sectors
+    return {
+        "seconds": seconds,
+        "sectors_per_second": sectors / seconds if seconds > 0 else 0.0,
+        "mib_per_second": sectors * bs / seconds / (1 << 20) if seconds > 0 else 0.0,
+    }
+
+
+def time_stages(files, bs=512, chunk_sectors=2048, use_mmap=False):
+    # Read all images batch by batch and time each processing stage on every batch
+    reader = MultiImageReader(files, bs=bs, batch_sectors=chunk_sectors, use_mmap=use_mmap)
+    subsets = q_subsets(len(files))
+    per_file = [
+        ("classify", classify_sectors),
+        ("entropy", batch_entropy),
+        ("signatures", scan_signatures),
+    ]
+    per_batch = [
+        ("mirrors", mirror_counts),
+        ("parity", parity_matches),
+        ("raid6", lambda batch: q_matches(batch, subsets) if subsets else None),
+    ]
+
+    seconds = {stage: 0.0 for stage in STAGES}
+    sector = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            batch = reader.read_batch(sector, chunk_sectors)
+            seconds["read"] += time.perf_counter() - start
+            if batch.shape[1] == 0:
+                break
+
+            for stage, function in per_file:
+                start = time.perf_counter()
+                for i in range(len(files)):
+                    function(batch[i])
+                seconds[stage] += time.perf_counter() - start
+
+            for stage, function in per_batch:
+                start = time.perf_counter()
+                function(batch)
+                seconds[stage] += time.perf_counter() - start
+
+            sector += batch.shape[1]
+    finally:
+        reader.close()
+
+    return {stage: rate(seconds[stage], sector * len(files), bs) for stage in STAGES}
+
+
+def time_engine(files, bs=512, processes=1, workdir=None, report=True):
+    # Time a full analysis with the engine and (optionally) writing its report.
+    # Returns (timings, results), the results allow checking a faster version
+    # still computes the same.
+    workdir = workdir or tempfile.gettempdir()
+    engine = RaidAnalysisEngine(files, bs=bs, parity_log_path=os.path.join(workdir, "parity_check.log"), processes=processes)
+
+    start, cpu = time.perf_counter(), time.process_time()
+    engine.run()
+    seconds = time.perf_counter() - start
+    sectors = engine.offset * len(files)
+
+    timings = {"engine": rate(seconds, sectors, bs)}
+    timings["engine"]["cpu_seconds"] = time.process_time() - cpu
+    timings["engine"]["processes"] = processes
+
+    if report:
+        start = time.perf_counter()
+        engine.write_report(os.path.join(workdir, "report.html"))
+        timings["report"] = rate(time.perf_counter() - start, sectors, bs)
+
+    results = {
+        "sectors": engine.offset,
+        "zero_blocks": [s['zero_blocks'] for s in engine.stats],
+        "pattern_blocks": [s['pattern_blocks'] for s in engine.stats],
+        "entropy": [s['entropy'] / max(engine.offset, 1) for s in engine.stats],
+        "mirrors": engine.mirrors,
+        "parity": engine.parity,
+        "q_parity": engine.q_parity,
+    }
+    return timings, results
+
+
+def run_benchmark(scenarios=None, sectors=1 << 17, stripe_size=65536, bs=512, processes=1, repeat=1, workdir=None, keep=False, progress=None):
+    # Generate each scenario in a temporary directory and time all stages, the
+    # best of repeat runs counts. Returns a JSON serializable dict.
+    scenarios = list(scenarios or SCENARIOS)
+    base = tempfile.mkdtemp(prefix="raidalyzer_bench_", dir=workdir)
+    result = {
+        "version": VERSION,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "sectors": sectors,
+        "stripe_size": stripe_size,
+        "sector_size": bs,
+        "processes": processes,
+        "repeat": repeat,
+        "scenarios": {},
+    }
+
+    try:
+        for name in scenarios:
+            directory = os.path.join(base, name)
+            if progress is not None:
+                progress(f"{name}: generating images")
+            start = time.perf_counter()
+            description = generate_raid(directory, **scenario_kwargs(name, sectors, stripe_size, bs))
+            generate_seconds = time.perf_counter() - start
+
+            timings = {}
+            for run in range(repeat):
+                if progress is not None:
+                    progress(f"{name}: run {run + 1} of {repeat}")
+                stages = time_stages(description["files"], bs=bs)
+                engine, results = time_engine(description["files"], bs=bs, processes=processes, workdir=directory)
+                stages.update(engine)
+
+                for stage, timing in stages.items():
+                    if stage not in timings or timing["seconds"] < timings[stage]["seconds"]:
+                        timings[stage] = timing
+
+            description["files"] = [os.path.basename(file) for file in description["files"]]
+            result["scenarios"][name] = {
+                "set": description,
+                "generate_seconds": generate_seconds,
+                "stages": timings,
+                "results": results,
+            }
+
+            if not keep:
+                shutil.rmtree(directory, ignore_errors=True)
+    finally:
+        if keep:
+            result["directory"] = base
+        else:
+            shutil.rmtree(base, ignore_errors=True)
+
+    return result
+
+
+def format_benchmark(result, baseline=None):
+    # Throughput table of all scenarios and stages, with the speedup over a baseline
+    # result (e.g. of the previous version) if given
+    text = f"RaidAlyzer v{result['version']}, Python {result['python']}, numpy {result['numpy']}, {result['cpu_count']} CPUs\n\n"
+    text += f"{'SCENARIO':<20}  {'STAGE':<10}  {'MIB/S':>10}  {'SECONDS':>9}"
+    text += f"  {'BASELINE':>10}  {'SPEEDUP':>7}  RESULTS\n" if baseline else "\n"
+
+    for name, scenario in result["scenarios"].items():
+        base_scenario = baseline["scenarios"].get(name) if baseline else None
+        for stage, timing in scenario["stages"].items():
+            text += f"{name:<20}  {stage:<10}  {timing['mib_per_second']:>10.1f}  {timing['seconds']:>9.3f}"
+            if baseline:
+                base_timing = base_scenario["stages"].get(stage) if base_scenario else None
+                if base_timing and base_timing["mib_per_second"] > 0:
+                    speedup = timing["mib_per_second"] / base_timing["mib_per_second"]
+                    text += f"  {base_timing['mib_per_second']:>10.1f}  {speedup:>6.2f}x"
+                else:
+                    text += f"  {'-':>10}  {'-':>7}"
+                if stage == "engine" and base_scenario is not None:
+                    # Results are only comparable on the same generated set
+                    if base_scenario["set"] != scenario["set"]:
+                        text += "  other set"
+                    else:
+                        text += "  same" if base_scenario["results"] == scenario["results"] else "  DIFFERENT"
+            text += "\n"
+    return text
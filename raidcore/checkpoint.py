@@ -0,0 +1,108 @@
+import os
+import json
+import time
+
+import numpy as np
+
+from .heatmap import load_heatmap
+from .paritylog import load_parity_runs
+from .pyramid import load_pyramid
+from .reader import image_size
+from .signatures import HIT_DTYPE
+
+
+# A checkpoint holds the mergeable state of the analyzed range from the start
+# sector on (see RaidAnalysisEngine.partial_result()) as JSON, plus what it is only
+# valid for: the images with their size and mtime, and the analysis settings.
+# Version 2 holds the parity check log runs instead of the length of the text log,
+# version 3 the counts of unreadable sectors and stripes, version 4 the entropy pyramid,
+# version 5 the region heatmap.
+CHECKPOINT_FORMAT = "raidalyzer-checkpoint"
+CHECKPOINT_VERSION = 5
+
+# Settings which change the results, a checkpoint only resumes with the same
+SETTINGS = ["engine", "files", "sizes", "mtimes", "sector_size", "start_sector", "disk_offsets",
+            "analysis_block_size", "check_q", "signatures"]
+
+
+def checkpoint_settings(engine):
+    files = [os.path.abspath(file) for file in engine.files]
+    stats = [os.stat(file) for file in files]
+    return {
+        "engine": type(engine).__name__,
+        "files": files,
+        "sizes": [image_size(file) for file in files],
+        "mtimes": [s.st_mtime_ns for s in stats],
+        "sector_size": engine.bs,
+        "start_sector": engine.analysis_start_sector,
+        "disk_offsets": engine.disk_offsets or [0 for x in files],
+        "analysis_block_size": engine.analysis_block_size,
+        "check_q": engine.checking_q(),
+        "signatures": list(engine.signatures),
+    }
+
+
+def encode_state(result):
+    # JSON form of a partial result, the entropy sums stay exact integers
+    state = {key: value for key, value in result.items() if key != "timers"}
+    state["signature_hits"] = [hits.tolist() for hits in result["signature_hits"]]
+    state["parity_runs"] = result["parity_runs"].to_state()
+    state["pyramid"] = result["pyramid"].to_state() if result["pyramid"] is not None else None
+    state["heatmap"] = result["heatmap"].to_state() if result["heatmap"] is not None else None
+    return state
+
+
+def decode_state(state):
+    result = dict(state)
+    result["signature_hits"] = [np.array([tuple(hit) for hit in hits], dtype=HIT_DTYPE) for hits in state["signature_hits"]]
+    result["parity_runs"] = load_parity_runs(state["parity_runs"])
+    result["pyramid"] = load_pyramid(state["pyramid"]) if state["pyramid"] is not None else None
+    result["heatmap"] = load_heatmap(state["heatmap"]) if state["heatmap"] is not None else None
+    for key in ("bootsector_hit", "efi_part_hit"):
+        if result[key] is not None:
+            result[key] = tuple(result[key])
+    return result
+
+
+def write_checkpoint(path, engine, result):
+    # Write atomically: the old checkpoint stays valid until the new one replaces it
+    checkpoint = {
+        "format": CHECKPOINT_FORMAT,
+        "version": CHECKPOINT_VERSION,
+        "raidalyzer": engine.version,
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "settings": checkpoint_settings(engine),
+        "state": encode_state(result),
+    }
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    with open(path, "r") as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("format") != CHECKPOINT_FORMAT or checkpoint.get("version") != CHECKPOINT_VERSION:
+        raise ValueError(f"{path} is no RaidAlyzer checkpoint of version {CHECKPOINT_VERSION}")
+    checkpoint["state"] = decode_state(checkpoint["state"])
+    return checkpoint
+
+
+def check_checkpoint(checkpoint, engine):
+    # Raise ValueError if the checkpoint was written for other images or settings
+    settings = checkpoint_settings(engine)
+    settings["start_sector"] = checkpoint["settings"]["start_sector"]
+    for key in SETTINGS:
+        if checkpoint["settings"][key] != settings[key]:
+            raise ValueError(f"The checkpoint doesn't match the analysis: {key} differs")
+
+
+def format_checkpoint(checkpoint):
+    settings, state = checkpoint["settings"], checkpoint["state"]
+    status = "complete" if state["reached_end"] else "unfinished"
+    return (f"{status.capitalize()} analysis of {len(settings['files'])} images from sector {settings['start_sector']}, "
+            f"{state['offset']} sectors analyzed, saved {checkpoint['time']}")
@@ -0,0 +1,111 @@
+import math
+
+import numpy as np
+
+
+_entropy_terms = {}
+
+
+def entropy_terms(bs):
+    # Table of p * log2(p) for every possible byte count in a sector, computed
+    # exactly like calc_entropy() so batch results are bit-identical
+    terms = _entropy_terms.get(bs)
+    if terms is None:
+        terms = np.zeros(bs + 1, dtype=np.float64)
+        for count in range(1, bs + 1):
+            p = count / bs
+            terms[count] = p * math.log2(p)
+        _entropy_terms[bs] = terms
+    return terms
+
+
+def byte_histograms(sectors):
+    # Count byte values per sector, returns an array of shape (sectors, 256)
+    n, bs = sectors.shape
+    index = sectors.astype(np.intp) + (np.arange(n, dtype=np.intp) * 256)[:, None]
+    return np.bincount(index.ravel(), minlength=n * 256).reshape(n, 256)
+
+
+def batch_entropy(sectors):
+    # Shannon entropy of each sector of a (sectors, bs) uint8 array
+    n, bs = sectors.shape
+    terms = entropy_terms(bs)
+    counts = byte_histograms(sectors)
+
+    # Subtract the terms in byte value order, same as the scalar loop
+    entropy = np.zeros(n, dtype=np.float64)
+    for value in range(256):
+        entropy -= terms[counts[:, value]]
+    return entropy
+
+
+def classify_sectors(sectors):
+    # Classify a (sectors, bs) uint8 array, returns (zero_mask, pattern_mask, entropy)
+    # where entropy is 0.0 for zero and pattern sectors
+    zero = ~sectors.any(axis=1)
+    pattern = (sectors == sectors[:, :1]).all(axis=1) & ~zero
+    data = ~(zero | pattern)
+
+    entropy = np.zeros(sectors.shape[0], dtype=np.float64)
+    if data.any():
+        entropy[data] = batch_entropy(sectors[data])
+
+    return zero, pattern, entropy
+
+
+def accumulate(total, values):
+    # Add values to total one after another (no pairwise summation) so the
+    # result matches a sequential Python loop bit for bit
+    if len(values) == 0:
+        return total
+    return float(np.add.accumulate(np.concatenate(([total], values)))[-1])
+
+
+# For merging the partial results of different sector ranges the entropy sums are
+# also kept as integers in units of 2**-ENTROPY_UNIT_BITS. Every float64 entropy of
+# a sector is an exact multiple of that unit, so these sums are exact and do not
+# depend on the order of addition.
+ENTROPY_UNIT_BITS = 80
+
+
+def exact_sum(values):
+    # Exact sum of non-negative float64 values in entropy units
+    values = np.asarray(values, dtype=np.float64)
+    values = values[values > 0]
+    if len(values) == 0:
+        return 0
+
+    mantissa, exponent = np.frexp(values)
+    mantissa = np.ldexp(mantissa, 53).astype(np.int64)  # value = mantissa * 2**(exponent - 53)
+    exponent = exponent - 53 + ENTROPY_UNIT_BITS
+
+    total = 0
+    for shift in np.unique(exponent).tolist():
+        group = mantissa[exponent == shift]
+
+        # Split in 26 bit halves so the int64 sums can not overflow
+        high = int(np.sum(group >> 26))
+        low = int(np.sum(group & 0x3FFFFFF))
+        group_sum = (high << 26) + low
+
+        total += group_sum << shift if shift >= 0 else group_sum >> -shift
+    return total
+
+
+def entropy_value(total):
+    # Correctly rounded float of an exact entropy sum
+    return total / (1 << ENTROPY_UNIT_BITS)
+
+
+def calc_entropy(data):
+    if not data:
+        return 0.0
+    freq = [0] * 256
+    for b in data:
+        freq[b] += 1
+    entropy = 0.0
+    for count in freq:
+        if count:
+            p = count / len(data)
+            entropy -= p * math.log2(p)
+    return entropy
@@ -0,0 +1,443 @@
+import os
+import sys
+import json
+import time
+import argparse
+
+from .assemble import ASSEMBLE_LEVELS, ArrayAssembler, write_volume
+from .bench import SCENARIOS, format_benchmark, run_benchmark
+from .checkpoint import CHECKPOINT_FORMAT, check_checkpoint, format_checkpoint, load_checkpoint
+from .engine import VERSION, RaidAnalysisEngine
+from .export import ImageExporter, format_export, format_plan, rebuild_plan, stitch_plan
+from .index import build_index, load_index
+from .indexed import IndexedAnalysisEngine, indexes_available
+from .layout import RAID5_LAYOUTS, detect_layout, format_layouts, layout_signals
+from .offsets import detect_offsets, format_offsets
+from .paritylog import parity_runs_from_dict, read_parity_log
+from .reader import PREFETCH_BUFFER_SIZE, PREFETCH_DEPTH, READ_RETRIES, SKIP_SECTORS
+from .sampling import SamplingAnalysisEngine
+from .signatures import SIGNATURE_NAMES
+
+
+def disk_offsets(text, images):
+    # Comma separated start offsets in sectors, one per image
+    if text is None:
+        return None
+    offsets = [int(value) for value in text.split(",")]
+    if len(offsets) != len(images) or min(offsets) < 0:
+        raise SystemExit(f"--disk-offsets needs {len(images)} non-negative values, one per image")
+    return offsets
+
+
+def signature_names(text):
+    # Comma separated signature names, all if not given
+    if text is None:
+        return list(SIGNATURE_NAMES)
+    names = [name.strip() for name in text.split(",")]
+    unknown = [name for name in names if name not in SIGNATURE_NAMES]
+    if unknown:
+        raise SystemExit(f"Unknown signature {unknown[0]}, choose from: {', '.join(SIGNATURE_NAMES)}")
+    return names
+
+
+def print_progress(event, engine):
+    if event == "progress":
+        print(engine.status_text(), file=sys.stderr, flush=True)
+
+
+def analyze(args):
+    indexed = not args.sample and not args.no_index and indexes_available(args.images, args.sector_size)
+    if args.processes is not None and args.processes > 1:
+        if args.sample:
+            raise SystemExit("--processes can't be used with --sample, samples are analyzed in one process")
+        if indexed:
+            raise SystemExit("--processes can't be used with the sector indexes, add --no-index to read the images with several processes")
+
+    if args.sample:
+        engine = SamplingAnalysisEngine(
+            args.images,
+            bs=args.sector_size,
+            precision=args.precision,
+            confidence=args.confidence,
+            strategy=args.strategy,
+            seed=args.seed,
+            max_seconds=args.max_seconds,
+        )
+    elif indexed:
+        engine = IndexedAnalysisEngine(
+            args.images,
+            bs=args.sector_size,
+            analysis_block_size=args.block_size,
+            parity_log_path=args.parity_log,
+            verify_parity=args.verify_parity,
+        )
+    else:
+        engine = RaidAnalysisEngine(
+            args.images,
+            bs=args.sector_size,
+            analysis_block_size=args.block_size,
+            parity_log_path=args.parity_log,
+            processes=args.processes or os.cpu_count() or 1,
+        )
+
+    engine.disk_offsets = disk_offsets(args.disk_offsets, args.images)
+    engine.signatures = signature_names(args.signatures)
+    engine.direct_io = {"auto": None, "on": True, "off": False}[args.direct_io]
+    engine.read_retries = args.retries
+    engine.skip_sectors = args.skip_sectors
+    if args.prefetch_depth is not None:
+        engine.prefetch_depth = args.prefetch_depth
+    engine.prefetch_buffer_size = args.prefetch_buffer << 20
+    if not args.quiet:
+        engine.subscribe(print_progress)
+
+    if args.profile:
+        engine.profile_path = args.profile
+
+    if args.resume and not args.checkpoint:
+        raise SystemExit("--resume needs the --checkpoint FILE to resume from")
+    if args.checkpoint:
+        if args.sample:
+            raise SystemExit("Checkpoints need a full analysis, samples can't be resumed")
+        engine.checkpoint_path = args.checkpoint
+        engine.checkpoint_interval = args.checkpoint_interval
+
+    if args.resume and os.path.exists(args.checkpoint):
+        checkpoint = engine.resume_from(args.checkpoint)
+        try:
+            check_checkpoint(checkpoint, engine)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        print(f"Resuming: {format_checkpoint(checkpoint)}", file=sys.stderr)
+    elif args.resume:
+        print(f"No checkpoint {args.checkpoint} yet, starting from the beginning.", file=sys.stderr)
+
+    try:
+        engine.run(offset=args.start_sector)
+    except KeyboardInterrupt:
+        engine.stop()
+        print("Analysis interrupted, writing partial results.", file=sys.stderr)
+        if args.checkpoint:
+            print(f"Continue from the last checkpoint with: --checkpoint {args.checkpoint} --resume", file=sys.stderr)
+
+    print(engine.format_stats())
+    print(engine.format_signatures())
+    print(engine.format_mirrors())
+    print(engine.format_parity())
+    if args.timers:
+        print(engine.timers.format())
+
+    if args.trace:
+        engine.timers.write_trace(args.trace)
+    if args.profile:
+        print(f"Profile written to {args.profile}, view it with: python -m pstats {args.profile}", file=sys.stderr)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(engine.to_dict(), f, indent=2)
+
+    if args.report:
+        engine.write_report(args.report)
+
+    return 0
+
+
+def index(args):
+    for image in args.images:
+        existing = load_index(image, args.sector_size)
+        if existing is not None and not args.force:
+            existing.close()
+            print(f"{image}: index is up to date ({existing.path})", file=sys.stderr)
+            continue
+
+        def progress(sector, sectors):
+            if not args.quiet:
+                print(f"{image}: {sector} / {sectors} sectors indexed", file=sys.stderr, flush=True)
+
+        try:
+            path = build_index(image, bs=args.sector_size, progress=progress)
+        except KeyboardInterrupt:
+            print("Indexing interrupted.", file=sys.stderr)
+            return 1
+        print(f"{image}: index written to {path}", file=sys.stderr)
+
+    return 0
+
+
+def layout(args):
+    if not args.quiet:
+        print(f"Reading {args.sectors} sectors from sector {args.start_sector}...", file=sys.stderr, flush=True)
+    offsets = disk_offsets(args.disk_offsets, args.images)
+    entropy, parity = layout_signals(args.images, bs=args.sector_size, start_sector=args.start_sector, sectors=args.sectors, offsets=offsets)
+    hypotheses = detect_layout(entropy, parity, bs=args.sector_size, top=args.top)
+
+    print(format_layouts(hypotheses, [os.path.basename(image) for image in args.images]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(hypotheses, f, indent=2)
+
+    return 0
+
+
+def offsets(args):
+    if not args.quiet:
+        print(f"Correlating the images over +/- {args.window} sectors...", file=sys.stderr, flush=True)
+    result = detect_offsets(args.images, bs=args.sector_size, window=args.window, sectors=args.sectors)
+
+    print(format_offsets(result, [os.path.basename(image) for image in args.images]))
+    print("--disk-offsets " + ",".join(str(offset) for offset in result["offsets"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    return 0
+
+
+def load_runs(path):
+    # Parity check log of a checkpoint, an analyze --json result or the text of
+    # analyze --parity-log, with the start sector and offsets if they are known
+    with open(path, "r") as f:
+        if f.read(1) != "{":
+            return read_parity_log(path), None, None
+        f.seek(0)
+        data = json.load(f)
+
+    if data.get("format") == CHECKPOINT_FORMAT:
+        checkpoint = load_checkpoint(path)
+        settings = checkpoint["settings"]
+        return checkpoint["state"]["parity_runs"], settings["start_sector"], settings["disk_offsets"]
+    if data.get("parity_check_log"):
+        return parity_runs_from_dict(data["parity_check_log"]), data["start_sector"], data["disk_offsets"]
+    raise SystemExit(f"{path} holds no parity check log")
+
+
+def export(args):
+    if not args.output and not args.dry_run:
+        raise SystemExit("export needs the --output FILE to write")
+    filenames = [os.path.basename(image) for image in args.images]
+    start_sector, offsets = args.start_sector, disk_offsets(args.disk_offsets, args.images)
+
+    if args.stitch:
+        if not args.runs:
+            raise SystemExit("--stitch needs the parity check log, see --runs")
+        candidates = []
+        for name in args.stitch.split(","):
+            name = os.path.basename(name.strip())
+            if name not in filenames:
+                raise SystemExit(f"{name} is not one of the images")
+            candidates.append(filenames.index(name))
+
+        try:
+            runs, saved_start, saved_offsets = load_runs(args.runs)
+            if start_sector is None and saved_start is not None:
+                start_sector = saved_start
+            if offsets is None and saved_offsets is not None and len(saved_offsets) == len(args.images):
+                offsets = saved_offsets
+            plan = stitch_plan(runs, filenames, candidates)
+        except ValueError as e:
+            raise SystemExit(str(e))
+    else:
+        plan = rebuild_plan(range(len(args.images)))
+
+    start_sector = start_sector or 0
+    print(format_plan(plan, filenames, start_sector), file=sys.stderr if not args.dry_run else sys.stdout)
+    if args.dry_run:
+        return 0
+
+    shown = [-1]
+    def progress(sector, sectors):
+        # At most one line per percent
+        percent = sector * 100 // max(sectors, 1)
+        if not args.quiet and percent != shown[0]:
+            shown[0] = percent
+            print(f"{args.output}: {sector} / {sectors} sectors written", file=sys.stderr, flush=True)
+
+    exporter = ImageExporter(args.images, bs=args.sector_size, start_sector=start_sector, offsets=offsets,
+                             buffer_size=args.buffer_size << 20, threads=args.threads)
+    summary = exporter.export(args.output, plan, progress=progress)
+    print(format_export(summary))
+    return 0
+
+
+def assemble(args):
+    # "missing" stands for a member without image
+    files = [None if image == "missing" else image for image in args.images]
+    offsets = disk_offsets(args.disk_offsets, args.images)
+
+    try:
+        assembler = ArrayAssembler(files, level=args.level, stripe_size=args.stripe_size, layout=args.layout, bs=args.sector_size,
+                                   start_sector=args.start_sector, offsets=offsets, batch_size=args.batch_size << 20)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    shown = [-1]
+    def progress(sector, sectors):
+        percent = sector * 100 // max(sectors, 1)
+        if not args.quiet and percent != shown[0]:
+            shown[0] = percent
+            print(f"{args.output}: {sector} / {sectors} sectors written", file=sys.stderr, flush=True)
+
+    try:
+        start = time.perf_counter()
+        sectors = write_volume(assembler, args.output, progress=progress)
+        seconds = time.perf_counter() - start
+    finally:
+        assembler.close()
+
+    print(f"{args.output}: {sectors} sectors ({sectors * args.sector_size / (1 << 30):.2f} GiB) of the {args.level} volume, "
+          f"{seconds:.1f} s, {sectors * args.sector_size / max(seconds, 1e-9) / (1 << 20):.1f} MiB/s")
+    return 0
+
+
+def bench(args):
+    def progress(message):
+        if not args.quiet:
+            print(message, file=sys.stderr, flush=True)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    scenarios = args.scenarios.split(",") if args.scenarios else None
+    unknown = [name for name in scenarios or [] if name not in SCENARIOS]
+    if unknown:
+        raise SystemExit(f"Unknown scenario {unknown[0]}, choose from: {', '.join(SCENARIOS)}")
+
+    result = run_benchmark(
+        scenarios,
+        sectors=args.size * (1 << 20) // args.sector_size,
+        stripe_size=args.stripe_size,
+        bs=args.sector_size,
+        processes=args.processes,
+        repeat=args.repeat,
+        workdir=args.workdir,
+        keep=args.keep,
+        progress=progress,
+    )
+
+    print(format_benchmark(result, baseline))
+    if args.keep:
+        print(f"Images kept in {result['directory']}", file=sys.stderr)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="raidalyzer", description="Analyze RAID member images without the GUI.")
+    parser.add_argument("--version", action="version", version=f"RaidAlyzer v{VERSION}")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("analyze", help="run a full analysis of the given images")
+    p.add_argument("images", nargs="+", help="disk image files in array order")
+    p.add_argument("--start-sector", type=int, default=0, help="start offset in sectors (default: 0)")
+    p.add_argument("--sector-size", type=int, default=512, help="sector size in bytes (default: 512)")
+    p.add_argument("--block-size", type=int, default=10000, help="sectors analyzed between progress updates (default: 10000)")
+    p.add_argument("--processes", type=int, help="worker processes, each analyzes its own shard of the sector range (default: number of CPUs)")
+    p.add_argument("--json", metavar="FILE", help="write the results as JSON to FILE")
+    p.add_argument("--report", metavar="FILE", help="write the HTML report to FILE")
+    p.add_argument("--parity-log", metavar="FILE", default="parity_check.log", help="write the complete parity check log as text to FILE (default: parity_check.log)")
+    p.add_argument("--sample", action="store_true", help="estimate the results from sampled stripes with confidence intervals")
+    p.add_argument("--precision", type=float, default=1.0, help="sampling: stop when all intervals are within +/- this many percent (default: 1.0)")
+    p.add_argument("--confidence", type=float, default=0.95, help="sampling: confidence level of the intervals (default: 0.95)")
+    p.add_argument("--strategy", choices=["stratified", "random"], default="stratified", help="sampling: how stripes are chosen (default: stratified)")
+    p.add_argument("--max-seconds", type=float, help="sampling: stop after this many seconds")
+    p.add_argument("--seed", type=int, help="sampling: random seed for reproducible runs")
+    p.add_argument("--no-index", action="store_true", help="read the images even if all have an up to date sector index")
+    p.add_argument("--verify-parity", action="store_true", help="index: confirm parity matches by reading the candidate stripes")
+    p.add_argument("--disk-offsets", metavar="N,N,...", help="extra start offset in sectors of each image, see the offsets command")
+    p.add_argument("--direct-io", choices=["auto", "on", "off"], default="auto", help="read with O_DIRECT, bypassing the page cache (default: auto, for block devices)")
+    p.add_argument("--retries", type=int, default=READ_RETRIES, help=f"attempts to repeat a failing read before its sectors are skipped (default: {READ_RETRIES})")
+    p.add_argument("--skip-sectors", type=int, default=SKIP_SECTORS, help=f"sectors skipped as unknown at once after a read failed (default: {SKIP_SECTORS})")
+    p.add_argument("--prefetch-depth", type=int, metavar="N", help=f"buffers each image is read ahead into by its own thread, 0 to read the images in turn (default: {PREFETCH_DEPTH}, 0 with --sample)")
+    p.add_argument("--prefetch-buffer", type=int, default=PREFETCH_BUFFER_SIZE >> 20, metavar="MIB", help=f"size of each read ahead buffer in MiB (default: {PREFETCH_BUFFER_SIZE >> 20})")
+    p.add_argument("--timers", action="store_true", help="print wall/CPU time and throughput of each analysis stage")
+    p.add_argument("--trace", metavar="FILE", help="write the stage timers after every analysis block to FILE (.csv or .json)")
+    p.add_argument("--profile", metavar="FILE", help="run the analysis under cProfile and write the profile to FILE")
+    p.add_argument("--signatures", metavar="NAME,...", help=f"signatures to record (default: all of {','.join(SIGNATURE_NAMES)})")
+    p.add_argument("--checkpoint", metavar="FILE", help="save the analysis state to FILE periodically and when it stops")
+    p.add_argument("--checkpoint-interval", type=float, default=60.0, help="seconds between checkpoints (default: 60)")
+    p.add_argument("--resume", action="store_true", help="continue from the --checkpoint FILE if it exists, with the start sector saved there")
+    p.add_argument("-q", "--quiet", action="store_true", help="do not print progress to stderr")
+    p.set_defaults(func=analyze)
+
+    p = subparsers.add_parser("layout", help="rank stripe size, parity rotation and disk order hypotheses")
+    p.add_argument("images", nargs="+", help="disk image files in any order")
+    p.add_argument("--start-sector", type=int, default=0, help="first sector of the array data (default: 0)")
+    p.add_argument("--sectors", type=int, default=1 << 21, help="sectors per image to evaluate (default: 2097152)")
+    p.add_argument("--sector-size", type=int, default=512, help="sector size in bytes (default: 512)")
+    p.add_argument("--top", type=int, default=10, help="number of hypotheses to show (default: 10)")
+    p.add_argument("--disk-offsets", metavar="N,N,...", help="extra start offset in sectors of each image, see the offsets command")
+    p.add_argument("--json", metavar="FILE", help="write the ranked hypotheses as JSON to FILE")
+    p.add_argument("-q", "--quiet", action="store_true", help="do not print progress to stderr")
+    p.set_defaults(func=layout)
+
+    p = subparsers.add_parser("offsets", help="detect a different start offset of each image by correlating their contents")
+    p.add_argument("images", nargs="+", help="disk image files in array order")
+    p.add_argument("--window", type=int, default=1 << 18, help="largest offset in sectors to consider, in either direction (default: 262144)")
+    p.add_argument("--sectors", type=int, help="sectors per image to correlate (default: 4 times the window)")
+    p.add_argument("--sector-size", type=int, default=512, help="sector size in bytes (default: 512)")
+    p.add_argument("--json", metavar="FILE", help="write the offsets as JSON to FILE")
+    p.add_argument("-q", "--quiet", action="store_true", help="do not print progress to stderr")
+    p.set_defaults(func=offsets)
+
+    p = subparsers.add_parser("index", help="build the sector index of the given images for fast re-analysis")
+    p.add_argument("images", nargs="+", help="disk image files")
+    p.add_argument("--sector-size", type=int, default=512, help="sector size in bytes (default: 512)")
+    p.add_argument("--force", action="store_true", help="rebuild even if the index is up to date")
+    p.add_argument("-q", "--quiet", action="store_true", help="do not print progress to stderr")
+    p.set_defaults(func=index)
+
+    p = subparsers.add_parser("export", help="write a stitched member image from the parity check log, or rebuild a missing one by XOR")
+    p.add_argument("images", nargs="+", help="disk image files in array order, as analyzed")
+    p.add_argument("-o", "--output", metavar="FILE", help="image file (or device) to write")
+    p.add_argument("--stitch", metavar="NAME,NAME", help="two images of the same member, each valid in other ranges; without it the output is the XOR of all images")
+    p.add_argument("--runs", metavar="FILE", help="parity check log: a checkpoint, an analyze --json result or the analyze --parity-log text")
+    p.add_argument("--start-sector", type=int, help="analysis start sector of the log (default: from the log file, else 0)")
+    p.add_argument("--disk-offsets", metavar="N,N,...", help="extra start offset in sectors of each image (default: from the log file, else 0)")
+    p.add_argument("--sector-size", type=int, default=512, help="sector size in bytes (default: 512)")
+    p.add_argument("--buffer-size", type=int, default=16, help="MiB read and written at once by each thread (default: 16)")
+    p.add_argument("--threads", type=int, help="copy and XOR threads (default: number of CPUs, up to 8)")
+    p.add_argument("--dry-run", action="store_true", help="only print which image each sector range comes from")
+    p.add_argument("-q", "--quiet", action="store_true", help="do not print progress to stderr")
+    p.set_defaults(func=export)
+
+    p = subparsers.add_parser("assemble", help="reassemble the RAID volume as one flat image")
+    p.add_argument("images", nargs="+", help="disk image files in array order, \"missing\" for a member without image")
+    p.add_argument("-o", "--output", metavar="FILE", required=True, help="volume image file (or device) to write")
+    p.add_argument("--level", choices=list(ASSEMBLE_LEVELS), default="RAID5", help="RAID level (default: RAID5)")
+    p.add_argument("--stripe-size", type=int, default=65536, help="stripe (chunk) size in bytes (default: 65536)")
+    p.add_argument("--layout", choices=RAID5_LAYOUTS, default="left-symmetric", help="RAID5/6 parity rotation (default: left-symmetric)")
+    p.add_argument("--start-sector", type=int, default=0, help="first sector of the array data (default: 0)")
+    p.add_argument("--disk-offsets", metavar="N,N,...", help="extra start offset in sectors of each image, see the offsets command")
+    p.add_argument("--sector-size", type=int, default=512, help="sector size in bytes (default: 512)")
+    p.add_argument("--batch-size", type=int, default=32, help="MiB of volume data read at once (default: 32)")
+    p.add_argument("-q", "--quiet", action="store_true", help="do not print progress to stderr")
+    p.set_defaults(func=assemble)
+
+    p = subparsers.add_parser("bench", help="time the analysis stages on generated RAID image sets")
+    p.add_argument("--scenarios", metavar="NAME,...", help=f"scenarios to run (default: all of {','.join(SCENARIOS)})")
+    p.add_argument("--size", type=int, default=64, help="data size per member in MiB (default: 64)")
+    p.add_argument("--stripe-size", type=int, default=65536, help="stripe (chunk) size in bytes (default: 65536)")
+    p.add_argument("--sector-size", type=int, default=512, help="sector size in bytes (default: 512)")
+    p.add_argument("--processes", type=int, default=1, help="worker processes of the engine run (default: 1)")
+    p.add_argument("--repeat", type=int, default=1, help="runs per scenario, the fastest counts (default: 1)")
+    p.add_argument("--workdir", metavar="DIR", help="directory for the generated images (default: system temp dir)")
+    p.add_argument("--keep", action="store_true", help="keep the generated images")
+    p.add_argument("--json", metavar="FILE", help="write the timings as JSON to FILE")
+    p.add_argument("--compare", metavar="FILE", help="show the speedup over the timings in FILE, e.g. of an older version")
+    p.add_argument("-q", "--quiet", action="store_true", help="do not print progress to stderr")
+    p.set_defaults(func=bench)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
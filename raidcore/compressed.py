@@ -0,0 +1,624 @@
+import os
+import bz2
+import lzma
+import zlib
+import struct
+import hashlib
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# Images compressed with gzip, xz or bzip2 are read without unpacking them. The
+# first use builds a chunk index of access points, places where decompression can
+# start without the state of the decompressor, at least SPAN_SIZE bytes of
+# uncompressed data apart. The data from one point to the next is a span. The
+# index is stored next to the image ("disk.img.gz.rdxzidx") or in the user cache
+# directory like the sector index and only used while size and mtime match.
+#
+# The access points are those the formats offer: gzip members (bgzip or
+# concatenated files have many, a plain .gz has one), xz blocks (many with
+# xz -T, read from the index at the end of each stream without decompressing)
+# and bzip2 blocks, which start at any bit. They are found by their magic number
+# and shifted into a stream of their own to decompress them.
+COMPRESSED_FORMATS = {".gz": "gzip", ".xz": "xz", ".bz2": "bzip2"}
+FORMAT_MAGICS = {"gzip": b"\x1f\x8b", "xz": b"\xfd7zXZ\x00", "bzip2": b"BZh"}
+
+CHUNK_INDEX_SUFFIX = ".rdxzidx"
+CHUNK_INDEX_MAGIC = b"RDXZIX\x00\x01"
+CHUNK_INDEX_HEADER = struct.Struct("<8s8sQqQQ")  # magic, format, compressed size, mtime (ns), size, access points
+CHUNK_INDEX_HEADER_SIZE = 64
+
+# Uncompressed offset, bit position of the span in the compressed file, bit
+# position of its end and (xz) the offset of the stream header
+POINT_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('position', '<u8'),
+    ('end', '<u8'),
+    ('stream', '<u8'),
+])
+
+SPAN_SIZE = 8 << 20         # Minimum uncompressed data between access points
+PIECE_SIZE = 8 << 20        # Longer spans are decoded and cached in pieces of this size
+INPUT_SIZE = 1 << 20        # Compressed data read at once
+SCAN_SIZE = 16 << 20        # Compressed data searched for bzip2 magic numbers at once
+
+DECOMPRESS_THREADS = min(os.cpu_count() or 1, 4)
+
+BZIP2_BLOCK_MAGIC = 0x314159265359
+BZIP2_END_MAGIC = 0x177245385090
+
+DECODE_ERRORS = (zlib.error, lzma.LZMAError, OSError, EOFError, ValueError)
+
+
+def sidecar_paths(image, suffix):
+    # Candidate locations of a file kept for an image, next to it first, then in
+    # the user cache directory
+    image = os.path.abspath(image)
+    cache = os.environ.get("LOCALAPPDATA") or os.path.join(os.path.expanduser("~"), ".cache")
+    name = hashlib.sha1(image.encode("utf-8", "surrogateescape")).hexdigest() + suffix
+    return [image + suffix, os.path.join(cache, "raidalyzer", name)]
+
+
+def compressed_format(path):
+    # "gzip", "xz" or "bzip2" for an image with the suffix and magic bytes of the
+    # format, None for an uncompressed image
+    fmt = COMPRESSED_FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            head = f.read(len(FORMAT_MAGICS[fmt]))
+    except OSError:
+        return None
+    return fmt if head == FORMAT_MAGICS[fmt] else None
+
+
+class CompressedFile:
+    # Positional reads of the compressed file, shared by the decoding threads
+    def __init__(self, path):
+        self.handle = open(path, "rb")
+        self.size = os.fstat(self.handle.fileno()).st_size
+        self.lock = threading.Lock()
+
+
+    def read(self, position, length):
+        with self.lock:
+            self.handle.seek(position)
+            return self.handle.read(length)
+
+
+    def close(self):
+        self.handle.close()
+
+
+class SpanDecoder:
+    # Decompresses the data of a span in order, from its access point on
+    def __init__(self, source, fmt, point):
+        self.source = source
+        self.format = fmt
+        self.start = int(point['position'])
+        self.end = int(point['end'])
+        self.cursor = self.start // 8               # Next compressed byte
+        self.input_end = -(-self.end // 8)
+        self.offset = int(point['offset'])          # Uncompressed offset of the next data
+        self.finished = False
+        self.member = False                         # gzip: a new member starts, check its magic
+
+        if fmt == "gzip":
+            self.decompressor = zlib.decompressobj(31)
+            self.pending = b""
+        elif fmt == "xz":
+            # The blocks of a stream follow its header
+            self.decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ)
+            self.pending = source.read(int(point['stream']), 12)
+        else:
+            # A block shifted to the start of a stream of its own. libbz2 only puts
+            # out a block after reading past it, so the magic number of the next one
+            # is read too, not the CRC following it.
+            self.decompressor = bz2.BZ2Decompressor()
+            self.pending = b"BZh9"
+            self.input_end = min(-(-(self.end + 48) // 8), source.size)
+
+
+    def next_input(self):
+        # Next piece of the compressed span, b"" at its end
+        end = self.input_end
+        length = min(INPUT_SIZE, end - self.cursor)
+        if length <= 0:
+            return b""
+
+        shift = self.start % 8
+        if self.format != "bzip2" or shift == 0:
+            data = self.source.read(self.cursor, length)
+        else:
+            raw = np.frombuffer(self.source.read(self.cursor, length + 1).ljust(length + 1, b"\0"), dtype=np.uint8)
+            data = ((raw[:-1] << shift) | (raw[1:] >> (8 - shift))).tobytes()
+        self.cursor = self.cursor + len(data) if data else end
+        return data
+
+
+    def needs_input(self):
+        if self.format == "gzip":
+            return not self.pending
+        return not self.pending and self.decompressor.needs_input
+
+
+    def read(self, size):
+        # Up to size bytes of uncompressed data, fewer at the end of the span
+        out = []
+        remaining = size
+        while remaining > 0 and not self.finished:
+            if self.member:
+                # Another gzip member or the end (padding or other data after the last one)
+                while len(self.pending) < 2:
+                    data = self.next_input()
+                    if not data:
+                        break
+                    self.pending += data
+                if self.pending[:2] != FORMAT_MAGICS["gzip"]:
+                    self.finished = True
+                    break
+                self.member = False
+
+            # At the end of the input lzma and bz2 may still hold data
+            if self.needs_input():
+                self.pending = self.next_input()
+            exhausted = not self.pending and self.cursor >= self.input_end
+            if exhausted and self.format == "gzip":
+                break
+
+            data = self.decompressor.decompress(self.pending, remaining)
+            if self.format == "gzip":
+                self.pending = self.decompressor.unconsumed_tail
+                if self.decompressor.eof:
+                    self.pending = self.decompressor.unused_data
+                    self.decompressor = zlib.decompressobj(31)
+                    self.member = True
+            else:
+                self.pending = b""
+                self.finished = self.decompressor.eof
+            out.append(data)
+            remaining -= len(data)
+            if exhausted and not data:
+                break
+
+        self.offset += size - remaining
+        return b"".join(out)
+
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, PIECE_SIZE))
+            if not data:
+                raise EOFError("Compressed data ends early")
+            size -= len(data)
+
+
+    def count(self):
+        # Length of the rest of the span
+        total = 0
+        while True:
+            data = self.read(PIECE_SIZE)
+            if not data:
+                return total
+            total += len(data)
+
+
+def gzip_points(source):
+    # Access points at the gzip members, found by decompressing the file once
+    points = []
+    offset = 0
+    decompressor = None
+    data, data_end = b"", 0
+    while True:
+        if decompressor is None:
+            while len(data) < 2 and data_end < source.size:
+                more = source.read(data_end, INPUT_SIZE)
+                data, data_end = data + more, data_end + len(more)
+            if data[:2] != FORMAT_MAGICS["gzip"]:
+                break
+            if not points or offset - points[-1][0] >= SPAN_SIZE:
+                points.append([offset, (data_end - len(data)) * 8, source.size * 8, 0])
+            decompressor = zlib.decompressobj(31)
+
+        if not data:
+            data = source.read(data_end, INPUT_SIZE)
+            data_end += len(data)
+            if not data:
+                raise ValueError(f"Truncated gzip data at byte {data_end}")
+
+        try:
+            offset += len(decompressor.decompress(data, PIECE_SIZE))
+        except zlib.error as e:
+            raise ValueError(f"Damaged gzip data before byte {data_end} ({e})")
+        data = decompressor.unconsumed_tail
+        if decompressor.eof:
+            data = decompressor.unused_data
+            decompressor = None
+
+    if not points:
+        raise ValueError("No gzip data")
+    return points, offset
+
+
+def read_varint(data, position):
+    # xz multibyte integer, returns (value, next position)
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        value |= (byte & 0x7F) << shift
+        position += 1
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def xz_points(source):
+    # Access points at the xz blocks, from the index of every stream, which is read
+    # from the end of the file on without decompressing anything
+    streams = []
+    end = source.size
+    while end > 0:
+        if source.read(end - 4, 4) == b"\0\0\0\0":       # Stream padding
+            end -= 4
+            continue
+        footer = source.read(end - 12, 12)
+        if len(footer) < 12 or footer[10:] != b"YZ":
+            raise ValueError(f"No xz stream footer at byte {end - 12}")
+        index_size = (struct.unpack_from("<I", footer, 4)[0] + 1) * 4
+        index = source.read(end - 12 - index_size, index_size)
+        if not index or index[0] != 0:
+            raise ValueError(f"No xz index at byte {end - 12 - index_size}")
+
+        count, position = read_varint(index, 1)
+        blocks = []
+        for k in range(count):
+            unpadded, position = read_varint(index, position)
+            size, position = read_varint(index, position)
+            blocks.append((unpadded + (-unpadded % 4), size))
+
+        stream = end - 12 - index_size - sum(padded for padded, size in blocks) - 12
+        if stream < 0 or source.read(stream, 6) != FORMAT_MAGICS["xz"]:
+            raise ValueError(f"No xz stream header at byte {stream}")
+        streams.append((stream, blocks))
+        end = stream
+
+    points = []
+    offset = 0
+    for stream, blocks in reversed(streams):
+        position = stream + 12
+        for padded, size in blocks:
+            if not points or points[-1][3] != stream or offset - points[-1][0] >= SPAN_SIZE:
+                points.append([offset, position * 8, 0, stream])
+            position += padded
+            offset += size
+            points[-1][2] = position * 8
+    return points, offset
+
+
+def bzip2_magics(source):
+    # Sorted (bit position, end of stream) of the block and end of stream magic
+    # numbers. Each is searched at all 8 bit shifts by the 5 bytes it covers
+    # completely, then checked with the bits around them.
+    patterns = []
+    for magic, is_end in ((BZIP2_BLOCK_MAGIC, False), (BZIP2_END_MAGIC, True)):
+        for shift in range(8):
+            window = (magic << (8 - shift)).to_bytes(7, "big")
+            patterns.append((window[1:6], magic, shift, is_end))
+
+    found = {}
+    start = 0
+    while start < source.size:
+        data = source.read(start, SCAN_SIZE + 8)
+        for key, magic, shift, is_end in patterns:
+            i = data.find(key, 1)
+            while i >= 0:
+                window = int.from_bytes(data[i - 1:i + 6].ljust(7, b"\0"), "big")
+                if (window >> (8 - shift)) & 0xFFFFFFFFFFFF == magic:
+                    found[(start + i - 1) * 8 + shift] = is_end
+                i = data.find(key, i + 1)
+        start += SCAN_SIZE
+    return sorted(found.items())
+
+
+def bzip2_points(source, threads):
+    # Access points at the bzip2 blocks. Every block is decompressed up to the next
+    # magic number, in parallel, for its size. A block giving no data runs on
+    # behind that magic number, which is then a false one within its compressed
+    # data and dropped, and the block tried again.
+    magics = bzip2_magics(source)
+    sizes = {}
+
+    def block_size(segment):
+        point = np.array((0, segment[0], segment[1], 0), dtype=POINT_DTYPE)
+        try:
+            return SpanDecoder(source, "bzip2", point).count()
+        except DECODE_ERRORS:
+            return None
+
+    with ThreadPoolExecutor(threads) as pool:
+        while True:
+            segments = [(position, magics[k + 1][0] if k + 1 < len(magics) else source.size * 8)
+                        for k, (position, is_end) in enumerate(magics) if not is_end]
+            missing = [segment for segment in segments if segment not in sizes]
+            sizes.update(zip(missing, pool.map(block_size, missing)))
+
+            drop = None
+            segments = iter(segments)
+            for k, (position, is_end) in enumerate(magics):
+                if is_end:
+                    continue
+                size = sizes[next(segments)]
+                if size == 0 and k + 1 < len(magics):
+                    drop = k + 1
+                    break
+                if size is None:
+                    raise ValueError(f"Damaged bzip2 block at byte {position // 8}")
+            if drop is None:
+                break
+            del magics[drop]
+
+    points = []
+    offset = 0
+    for k, (position, is_end) in enumerate(magics):
+        if is_end:
+            continue
+        end = magics[k + 1][0] if k + 1 < len(magics) else source.size * 8
+        # A span doesn't continue past the end of its stream
+        if not points or points[-1][2] != position or offset - points[-1][0] >= SPAN_SIZE:
+            points.append([offset, position, end, 0])
+        else:
+            points[-1][2] = end
+        offset += sizes[(position, end)]
+
+    if not points:
+        raise ValueError("No bzip2 blocks")
+    return points, offset
+
+
+class ChunkIndex:
+    # Access points of a compressed image, see build_chunk_index()
+    def __init__(self, fmt, size, points, compressed_size, mtime_ns):
+        self.format = fmt
+        self.size = size
+        self.points = points
+        self.compressed_size = compressed_size
+        self.mtime_ns = mtime_ns
+
+
+    def __len__(self):
+        return len(self.points)
+
+
+    def span(self, offset):
+        return max(int(np.searchsorted(self.points['offset'], offset, side='right')) - 1, 0)
+
+
+    def span_range(self, span):
+        # (start, end) uncompressed offsets of a span
+        end = int(self.points['offset'][span + 1]) if span + 1 < len(self.points) else self.size
+        return int(self.points['offset'][span]), end
+
+
+    def matches(self, image):
+        try:
+            st = os.stat(image)
+        except OSError:
+            return False
+        return (self.compressed_size, self.mtime_ns) == (st.st_size, st.st_mtime_ns)
+
+
+def read_chunk_index(path):
+    with open(path, "rb") as f:
+        header = f.read(CHUNK_INDEX_HEADER_SIZE)
+        if len(header) < CHUNK_INDEX_HEADER_SIZE or header[:8] != CHUNK_INDEX_MAGIC:
+            raise ValueError(f"Not a RaidAlyzer chunk index: {path}")
+        magic, fmt, compressed_size, mtime_ns, size, count = CHUNK_INDEX_HEADER.unpack_from(header)
+        points = np.frombuffer(f.read(count * POINT_DTYPE.itemsize), dtype=POINT_DTYPE)
+    if len(points) != count:
+        raise ValueError(f"Truncated RaidAlyzer chunk index: {path}")
+    return ChunkIndex(fmt.rstrip(b"\0").decode("ascii"), size, points, compressed_size, mtime_ns)
+
+
+def load_chunk_index(image):
+    # Valid chunk index of the compressed image or None
+    for path in sidecar_paths(image, CHUNK_INDEX_SUFFIX):
+        if not os.path.exists(path):
+            continue
+        try:
+            index = read_chunk_index(path)
+        except (OSError, ValueError):
+            continue
+        if index.matches(image):
+            return index
+    return None
+
+
+def build_chunk_index(image, threads=None):
+    # Find the access points of the compressed image and write its chunk index.
+    # A gzip file is decompressed once, bzip2 blocks in parallel, an xz file only
+    # needs its stream indexes. The index is still used if it can't be written.
+    fmt = compressed_format(image)
+    if fmt is None:
+        raise ValueError(f"{image} is no gzip, xz or bzip2 image")
+    st = os.stat(image)
+    source = CompressedFile(image)
+    try:
+        if fmt == "gzip":
+            points, size = gzip_points(source)
+        elif fmt == "xz":
+            points, size = xz_points(source)
+        else:
+            points, size = bzip2_points(source, threads or DECOMPRESS_THREADS)
+    finally:
+        source.close()
+
+    index = ChunkIndex(fmt, size, np.array([tuple(point) for point in points], dtype=POINT_DTYPE), st.st_size, st.st_mtime_ns)
+    header = CHUNK_INDEX_HEADER.pack(CHUNK_INDEX_MAGIC, fmt.encode("ascii"), st.st_size, st.st_mtime_ns, size, len(points))
+    for path in sidecar_paths(image, CHUNK_INDEX_SUFFIX):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as out:
+                out.write(header.ljust(CHUNK_INDEX_HEADER_SIZE, b"\0"))
+                out.write(index.points.tobytes())
+            os.replace(path + ".tmp", path)
+            break
+        except OSError:
+            continue
+    return index
+
+
+_chunk_indexes = {}
+_chunk_index_locks = {}
+_chunk_index_lock = threading.Lock()
+
+
+def chunk_index(image):
+    # Chunk index of the compressed image, loaded or built on first use and kept
+    # for the process. An image is only indexed once at a time.
+    key = os.path.abspath(image)
+    with _chunk_index_lock:
+        lock = _chunk_index_locks.setdefault(key, threading.Lock())
+    with lock:
+        index = _chunk_indexes.get(key)
+        if index is None or not index.matches(image):
+            index = load_chunk_index(image) or build_chunk_index(image)
+            _chunk_indexes[key] = index
+    return index
+
+
+def compressed_size(image):
+    # Uncompressed size of a compressed image
+    return chunk_index(image).size
+
+
+class CompressedImage:
+    # Random access to the uncompressed data of a compressed image. Reads are
+    # served from decoded pieces: a short span is one piece, decoded by a pool of
+    # threads, a long one (e.g. a plain .gz) is decoded in PIECE_SIZE pieces in
+    # order by a thread of its own. Sequential reads keep the next pieces decoding
+    # ahead of them. zlib, lzma and bz2 release the GIL, so the images of a set
+    # (and the spans of one image) are decompressed on several cores while the
+    # analysis works on the batch before.
+    def __init__(self, path, threads=None):
+        self.path = path
+        self.index = chunk_index(path)
+        self.size = self.index.size
+        self.threads = threads or DECOMPRESS_THREADS
+        self.source = CompressedFile(path)
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.stream_pool = ThreadPoolExecutor(1)
+        self.pieces = OrderedDict()             # (span, piece): future of its data
+        self.decoder = None                     # (span, SpanDecoder) of the long span decoded in order
+        self.last = None                        # Last piece read
+
+
+    def close(self):
+        for pool in (self.pool, self.stream_pool):
+            pool.shutdown(wait=True, cancel_futures=True)
+        self.pieces.clear()
+        self.decoder = None
+        self.source.close()
+
+
+    def long_span(self, span):
+        start, end = self.index.span_range(span)
+        return end - start > 2 * PIECE_SIZE
+
+
+    def piece_range(self, span, piece):
+        # (start, end) uncompressed offsets of a piece
+        start, end = self.index.span_range(span)
+        if not self.long_span(span):
+            return start, end
+        return start + piece * PIECE_SIZE, min(start + (piece + 1) * PIECE_SIZE, end)
+
+
+    def locate(self, offset):
+        span = self.index.span(offset)
+        start = self.index.span_range(span)[0]
+        return span, (offset - start) // PIECE_SIZE if self.long_span(span) else 0
+
+
+    def next_piece(self, key):
+        span, piece = key
+        if self.piece_range(span, piece)[1] < self.index.span_range(span)[1]:
+            return span, piece + 1
+        return (span + 1, 0) if span + 1 < len(self.index) else None
+
+
+    def request(self, key):
+        # Future of the data of a piece, decoding it if it isn't yet
+        future = self.pieces.get(key)
+        if future is None:
+            if self.long_span(key[0]):
+                future = self.stream_pool.submit(self.decode_piece, *key)
+            else:
+                future = self.pool.submit(self.decode_span, key[0])
+            self.pieces[key] = future
+        self.pieces.move_to_end(key)
+        return future
+
+
+    def decode_span(self, span):
+        start, end = self.index.span_range(span)
+        data = SpanDecoder(self.source, self.index.format, self.index.points[span]).read(end - start)
+        if len(data) < end - start:
+            raise EOFError("Compressed data ends early")
+        return data
+
+
+    def decode_piece(self, span, piece):
+        # Only called by the stream thread, which keeps the decoder of the span
+        start, end = self.piece_range(span, piece)
+        if self.decoder is None or self.decoder[0] != span or self.decoder[1].offset > start:
+            self.decoder = (span, SpanDecoder(self.source, self.index.format, self.index.points[span]))
+        decoder = self.decoder[1]
+        decoder.skip(start - decoder.offset)
+        data = decoder.read(end - start)
+        if len(data) < end - start:
+            raise EOFError("Compressed data ends early")
+        return data
+
+
+    def read_ahead(self, key):
+        # Sequential reads keep the next pieces decoding, random ones (e.g. of the
+        # sampling analysis) don't. Old pieces are dropped.
+        sequential = self.last is None or key == self.last or key == self.next_piece(self.last)
+        self.last = key
+        if sequential:
+            ahead = key
+            for k in range(self.threads):
+                ahead = self.next_piece(ahead)
+                if ahead is None:
+                    break
+                self.request(ahead)
+        while len(self.pieces) > self.threads + 2:
+            self.pieces.popitem(last=False)[1].cancel()
+
+
+    def read_at(self, position, out):
+        # Fill the uint8 array out from position, returns the bytes read: fewer at
+        # the end of the image or before damaged compressed data, which raises
+        # OSError if nothing could be read
+        count = min(len(out), max(self.size - position, 0))
+        done = 0
+        while done < count:
+            key = self.locate(position + done)
+            future = self.request(key)
+            self.read_ahead(key)
+            try:
+                data = future.result()
+            except DECODE_ERRORS as e:
+                if done:
+                    return done
+                raise OSError(f"{self.path}: damaged compressed data ({e})")
+            skip = position + done - self.piece_range(*key)[0]
+            n = min(len(data) - skip, count - done)
+            out[done:done + n] = np.frombuffer(data, dtype=np.uint8, count=n, offset=skip)
+            done += n
+        return done
@@ -0,0 +1,1021 @@
+import os
+import time
+
+import numpy as np
+
+from datetime import datetime
+
+from .classify import accumulate, batch_entropy, calc_entropy, classify_sectors, exact_sum
+from .checkpoint import check_checkpoint, load_checkpoint, write_checkpoint
+from .index import load_index
+from .mirrors import mirror_counts
+from .parity import match_matrix, parity_matches
+from .heatmap import RegionHeatmap
+from .paritylog import UNKNOWN_PATTERN, ZERO_PATTERN, ParityRunLog
+from .pyramid import EntropyPyramid
+from .raid6 import q_matches, q_subsets
+from .reader import PREFETCH_BUFFER_SIZE, PREFETCH_DEPTH, READ_RETRIES, SKIP_SECTORS, ImageReader, MultiImageReader, PrefetchImageReader, image_size
+from .report import write_html_report
+from .signatures import SIGNATURE_NAMES, SignatureHits, scan_signatures
+from .timers import StageTimers, run_profiled
+from .shard import ShardedAnalysis
+
+
+VERSION = "3.0.8"
+
+
+class RaidAnalysisEngine:
+    version = VERSION
+
+    def __init__(self, files, bs=512, analysis_block_size=10000, parity_log_path="parity_check.log", processes=1):
+        # Base values for the analysis
+        self.bs = bs                                    # Check sector by sector
+        self.analysis_block_size = analysis_block_size  # Sectors analyzed between progress updates
+        self.analysis_start_sector = 0                  # Start offset in sectors
+        self.parity_log_path = parity_log_path          # Text file the parity check log is written to at the end, None for none
+        self.processes = processes                      # Worker processes for a full analysis
+        self.disk_offsets = None                        # Extra start offset in sectors of each image, None for all 0
+
+        # Range of this engine within the analysis, used by the shard workers
+        self.sector_base = 0                            # Index of the first sector relative to the analysis start
+        self.sector_count = None                        # Number of sectors to analyze, None for all
+
+        # Images to analyze
+        self.files = list(files)
+        self.filenames = [os.path.basename(file) for file in self.files]
+
+        # Runtime status data
+        self.stats = []
+        self.mirrors = []
+        self.parity = []
+        self.entropy_sums = []                          # Exact entropy sums for merging, see classify.exact_sum()
+
+        # RAID6 Q syndrome check of all files and with one or two files left out
+        self.check_q = True
+        self.q_subsets = q_subsets(len(self.files))
+        self.q_parity = []
+
+        self.reader = None
+        self.use_mmap = False                           # Memory map the images instead of reading into a buffer
+        self.chunk_sectors = 2048                       # Sectors read and processed at once
+        self.min_zero_run = 64                          # Shortest run of all-zero stripes taking the arithmetic path
+        self.direct_io = None                           # O_DIRECT reads: None for block devices only, True for all images, False for none
+        self.read_retries = READ_RETRIES                # Retries of a failing read before its sectors are skipped as unknown
+        self.skip_sectors = SKIP_SECTORS                # Sectors skipped at once after a read failed
+        self.prefetch_depth = PREFETCH_DEPTH            # Buffers each image is read ahead into by a thread of its own, 0 for none
+        self.prefetch_buffer_size = PREFETCH_BUFFER_SIZE    # Bytes per read ahead buffer
+        self.unknown_stripes = 0                        # Stripes with an unreadable sector, left out of mirrors and parity
+        self.max_sectors = 0
+        self.start_time = 0
+        self.first_analysis_block = False
+        self.analysis_block_entropy = []
+        self.run_only_one_block = False
+
+        self.offset = 0
+
+        # Parity check log as runs of stripes with the same pattern (see paritylog.py),
+        # runs shorter than parity_noise_sectors are merged in the report summary
+        self.record_parity_runs = True
+        self.parity_runs = ParityRunLog()
+        self.pattern_ids = {}                           # Interned pattern by packed match matrix row and Q label
+        self.parity_noise_sectors = 128
+
+        # Min/mean/max entropy and zero fraction pyramid of the whole range for the
+        # zoomable entropy map (see pyramid.py)
+        self.record_pyramid = True
+        self.pyramid = None
+
+        # Zero/pattern/entropy/parity counters of a fixed number of LBA regions for
+        # the heatmaps of the report (see heatmap.py)
+        self.record_heatmap = True
+        self.heatmap = None
+
+        self.running = False
+        self.is_open = False
+        self.reached_end = False
+        self.stop_requested = False
+        self.cancel_event = None                        # Optional event (e.g. of a shard worker) that stops the analysis
+        self.first_potential_bootsector_found_on = ""
+        self.first_potential_efi_part_found_on = ""
+        self.bootsector_hit = None                      # (sector, file index) of the first bootsector signature
+        self.efi_part_hit = None                        # (sector, file index) of the first EFI PART header
+
+        # Every hit of these partition, filesystem and RAID metadata signatures per image
+        self.signatures = list(SIGNATURE_NAMES)
+        self.signature_hits = SignatureHits(len(self.files), self.signatures)
+
+        # Sharded multi-process analysis while running with more than one process
+        self.shards = None
+
+        # Counters and timers per stage (see timers.py), and a file to write a
+        # cProfile profile of run() to
+        self.timers = StageTimers()
+        self.profile_path = None
+
+        # Checkpoint file the state is written to every checkpoint_interval seconds
+        # and when the analysis stops, and a loaded checkpoint the next open() resumes
+        self.checkpoint_path = None
+        self.checkpoint_interval = 60.0
+        self.last_checkpoint = 0
+        self.resume_checkpoint = None
+
+        # Progress subscribers, called as callback(event, engine)
+        self.listeners = []
+
+
+    def subscribe(self, callback):
+        self.listeners.append(callback)
+
+
+    def unsubscribe(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+
+    def notify(self, event):
+        for callback in list(self.listeners):
+            callback(event, self)
+
+
+    def open(self, offset=0, run_only_one_block=False, sector_count=None, sector_base=0):
+        # A resumed analysis continues at the start sector of its checkpoint
+        checkpoint, self.resume_checkpoint = self.resume_checkpoint, None
+        if checkpoint is not None:
+            offset = checkpoint["settings"]["start_sector"]
+
+        sharded = self.processes > 1 and not run_only_one_block and sector_count is None
+
+        # Open all files, the shard workers open their own readers
+        if sharded:
+            offsets = self.disk_offsets or [0 for x in self.files]
+            self.max_sectors = max(min(image_size(file) // self.bs - offset for file, offset in zip(self.files, offsets)), 0)
+        else:
+            self.reader = self.open_reader()
+            self.max_sectors = self.reader.max_sectors
+
+        self.running = True
+        self.is_open = True
+        self.reached_end = False
+        self.stop_requested = False
+        self.start_time = time.time()
+        self.last_checkpoint = self.start_time
+        self.timers = StageTimers()
+
+        # Reset analysis variables
+        self.offset = 0
+        self.unknown_stripes = 0
+        self.analysis_start_sector = offset
+        self.sector_base = sector_base
+        self.sector_count = sector_count
+        self.run_only_one_block = run_only_one_block
+        self.first_analysis_block = True
+        self.analysis_block_entropy = [[] for x in range(len(self.files))]
+        self.parity_runs = ParityRunLog() if self.record_parity_runs else None
+        self.pattern_ids = {}
+        self.pyramid = EntropyPyramid(len(self.files)) if self.record_pyramid else None
+
+        # The regions span the whole analysis, also in a shard
+        total = max(self.max_sectors - (offset - sector_base), 0)
+        self.heatmap = RegionHeatmap(len(self.files), total) if self.record_heatmap else None
+
+        self.first_potential_bootsector_found_on = ""
+        self.first_potential_efi_part_found_on = ""
+        self.bootsector_hit = None
+        self.efi_part_hit = None
+        self.signature_hits = SignatureHits(len(self.files), self.signatures)
+
+        self.stats.clear()
+        self.mirrors.clear()
+        self.parity.clear()
+        self.q_parity.clear()
+        self.entropy_sums.clear()
+
+        if checkpoint is not None:
+            check_checkpoint(checkpoint, self)
+            self.restore(checkpoint["state"])
+
+        if sharded:
+            self.shards = ShardedAnalysis(self, self.processes)
+            self.shards.start()
+
+
+    def resume_from(self, path):
+        # Resume the analysis from a checkpoint with the next open(), which raises
+        # ValueError if it was written for other images or settings
+        self.resume_checkpoint = load_checkpoint(path)
+        return self.resume_checkpoint
+
+
+    def restore(self, result):
+        # Continue from a partial result, e.g. of a checkpoint or the merged shards
+        self.offset = result['offset']
+        self.unknown_stripes = result['unknown_stripes']
+        self.stats = [dict(s) for s in result['stats']]
+        self.entropy_sums = list(result['entropy_sums'])
+        self.mirrors = [list(row) for row in result['mirrors']]
+        self.parity = list(result['parity'])
+        self.q_parity = list(result['q_parity'])
+        self.first_analysis_block = result['first_analysis_block']
+        self.analysis_block_entropy = [list(values) for values in result['analysis_block_entropy']]
+        self.parity_runs = result['parity_runs']
+        self.pattern_ids = {}
+        self.pyramid = result['pyramid']
+        self.heatmap = result['heatmap']
+
+        self.bootsector_hit = None
+        self.efi_part_hit = None
+        self.first_potential_bootsector_found_on = ""
+        self.first_potential_efi_part_found_on = ""
+        if result['bootsector_hit'] is not None:
+            self.set_signature_hits(bootsector=tuple(result['bootsector_hit']))
+        if result['efi_part_hit'] is not None:
+            self.set_signature_hits(efi_part=tuple(result['efi_part_hit']))
+
+        self.signature_hits = SignatureHits(len(self.files), self.signatures)
+        for i, hits in enumerate(result['signature_hits']):
+            self.signature_hits.add(i, hits)
+
+
+    def checkpoint_due(self):
+        return self.checkpoint_path is not None and not self.run_only_one_block and time.time() - self.last_checkpoint >= self.checkpoint_interval
+
+
+    def save_checkpoint(self):
+        # Write the state of the analyzed range from the start sector on. While the
+        # shards run, that is the contiguous range of the shards done so far.
+        if self.shards is not None and not self.shards.merged:
+            result = self.shards.checkpoint()
+        else:
+            result = self.partial_result()
+
+        write_checkpoint(self.checkpoint_path, self, result)
+        self.last_checkpoint = time.time()
+
+
+    def open_reader(self):
+        if self.prefetch_depth > 0 and not self.use_mmap:
+            return PrefetchImageReader(self.files, bs=self.bs, batch_sectors=self.chunk_sectors, offsets=self.disk_offsets, direct=self.direct_io,
+                                       retries=self.read_retries, skip_sectors=self.skip_sectors, depth=self.prefetch_depth,
+                                       buffer_size=self.prefetch_buffer_size)
+        return MultiImageReader(self.files, bs=self.bs, batch_sectors=self.chunk_sectors, use_mmap=self.use_mmap, offsets=self.disk_offsets,
+                                direct=self.direct_io, retries=self.read_retries, skip_sectors=self.skip_sectors)
+
+
+    def close(self):
+        # Stop shard workers and close all file readers
+        if self.shards is not None:
+            self.shards.close()
+            self.shards = None
+
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+
+    def request_stop(self):
+        # Cooperative stop, safe to call from another thread. The analysis stops
+        # after the current chunk and reports "finished" as usual.
+        self.stop_requested = True
+
+
+    def cancel_requested(self):
+        return self.stop_requested or (self.cancel_event is not None and self.cancel_event.is_set())
+
+
+    def stop(self, save_checkpoint=False):
+        # The analysis steps stop with save_checkpoint, an analysis stopped by an
+        # exception keeps its last periodic checkpoint as its state may be torn
+        was_open = self.is_open
+        self.is_open = False
+        self.running = False
+
+        # Keep what the shard workers finished so far
+        if self.shards is not None:
+            self.shards.cancel()
+            self.shards.merge()
+
+        if was_open and save_checkpoint and self.checkpoint_path is not None and not self.run_only_one_block:
+            self.save_checkpoint()
+        if was_open and self.parity_log_path is not None and self.parity_runs is not None:
+            self.parity_runs.write(self.parity_log_path)
+
+        self.close()
+
+        if was_open:
+            self.notify("finished")
+
+
+    def step(self):
+        # Analyze one analysis block, returns True while there is more to do
+        if not self.running:
+            return False
+
+        if self.shards is not None:
+            return self.step_sharded()
+
+        # Read the block in chunks, so a stop request takes effect quickly. Blocks
+        # end at multiples of the block size from the analysis start, also when a
+        # shard or a resumed analysis starts within a block.
+        block_start = self.offset
+        block_end = ((self.sector_base + self.offset) // self.analysis_block_size + 1) * self.analysis_block_size - self.sector_base
+        interrupted = False
+        while self.offset < block_end:
+            if self.cancel_requested():
+                self.running = False
+                interrupted = True
+                break
+
+            # Stripes in holes of all images are counted without reading them
+            remaining = block_end - self.offset
+            if self.sector_count is not None:
+                remaining = min(remaining, self.sector_count - self.offset)
+            with self.timers.stage("read"):
+                zeros = self.reader.zero_run(self.analysis_start_sector + self.offset, remaining)
+            if zeros:
+                self.init_stats()
+                with self.timers.stage("zero_runs", sectors=zeros * len(self.files)):
+                    self.process_zero_run(zeros)
+                if self.sector_count is not None and self.offset >= self.sector_count:
+                    self.running = False
+                    break
+                continue
+
+            batch = self.read_next_batch(min(self.chunk_sectors, remaining))
+            if batch is not None:
+                self.process_batch(batch, self.reader.last_unknown)
+
+            # Stop at the end of the files or of the requested sector range
+            if batch is None or self.reached_end or (self.sector_count is not None and self.offset >= self.sector_count):
+                self.running = False
+                break
+
+        # Calculate average entropy for actual analysis block, an interrupted block is
+        # continued on resume
+        if self.first_analysis_block and self.offset > block_start and not interrupted:
+            block_avg = 0.0
+            for i in range(len(self.files)):
+                block_avg += sum(self.analysis_block_entropy[i]) / max(len(self.analysis_block_entropy[i]), 1)
+            block_avg /= len(self.files)
+
+            # Stop if some block with higher entropy found
+            if block_avg > 25:
+                self.first_analysis_block = False
+
+            # Reset entropy data for next block
+            elif not self.run_only_one_block:
+                self.analysis_block_entropy = [[] for x in range(len(self.files))]
+
+        if self.running and self.checkpoint_due():
+            self.save_checkpoint()
+
+        self.timers.record(self.offset)
+        self.notify("progress")
+
+        # If only one block run requested or the end is reached, stop analysis
+        if self.run_only_one_block or not self.running:
+            self.stop(save_checkpoint=True)
+            return False
+
+        return True
+
+
+    def step_sharded(self):
+        # Wait a moment for shard progress, merge the partial results when all are done
+        if self.cancel_requested():
+            self.stop(save_checkpoint=True)
+            return False
+
+        with self.timers.stage("shards"):
+            done = self.shards.poll(timeout=0.05)
+        self.offset = self.shards.sectors_done()
+
+        if done:
+            self.shards.merge()
+            self.shards.close()
+            self.shards = None
+            self.running = False
+        elif self.checkpoint_due():
+            self.save_checkpoint()
+
+        self.timers.record(self.offset)
+        self.notify("progress")
+
+        if not self.running:
+            self.stop(save_checkpoint=True)
+            return False
+
+        return True
+
+
+    def run(self, offset=0, run_only_one_block=False, sector_count=None, sector_base=0):
+        # Blocking analysis loop for headless use
+        self.open(offset=offset, run_only_one_block=run_only_one_block, sector_count=sector_count, sector_base=sector_base)
+        try:
+            self.run_steps()
+        finally:
+            self.stop()
+
+
+    def run_steps(self):
+        # Step until done, under cProfile if a profile path is set
+        def steps():
+            while self.step():
+                pass
+
+        if self.profile_path is not None:
+            run_profiled(steps, self.profile_path)
+        else:
+            steps()
+
+
+    def sectors_per_second(self):
+        elapsed = time.time() - self.start_time
+        if elapsed <= 0:
+            return 0.0
+        return self.offset / elapsed
+
+
+    def status_text(self):
+        max_sectors = max(self.max_sectors, 1)
+        return f"Processed {self.offset} / {self.max_sectors} sectors: {self.offset * 100 / max_sectors:.1f}% ({self.sectors_per_second():.1f} sectors/sec.)"
+
+
+    def read_next_batch(self, sectors):
+        # Read up to the given number of sectors from each file, returns an array of
+        # shape (files, sectors, bs) or None at the end of one of the files
+        if self.sector_count is not None:
+            sectors = min(sectors, self.sector_count - self.offset)
+            if sectors <= 0:
+                return None
+
+        with self.timers.stage("read") as counts:
+            batch = self.reader.read_batch(self.analysis_start_sector + self.offset, sectors)
+            counts["sectors"] = batch.shape[0] * batch.shape[1]
+            counts["bytes"] = batch.nbytes
+
+        # A short read means the end of one of the files is reached
+        if batch.shape[1] < sectors:
+            self.reached_end = True
+        if batch.shape[1] == 0:
+            return None
+
+        return batch
+
+
+    def check_signatures(self, batch):
+        # Remember the first sector (and first file) with a bootsector signature or EFI PART header
+        if self.bootsector_hit is None:
+            hits = (batch[:, :, -2] == 0x55) & (batch[:, :, -1] == 0xAA)
+            if hits.any():
+                sector, i = np.unravel_index(np.argmax(hits.T), hits.T.shape)
+                self.set_signature_hits(bootsector=(self.sector_base + self.offset + int(sector), int(i)))
+
+        if self.efi_part_hit is None:
+            signature = np.frombuffer(b"EFI PART", dtype=np.uint8)
+            hits = (batch[:, :, :8] == signature).all(axis=2)
+            if hits.any():
+                sector, i = np.unravel_index(np.argmax(hits.T), hits.T.shape)
+                self.set_signature_hits(efi_part=(self.sector_base + self.offset + int(sector), int(i)))
+
+        for i in range(batch.shape[0]):
+            self.signature_hits.add(i, scan_signatures(batch[i], self.signatures), self.sector_base + self.offset)
+
+
+    def set_signature_hits(self, bootsector=None, efi_part=None):
+        if bootsector is not None:
+            sector, i = bootsector
+            self.bootsector_hit = bootsector
+            self.first_potential_bootsector_found_on = f"Bootsector signature found in file: {self.filenames[i]} at sector {sector}"
+
+        if efi_part is not None:
+            sector, i = efi_part
+            self.efi_part_hit = efi_part
+            self.first_potential_efi_part_found_on = f"EFI PART header found in file:      {self.filenames[i]} at sector {sector}"
+
+
+    def init_stats(self):
+        # Initialize statistics for first data block
+        if self.stats:
+            return
+
+        files = len(self.files)
+        for i in range(files):
+            self.stats.append({
+                'zero_blocks': 0,
+                'pattern_blocks': 0,
+                'unknown_blocks': 0,
+                'entropy': 0.0,
+            })
+
+            self.mirrors.append([0 for x in range(files)])
+            self.entropy_sums.append(0)
+
+        self.parity = [0 for x in range(files + 1)]
+        self.q_parity = [0 for x in self.q_subsets]
+
+
+    def process_batch(self, batch, unknown=None):
+        self.init_stats()
+        if unknown is None:
+            self.process_readable(batch)
+            return
+
+        # Stripes with a skipped unreadable sector on any image are counted apart
+        for start, end, skipped in zero_runs(unknown.any(axis=0), 1):
+            if skipped:
+                self.process_unknown(batch[:, start:end], unknown[:, start:end])
+            else:
+                self.process_readable(batch[:, start:end])
+
+
+    def process_readable(self, batch):
+        # Runs of stripes which are zero on all images take the arithmetic path
+        zero_stripes = ~batch.any(axis=(0, 2))
+        for start, end, zero in zero_runs(zero_stripes, self.min_zero_run):
+            if zero:
+                with self.timers.stage("zero_runs", sectors=(end - start) * len(self.files)):
+                    self.process_zero_run(end - start)
+            else:
+                self.process_stripes(batch[:, start:end])
+
+
+    def process_zero_run(self, sectors):
+        # Add the results of a run of stripes where every image holds a zero sector:
+        # all sectors count as zero blocks with entropy 0, every pair of images is
+        # mirrored and every parity combination matches
+        files = len(self.files)
+        for i in range(files):
+            self.stats[i]['zero_blocks'] += sectors
+            for j in range(files):
+                if i != j:
+                    self.mirrors[i][j] += sectors
+
+            if self.first_analysis_block:
+                self.analysis_block_entropy[i].extend([1] * sectors)
+
+        if self.pyramid is not None:
+            self.pyramid.add_zeros(self.sector_base + self.offset, sectors)
+        if self.heatmap is not None:
+            self.heatmap.add_zero_run(self.sector_base + self.offset, sectors)
+
+        self.parity[0] += sectors
+        if files > 1:
+            for i in range(files):
+                self.parity[i+1] += sectors
+
+        # Zeros are a valid RAID6 stripe for every Q check
+        if self.checking_q():
+            for i in range(len(self.q_subsets)):
+                self.q_parity[i] += sectors
+
+        self.offset += sectors
+
+        # All combinations match, a run of the zero stripe pattern
+        if self.parity_runs is not None:
+            zero = np.ones((1, files + 1), dtype=bool)
+            zero[:, 1:] = files > 1
+            suffixes = self.q_pattern_suffixes() if self.checking_q() else [""]
+            labels = np.ones(1, dtype=np.intp) if self.checking_q() else np.zeros(1, dtype=np.intp)
+            pattern = self.stripe_patterns(zero, labels, suffixes)
+            self.parity_runs.append([self.sector_base + self.offset - sectors], pattern, self.sector_base + self.offset)
+
+
+    def process_unknown(self, batch, unknown):
+        with self.timers.stage("signatures", sectors=batch.shape[0] * batch.shape[1], nbytes=batch.nbytes):
+            self.check_signatures(batch)
+        self.count_unknown(batch, unknown)
+
+
+    def count_unknown(self, data, unknown):
+        # Stripes with unreadable sectors: the readable sectors count for the image
+        # statistics, the others as unknown, and none for mirrors and parity. The
+        # entropy graph shows unknown sectors as 0, below the zero sectors.
+        files, sectors = unknown.shape
+        with self.timers.stage("classify", sectors=files * sectors, nbytes=data.nbytes):
+            for i in range(files):
+                known = ~unknown[i]
+                zero, pattern, entropy = self.classify(data[i][known])
+                self.update_stats(i, zero, pattern, entropy, graph=False)
+                self.stats[i]['unknown_blocks'] += sectors - len(entropy)
+                if self.pyramid is not None:
+                    self.pyramid.add(i, self.sector_base + self.offset, zero, entropy, known)
+                if self.heatmap is not None:
+                    self.heatmap.add(i, self.sector_base + self.offset, zero, pattern, entropy, known)
+                if self.first_analysis_block:
+                    values = np.zeros(sectors, dtype=np.int64)
+                    values[known] = (entropy * 10 + 1).astype(np.int64)
+                    self.analysis_block_entropy[i].extend(values.tolist())
+
+        if self.parity_runs is not None:
+            start = self.sector_base + self.offset
+            self.parity_runs.append([start], [self.parity_runs.intern(UNKNOWN_PATTERN)], start + sectors)
+        self.unknown_stripes += sectors
+        self.offset += sectors
+
+
+    def classify(self, data):
+        # (zero, pattern, entropy) of the sectors of one image
+        return classify_sectors(data)
+
+
+    def process_stripes(self, batch):
+        files, sectors, bs = batch.shape
+        with self.timers.stage("signatures", sectors=files * sectors, nbytes=batch.nbytes):
+            self.check_signatures(batch)
+
+        # Update statistics for each file, entropy only for non-zero, non-pattern blocks
+        with self.timers.stage("classify", sectors=files * sectors, nbytes=batch.nbytes):
+            for i in range(files):
+                zero, pattern, entropy = classify_sectors(batch[i])
+                self.update_stats(i, zero, pattern, entropy)
+
+        with self.timers.stage("mirrors", sectors=files * sectors, nbytes=batch.nbytes):
+            self.update_mirrors(batch)
+        with self.timers.stage("parity", sectors=files * sectors, nbytes=batch.nbytes):
+            self.update_parity(batch)
+        self.offset += sectors
+
+
+    def update_stats(self, i, zero, pattern, entropy, graph=True):
+        # Statistics of image i for the sectors from the current offset on, which
+        # also go to the entropy graph and map with graph
+        self.stats[i]['zero_blocks'] += int(np.count_nonzero(zero))
+        self.stats[i]['pattern_blocks'] += int(np.count_nonzero(pattern))
+        self.stats[i]['entropy'] = accumulate(self.stats[i]['entropy'], entropy[~(zero | pattern)])
+        self.entropy_sums[i] += exact_sum(entropy)
+
+        if self.first_analysis_block and graph:
+            self.analysis_block_entropy[i].extend((entropy * 10 + 1).astype(np.int64).tolist())
+        if self.pyramid is not None and graph:
+            self.pyramid.add(i, self.sector_base + self.offset, zero, entropy)
+        if self.heatmap is not None and graph:
+            self.heatmap.add(i, self.sector_base + self.offset, zero, pattern, entropy)
+
+
+    def calc_entropy(self, data):
+        return calc_entropy(data)
+
+
+    def parity_patterns(self):
+        # Pattern names by match matrix column, "NO_MATCH" is addressed as column -1
+        patterns = [" + ".join(self.filenames)]
+        for i in range(len(self.filenames)):
+            patterns.append(" + ".join(self.filenames[:i] + self.filenames[i+1:]))
+        patterns.append("NO_MATCH")
+        return patterns
+
+
+    def q_pattern_names(self):
+        # Files of each Q check, e.g. "Q: 01.img + 02.img + 04.img + 05.img"
+        names = []
+        for subset in self.q_subsets:
+            names.append("Q: " + " + ".join(name for i, name in enumerate(self.filenames) if i not in subset))
+        return names
+
+
+    def q_pattern_suffixes(self):
+        # Appended to the XOR pattern in the parity check log, index 0 for no valid Q check
+        return [""] + [" | " + name for name in self.q_pattern_names()]
+
+
+    def update_mirrors(self, batch):
+        # Update mirror status from the groups of identical sectors in each stripe
+        counts = mirror_counts(batch)
+        if counts.any():
+            self.mirrors = (np.array(self.mirrors, dtype=np.int64) + counts).tolist()
+
+
+    def update_parity(self, batch):
+        # Update parity status for all data blocks and each combination with one block missing
+        full, without = parity_matches(batch)
+        q = q_matches(batch, self.q_subsets) if self.checking_q() else None
+        self.count_parity(full, without, q)
+
+
+    def checking_q(self):
+        return self.check_q and len(self.q_subsets) > 0
+
+
+    def count_parity(self, full, without, q=None):
+        self.parity[0] += int(np.count_nonzero(full))
+        for i in range(len(without)):
+            self.parity[i+1] += int(np.count_nonzero(without[i]))  # Update i+1 as 0 is full parity
+
+        if q is not None:
+            for i in range(len(q)):
+                self.q_parity[i] += int(np.count_nonzero(q[i]))
+
+        if self.heatmap is not None:
+            self.heatmap.add_parity(self.sector_base + self.offset, full, without)
+
+        # Add a run to the parity check log each time the pattern changes
+        if self.parity_runs is not None:
+            with self.timers.stage("parity_log"):
+                self.log_parity(full, without, q)
+
+
+    def log_parity(self, full, without, q=None):
+        # Each XOR pattern is logged with the first valid Q check of its stripe. Only
+        # the stripes where the match matrix row or the Q check changes are interned.
+        if len(full) == 0:
+            return
+        suffixes = self.q_pattern_suffixes() if q is not None else [""]
+        labels = np.zeros(len(full), dtype=np.intp)
+        if q is not None:
+            labels = np.where(q.any(axis=0), np.argmax(q, axis=0) + 1, 0)
+
+        matches = match_matrix(full, without)
+        packed = np.packbits(matches, axis=1)
+        changed = (packed[1:] != packed[:-1]).any(axis=1) | (labels[1:] != labels[:-1])
+        changes = np.concatenate(([0], np.flatnonzero(changed) + 1))
+        start = self.sector_base + self.offset
+        self.parity_runs.append(start + changes, self.stripe_patterns(matches[changes], labels[changes], suffixes), start + len(full))
+
+
+    def stripe_patterns(self, matches, labels, suffixes):
+        # Interned pattern of each stripe from its match matrix row (see
+        # parity.match_matrix()) and its Q check label, the index into suffixes. Each
+        # distinct (packed row, label) pair is looked up once, pairs of up to 8 bytes
+        # are compared as one integer.
+        keys = np.column_stack([np.packbits(matches, axis=1), labels.astype('<u2').view(np.uint8).reshape(-1, 2)])
+        if keys.shape[1] <= 8:
+            padded = np.zeros((len(keys), 8), dtype=np.uint8)
+            padded[:, :keys.shape[1]] = keys
+            unique, inverse = np.unique(padded.view(np.uint64).reshape(-1), return_inverse=True)
+            rows = unique.view(np.uint8).reshape(-1, 8)[:, :keys.shape[1]]
+        else:
+            rows, inverse = np.unique(keys, axis=0, return_inverse=True)
+
+        patterns = np.empty(len(rows), dtype=np.uint16)
+        for k, row in enumerate(rows):
+            key = row.tobytes()
+            pattern = self.pattern_ids.get(key)
+            if pattern is None:
+                columns = np.flatnonzero(np.unpackbits(row[:-2])[:matches.shape[1]])
+                label = int(row[-2:].view('<u2')[0])
+                pattern = self.pattern_ids[key] = self.parity_runs.intern(self.pattern_name(columns, suffixes[label]))
+            patterns[k] = pattern
+        return patterns[inverse.reshape(-1)]
+
+
+    def pattern_name(self, columns, suffix):
+        # Name of the matching match matrix columns of a stripe: the XOR pattern with
+        # its Q check, several matching patterns joined by " / ", NO_MATCH for none.
+        # Where every pattern matches, all sectors of the stripe are zero.
+        names = self.parity_patterns()
+        if len(self.files) > 1 and len(columns) == len(self.files) + 1:
+            return ZERO_PATTERN
+        if len(columns) == 0:
+            return names[-1] + suffix
+        return " / ".join(names[column] for column in columns) + suffix
+
+
+    def readable_sectors(self, i):
+        # Sectors of image i the percentages refer to, the unreadable ones are left out
+        return max(self.offset - self.stats[i]['unknown_blocks'], 1)
+
+
+    def complete_stripes(self):
+        # Stripes the mirror and parity percentages refer to
+        return max(self.offset - self.unknown_stripes, 1)
+
+
+    def format_stats(self):
+        stats = " #  FILE                   ZERO %  PATTERN %  ENTROPY\n"
+        for idx in range(len(self.stats)):
+            sectors = self.readable_sectors(idx)
+            file = self.filenames[idx]
+            zero_percent = (self.stats[idx]['zero_blocks'] / sectors) * 100
+            pattern_percent = (self.stats[idx]['pattern_blocks'] / sectors) * 100
+            entropy = self.stats[idx]['entropy'] / sectors
+            stats += f"{idx:>2}  {file[:20]:<20}  {zero_percent:>5.1f} %  {pattern_percent:>7.1f} %  {entropy:>7.1f}\n"
+
+        stats += "\n---\n\n"
+
+        if self.unknown_stripes:
+            skipped = ", ".join(f"{self.filenames[i]}: {s['unknown_blocks']}" for i, s in enumerate(self.stats) if s['unknown_blocks'])
+            stats += f"Unreadable sectors skipped as unknown ({skipped}), {self.unknown_stripes} stripes left out of mirrors and parity\n"
+
+        # Check for first potential bootsector and EFI PART findings
+        if self.first_potential_bootsector_found_on != "":
+            stats += f"{self.first_potential_bootsector_found_on}\n"
+
+        if self.first_potential_efi_part_found_on != "":
+            stats += f"{self.first_potential_efi_part_found_on}\n"
+
+        return stats
+
+
+    def format_signatures(self):
+        return self.signature_hits.format(self.filenames)
+
+
+    def format_mirrors(self):
+        sectors = self.complete_stripes()
+        mirrors = " " * 22 # 20 spaces for index column + 2 spaces as padding
+        for file in self.filenames:
+            file = file[:20]
+            mirrors += f"{file:>20}  "
+        mirrors += "\n"
+
+        for i in range(len(self.mirrors)):
+            file = self.filenames[i][:20]
+            mirrors += f"{file:>20}  "
+            for j in range(len(self.mirrors)):
+                if i == j:
+                    mirrors += " " * 17 + "---  "
+                else:
+                    mirrors += f"{self.mirrors[i][j]*100/sectors:>19.0f}%  "
+            mirrors += "\n"
+
+        return mirrors
+
+
+    def format_parity(self):
+        if not self.parity:
+            return ""
+
+        sectors = self.complete_stripes()
+        if not self.checking_q() or not self.q_parity:
+            file = "ALL FILES"
+            parity = f"{file:<28}  {self.parity[0]*100/sectors:>3.0f}%\n"
+            for i in range(len(self.filenames)):
+                file = self.filenames[i][:20]
+                parity += f"WITHOUT {file:<20}  {self.parity[i+1]*100/sectors:>3.0f}%\n"
+
+            return parity
+
+        # XOR (P) parity and RAID6 Q syndrome side by side
+        q_parity = dict(zip(self.q_subsets, self.q_parity))
+        parity = f"{'':<28}  {'P':>4}  {'Q':>4}\n"
+        for subset in [()] + [(i,) for i in range(len(self.filenames))]:
+            p = self.parity[subset[0] + 1] if subset else self.parity[0]
+            q = f"{q_parity[subset]*100/sectors:>3.0f}%" if subset in q_parity else "   -"
+            file = f"WITHOUT {self.filenames[subset[0]][:20]}" if subset else "ALL FILES"
+            parity += f"{file:<28}  {p*100/sectors:>3.0f}%  {q}\n"
+
+        for subset, q in q_parity.items():
+            if len(subset) == 2:
+                file = f"WITHOUT {self.filenames[subset[0]][:9]} + {self.filenames[subset[1]][:8]}"
+                parity += f"{file:<28}     -  {q*100/sectors:>3.0f}%\n"
+
+        return parity
+
+
+    def format_parity_runs(self, first=0, count=None):
+        if self.parity_runs is None:
+            return ""
+        return self.parity_runs.format(first, count)
+
+
+    def snapshot(self):
+        # Rendered results for display in another thread
+        return {
+            "offset": self.offset,
+            "status": self.status_text(),
+            "stats": self.format_stats(),
+            "mirrors": self.format_mirrors(),
+            "parity": self.format_parity(),
+            "timers": self.timers.format(),
+        }
+
+
+    def partial_result(self):
+        # Mergeable state of an analyzed sector range, see shard.ShardedAnalysis.merge()
+        return {
+            "offset": self.offset,
+            "unknown_stripes": self.unknown_stripes,
+            "stats": [dict(s) for s in self.stats],
+            "entropy_sums": list(self.entropy_sums),
+            "mirrors": self.mirrors,
+            "parity": self.parity,
+            "q_parity": self.q_parity,
+            "first_analysis_block": self.first_analysis_block,
+            "analysis_block_entropy": self.analysis_block_entropy,
+            "bootsector_hit": self.bootsector_hit,
+            "efi_part_hit": self.efi_part_hit,
+            "signature_hits": self.signature_hits.arrays(),
+            "parity_runs": self.parity_runs,
+            "pyramid": self.pyramid,
+            "heatmap": self.heatmap,
+            "reached_end": self.reached_end,
+            "timers": self.timers.to_dict(),
+        }
+
+
+    def to_dict(self):
+        return {
+            "version": VERSION,
+            "files": self.files,
+            "start_sector": self.analysis_start_sector,
+            "disk_offsets": self.disk_offsets or [0 for x in self.files],
+            "sector_size": self.bs,
+            "sectors_analyzed": self.offset,
+            "unknown_stripes": self.unknown_stripes,
+            "max_sectors": self.max_sectors,
+            "reached_end": self.reached_end,
+            "stats": [
+                {
+                    "file": self.filenames[i],
+                    "zero_blocks": s['zero_blocks'],
+                    "pattern_blocks": s['pattern_blocks'],
+                    "unknown_blocks": s['unknown_blocks'],
+                    "entropy_sum": s['entropy'],
+                    "zero_percent": s['zero_blocks'] * 100 / self.readable_sectors(i),
+                    "pattern_percent": s['pattern_blocks'] * 100 / self.readable_sectors(i),
+                    "entropy": s['entropy'] / self.readable_sectors(i),
+                }
+                for i, s in enumerate(self.stats)
+            ],
+            "mirrors": self.mirrors,
+            "parity": {
+                "all_files": self.parity[0] if self.parity else 0,
+                "without": {self.filenames[i]: self.parity[i+1] for i in range(len(self.parity) - 1)},
+            },
+            "q_parity": {
+                name[3:]: count for name, count in zip(self.q_pattern_names(), self.q_parity)
+            } if self.checking_q() else {},
+            "bootsector": self.first_potential_bootsector_found_on,
+            "efi_part": self.first_potential_efi_part_found_on,
+            "signatures": {
+                name: dict(zip(self.filenames, counts.tolist()))
+                for name, counts in zip(SIGNATURE_NAMES, self.signature_hits.counts()) if name in self.signatures
+            },
+            "signature_hits": self.signature_hits.to_dict(self.filenames),
+            "parity_check_log": {
+                "patterns": self.parity_runs.names,
+                "runs": [[int(s) + 1, int(e), int(p)] for s, e, p in zip(self.parity_runs.starts(), self.parity_runs.ends(), self.parity_runs.patterns())],
+            } if self.parity_runs is not None else {},
+            "analysis_block_entropy": self.analysis_block_entropy,
+            "timers": self.timers.to_dict(),
+        }
+
+
+    def write_report(self, report_file=None):
+        if report_file is None:
+            report_file = f"raidalyzer_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
+
+        write_html_report(self, report_file)
+        return report_file
+
+
+def zero_runs(mask, min_run):
+    # Split a boolean stripe mask into (start, end, is_zero_run) segments, only runs
+    # of at least min_run True values count as zero runs
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    starts, ends = edges[0::2], edges[1::2]
+    keep = (ends - starts) >= min_run
+
+    segments = []
+    position = 0
+    for start, end in zip(starts[keep].tolist(), ends[keep].tolist()):
+        if start > position:
+            segments.append((position, start, False))
+        segments.append((start, end, True))
+        position = end
+    if position < len(mask):
+        segments.append((position, len(mask), False))
+    return segments
+
+
+def find_data_sector(file, bs=512, threshold=2.5, start_sector=0, chunk_sectors=10000):
+    # Search the first sector with an entropy above the threshold, returns (sector, entropy) or None
+    index = load_index(file, bs)
+    if index is not None:
+        return find_data_sector_in_index(index, threshold, start_sector, chunk_sectors * 100)
+
+    reader = ImageReader(file, bs=bs, use_mmap=True)
+    try:
+        sector_index = start_sector
+        while sector_index < reader.sectors:
+            sectors = reader.view(sector_index, chunk_sectors)
+            entropy = batch_entropy(sectors)
+
+            hits = np.flatnonzero(entropy > threshold)
+            if len(hits):
+                return sector_index + int(hits[0]), float(entropy[hits[0]])
+
+            sector_index += len(sectors)
+    finally:
+        reader.close()
+
+    return None
+
+
+def find_data_sector_in_index(index, threshold=2.5, start_sector=0, chunk_sectors=1000000):
+    # Same search on the quantized entropy of a sector index
+    try:
+        sector_index = start_sector
+        while sector_index < index.sectors:
+            entropy = index.entropy(sector_index, chunk_sectors)
+
+            hits = np.flatnonzero(entropy > threshold)
+            if len(hits):
+                return sector_index + int(hits[0]), float(entropy[hits[0]])
+
+            sector_index += len(entropy)
+    finally:
+        index.close()
+
+    return None
@@ -0,0 +1,284 @@
+import os
+import time
+import errno
+import threading
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+from .paritylog import UNKNOWN_PATTERN, ZERO_PATTERN
+from .reader import ImageReader, aligned_buffer
+
+
+# Writes a replacement member image from segments of the analyzed range. Each
+# segment is (from_sector, to_sector, sources) with to_sector excluded and sector 0
+# at the analysis start: one source image is copied, several are XORed (e.g. all
+# present members of a RAID5 to rebuild the missing one). The first segment also
+# covers the sectors in front of the analysis start, the last one runs to the end
+# of its sources. Sector k of the output is sector k + offsets[i] of image i.
+
+COPY_ERRORS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF)
+
+
+def pattern_files(name):
+    # Sets of file names in parity of a parity check log pattern, e.g.
+    # "02.img + 03.img / 01.img + 03.img | Q: ..." gives two sets
+    xor = name.split(" | ")[0]
+    if xor in (ZERO_PATTERN, UNKNOWN_PATTERN, "NO_MATCH"):
+        return []
+    return [set(combination.split(" + ")) for combination in xor.split(" / ")]
+
+
+def stitch_plan(runs, filenames, candidates):
+    # Segments choosing, for every run of the parity check log, which of the two
+    # candidate images of the same member holds valid data: the one in parity with
+    # the other members while the second one is left out. Runs which don't tell
+    # (zero stripes, no match, both or neither in parity) keep the source of the
+    # run before them, leading ones the source of the first decided run.
+    if len(candidates) != 2:
+        raise ValueError("Stitching needs the two images of the same member")
+
+    choice = np.full(len(runs.names), -1, dtype=np.int64)
+    for pattern, name in enumerate(runs.names):
+        valid = [c for c in candidates if any(filenames[c] in files and not any(filenames[o] in files for o in candidates if o != c)
+                                              for files in pattern_files(name))]
+        if len(valid) == 1:
+            choice[pattern] = valid[0]
+
+    sources = choice[runs.patterns()]
+    decided = sources >= 0
+    if not decided.any():
+        raise ValueError("No run of the parity check log shows which of the images is valid")
+
+    owner = np.maximum.accumulate(np.where(decided, np.arange(len(sources)), -1))
+    owner[owner < 0] = np.argmax(decided)
+    sources = sources[owner]
+
+    changes = np.concatenate(([0], np.flatnonzero(sources[1:] != sources[:-1]) + 1))
+    starts = runs.starts()[changes]
+    ends = np.append(starts[1:], np.uint64(runs.end))
+    return [(int(s), int(e), (int(source),)) for s, e, source in zip(starts, ends, sources[changes])]
+
+
+def rebuild_plan(sources):
+    # One segment rebuilding the whole member as the XOR of the source images
+    return [(0, None, tuple(sources))]
+
+
+def format_plan(plan, filenames, start_sector=0):
+    # One "from - to : source" line per segment in sectors of the output image
+    lines = []
+    for k, (from_sector, to_sector, sources) in enumerate(plan):
+        first = 0 if k == 0 else from_sector + start_sector
+        last = "end" if k == len(plan) - 1 or to_sector is None else to_sector + start_sector - 1
+        source = filenames[sources[0]] if len(sources) == 1 else "XOR " + " + ".join(filenames[i] for i in sources)
+        lines.append(f"{first} - {last} : {source}")
+    return "\n".join(lines)
+
+
+class ImageExporter:
+    # Writes the segments with worker threads, each one handling whole chunks of
+    # buffer_size bytes at their own positions: image stretches are copied with
+    # os.copy_file_range() where available (in the kernel, without passing the
+    # data through Python), XOR stretches are read into aligned buffers and XORed
+    # as 64 bit words. Reading and XOR release the GIL, so the threads keep several
+    # disks and cores busy. All-zero chunks are skipped in a new output file,
+    # which stays sparse there.
+    def __init__(self, files, bs=512, start_sector=0, offsets=None, buffer_size=16 << 20, threads=None):
+        self.files = list(files)
+        self.bs = bs
+        self.start_sector = start_sector
+        self.offsets = list(offsets) if offsets is not None else [0 for x in self.files]
+        self.chunk_sectors = max(buffer_size // bs, 1)
+        self.threads = threads or min(os.cpu_count() or 1, 8)
+        self.use_copy_file_range = hasattr(os, "copy_file_range")
+        self.path = None
+        self.sparse = False                     # Output is a new regular file, zero chunks stay holes
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.handles = []
+
+        # Sectors of each image from output sector 0 on
+        self.sectors = []
+        for file, offset in zip(self.files, self.offsets):
+            reader = ImageReader(file, bs=bs)
+            self.sectors.append(max(reader.sectors - offset, 0))
+            reader.close()
+
+
+    def output_segments(self, plan):
+        # Plan in output sectors, from sector 0 to the end of the last sources
+        segments = []
+        for k, (from_sector, to_sector, sources) in enumerate(plan):
+            first = 0 if k == 0 else from_sector + self.start_sector
+            if k == len(plan) - 1 or to_sector is None:
+                last = min(self.sectors[i] for i in sources)
+            else:
+                last = to_sector + self.start_sector
+            if last > first:
+                segments.append((first, last, tuple(sources)))
+        return segments
+
+
+    def chunks(self, segments):
+        # (sector, count, sources) in chunk_sectors steps, split at multiples of
+        # the chunk size so the reads and writes stay aligned
+        for first, last, sources in segments:
+            sector = first
+            while sector < last:
+                end = min((sector // self.chunk_sectors + 1) * self.chunk_sectors, last)
+                yield sector, end - sector, sources
+                sector = end
+
+
+    def thread_state(self):
+        # Readers, output handle and buffers of the calling worker thread
+        state = getattr(self.local, "state", None)
+        if state is None:
+            state = {
+                "readers": [ImageReader(file, bs=self.bs) for file in self.files],
+                "out": open(self.path, "r+b", buffering=0),
+                "xor": aligned_buffer(self.chunk_sectors * self.bs).reshape(-1, self.bs),
+                "read": aligned_buffer(self.chunk_sectors * self.bs).reshape(-1, self.bs),
+            }
+            with self.lock:
+                self.handles.append(state)
+            self.local.state = state
+        return state
+
+
+    def write_chunk(self, sector, count, sources):
+        state = self.thread_state()
+        copied = 0
+        if len(sources) == 1 and self.use_copy_file_range and not state["readers"][sources[0]].compressed:
+            copied = self.copy_range(state, sector, count, sources[0])
+            if copied is None:
+                copied = 0
+            elif copied == count:
+                return count, copied
+
+        # The rest of the chunk (all of it without copy_file_range), zeros past
+        # the end of the sources, so a device target doesn't keep its old data
+        data = state["xor"][:count - copied]
+        done = self.read_source(state, sector + copied, sources[0], data)
+        for i in sources[1:]:
+            read = state["read"][:count - copied]
+            done = min(done, self.read_source(state, sector + copied, i, read))
+            if data.shape[1] % 8 == 0:
+                np.bitwise_xor(data.view(np.uint64), read.view(np.uint64), out=data.view(np.uint64))
+            else:
+                np.bitwise_xor(data, read, out=data)
+
+        if not self.sparse or data.any():
+            self.write_at(state["out"], (sector + copied) * self.bs, data)
+        return count, copied + done
+
+
+    def read_source(self, state, sector, i, out):
+        # Read into out, zeros past the end of the image
+        done = state["readers"][i].readinto(sector + self.offsets[i], out)
+        out[done:] = 0
+        return done
+
+
+    def copy_range(self, state, sector, count, i):
+        # Copy count sectors of image i in the kernel, None if it's not supported here
+        src, dst = state["readers"][i].handle.fileno(), state["out"].fileno()
+        src_pos, dst_pos = (sector + self.offsets[i]) * self.bs, sector * self.bs
+        remaining = min(count, max(self.sectors[i] - sector, 0)) * self.bs
+        try:
+            while remaining > 0:
+                n = os.copy_file_range(src, dst, remaining, src_pos, dst_pos)
+                if n == 0:
+                    break
+                src_pos, dst_pos, remaining = src_pos + n, dst_pos + n, remaining - n
+        except OSError as e:
+            if e.errno not in COPY_ERRORS or dst_pos != sector * self.bs:
+                raise
+            self.use_copy_file_range = False
+            return None
+        return (dst_pos // self.bs) - sector
+
+
+    def write_at(self, out, position, data):
+        view = memoryview(data.reshape(-1))
+        out.seek(position)
+        while len(view):
+            n = out.write(view)
+            view = view[n:]
+
+
+    def export(self, path, plan, progress=None, cancel_event=None):
+        # Write the output image, returns a summary or None if cancelled
+        segments = self.output_segments(plan)
+        total = sum(last - first for first, last, sources in segments)
+        size = segments[-1][1] * self.bs if segments else 0
+
+        # A new or regular output file is truncated to its size (holes read as zeros),
+        # a device is written completely
+        self.path = path
+        self.sparse = not os.path.exists(path) or os.path.isfile(path)
+        with open(path, "wb" if self.sparse else "r+b") as f:
+            if self.sparse:
+                f.truncate(size)
+
+        start = time.perf_counter()
+        done, short = 0, 0
+        cancelled = False
+        try:
+            with ThreadPoolExecutor(self.threads) as pool:
+                pending = set()
+                for chunk in self.chunks(segments):
+                    if cancel_event is not None and cancel_event.is_set():
+                        cancelled = True
+                        break
+                    # Keep a few chunks per thread in flight to bound the memory
+                    if len(pending) >= 2 * self.threads:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            count, read = future.result()
+                            done, short = done + count, short + count - read
+                        if progress is not None:
+                            progress(done, total)
+                    pending.add(pool.submit(self.write_chunk, *chunk))
+
+                for future in pending:
+                    count, read = future.result()
+                    done, short = done + count, short + count - read
+        finally:
+            for state in self.handles:
+                for reader in state["readers"]:
+                    reader.close()
+                state["out"].close()
+            self.handles = []
+            self.local = threading.local()
+
+        if progress is not None:
+            progress(done, total)
+        if cancelled:
+            return None
+
+        seconds = time.perf_counter() - start
+        return {
+            "path": path,
+            "sectors": total,
+            "bytes": size,
+            "copied": sum(last - first for first, last, sources in segments if len(sources) == 1),
+            "rebuilt": sum(last - first for first, last, sources in segments if len(sources) > 1),
+            "short": short,
+            "segments": len(segments),
+            "seconds": seconds,
+            "mib_per_second": total * self.bs / max(seconds, 1e-9) / (1 << 20),
+            "copy_file_range": self.use_copy_file_range,
+        }
+
+
+def format_export(summary):
+    text = (f"{summary['path']}: {summary['sectors']} sectors in {summary['segments']} segments "
+            f"({summary['copied']} copied, {summary['rebuilt']} rebuilt by XOR), "
+            f"{summary['seconds']:.1f} s, {summary['mib_per_second']:.1f} MiB/s")
+    if summary["short"]:
+        text += f"\n{summary['short']} sectors were past the end of a source image and written as zeros"
+    return text
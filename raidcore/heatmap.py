@@ -0,0 +1,137 @@
+import base64
+
+import numpy as np
+
+from .index import ENTROPY_SCALE
+
+
+# The analyzed range is split into this many LBA regions, whatever its size
+HEATMAP_REGIONS = 512
+
+# Counters of every image per region: zero, pattern and known (read) sectors and
+# the entropy sum in 1/ENTROPY_SCALE bits per byte
+IMAGE_FIELDS = ("zero", "pattern", "known", "entropy")
+
+
+class RegionHeatmap:
+    # Counters of a fixed number of equally sized LBA regions of the analyzed
+    # range, filled during the pass for the heatmaps of the report. The memory
+    # doesn't grow with the range: a few ten KB even for 20 images. The regions
+    # are the same in every shard (they only depend on the whole range), so
+    # partial heatmaps are merged by adding them up.
+    def __init__(self, files, total_sectors, regions=HEATMAP_REGIONS):
+        self.files = files
+        self.total_sectors = total_sectors
+        self.regions = max(min(regions, total_sectors), 1)
+        self.region_sectors = max(-(-total_sectors // self.regions), 1)
+        self.images = {field: np.zeros((files, self.regions), dtype=np.int64) for field in IMAGE_FIELDS}
+
+        # Checked stripes, and those in parity with all images and without each one
+        self.stripes = np.zeros(self.regions, dtype=np.int64)
+        self.parity = np.zeros((files + 1, self.regions), dtype=np.int64)
+
+
+    def region_counts(self, positions, weights=None):
+        # Sum of weights (or count) of the sorted sector positions per region,
+        # as (first region, sums)
+        index = np.minimum(positions // self.region_sectors, self.regions - 1)
+        first = int(index[0])
+        counts = np.bincount(index - first, weights=weights)
+        return first, np.rint(counts).astype(np.int64) if weights is not None else counts
+
+
+    def add(self, i, sector, zero, pattern, entropy, known=None):
+        # Sectors of image i from sector on, only those in the optional known mask
+        # if given (zero, pattern and entropy are then of the known sectors only)
+        positions = sector + (np.flatnonzero(known) if known is not None else np.arange(len(zero)))
+        if len(positions) == 0:
+            return
+        values = {
+            "zero": np.asarray(zero, dtype=np.float64),
+            "pattern": np.asarray(pattern, dtype=np.float64),
+            "known": None,
+            "entropy": np.rint(np.asarray(entropy) * ENTROPY_SCALE),
+        }
+        for field, weights in values.items():
+            first, counts = self.region_counts(positions, weights)
+            self.images[field][i, first:first + len(counts)] += counts
+
+
+    def add_parity(self, sector, full, without):
+        # Parity matches of the stripes from sector on
+        if len(full) == 0:
+            return
+        positions = sector + np.arange(len(full))
+        first, counts = self.region_counts(positions)
+        self.stripes[first:first + len(counts)] += counts
+        for row, matches in enumerate([full] + list(without)):
+            first, counts = self.region_counts(positions, np.asarray(matches, dtype=np.float64))
+            self.parity[row, first:first + len(counts)] += counts
+
+
+    def add_zero_run(self, sector, count):
+        # A run of stripes which are zero on all images: every combination is in parity
+        zero = np.ones(count, dtype=bool)
+        for i in range(self.files):
+            self.add(i, sector, zero, ~zero, np.zeros(count))
+        self.add_parity(sector, zero, [zero if self.files > 1 else ~zero for x in range(self.files)])
+
+
+    def extend(self, other):
+        # Add the counters of another part of the same range, e.g. of a shard
+        if (other.regions, other.region_sectors) != (self.regions, self.region_sectors):
+            raise ValueError("Heatmaps of different ranges can't be merged")
+        for field in IMAGE_FIELDS:
+            self.images[field] += other.images[field]
+        self.stripes += other.stripes
+        self.parity += other.parity
+
+
+    def fractions(self):
+        # {name: (rows, regions) array of 0..1, NaN where nothing is known} for
+        # the zero, pattern and entropy (of 8 bits) share of every image and the
+        # parity matches with all images and without each one
+        with np.errstate(divide="ignore", invalid="ignore"):
+            known = np.where(self.images["known"] > 0, self.images["known"], np.nan)
+            stripes = np.where(self.stripes > 0, self.stripes, np.nan)
+            return {
+                "zero": self.images["zero"] / known,
+                "pattern": self.images["pattern"] / known,
+                "entropy": self.images["entropy"] / known / ENTROPY_SCALE / 8,
+                "parity": self.parity / stripes,
+            }
+
+
+    def to_state(self):
+        # JSON serializable form, see load_heatmap()
+        arrays = [self.images[field] for field in IMAGE_FIELDS] + [self.stripes[None], self.parity]
+        return {
+            "files": self.files,
+            "total_sectors": self.total_sectors,
+            "regions": self.regions,
+            "counts": base64.b64encode(np.concatenate(arrays).astype("<i8").tobytes()).decode("ascii"),
+        }
+
+
+def load_heatmap(state):
+    # RegionHeatmap from its to_state() form
+    heatmap = RegionHeatmap(state["files"], state["total_sectors"], state["regions"])
+    counts = np.frombuffer(base64.b64decode(state["counts"]), dtype="<i8").reshape(-1, heatmap.regions)
+    files = heatmap.files
+    for k, field in enumerate(IMAGE_FIELDS):
+        heatmap.images[field][:] = counts[k * files:(k + 1) * files]
+    heatmap.stripes[:] = counts[len(IMAGE_FIELDS) * files]
+    heatmap.parity[:] = counts[len(IMAGE_FIELDS) * files + 1:]
+    return heatmap
+
+
+def merge_heatmaps(heatmaps):
+    # One heatmap of all given parts, None if there are none
+    merged = None
+    for heatmap in heatmaps:
+        if heatmap is None:
+            continue
+        if merged is None:
+            merged = RegionHeatmap(heatmap.files, heatmap.total_sectors, heatmap.regions)
+        merged.extend(heatmap)
+    return merged
@@ -0,0 +1,338 @@
+import os
+import struct
+import threading
+
+import numpy as np
+
+from .classify import classify_sectors
+from .compressed import sidecar_paths
+from .mirrors import _splitmix64
+from .raid6 import gf_mul_table
+from .reader import ImageReader, image_size
+from .signatures import HIT_DTYPE, scan_signatures
+
+
+# Sidecar index with one compact record per sector of an image. It is stored next
+# to the image ("disk.img.rdxidx") or, if that directory is not writable, in the
+# user cache directory, and is only used while size and mtime of the image match.
+# The records are followed by the signature hits of the image (see signatures.py).
+INDEX_SUFFIX = ".rdxidx"
+INDEX_MAGIC = b"RDXIDX\x00\x03"
+INDEX_HEADER = struct.Struct("<8sIIQqQQ")  # magic, entropy scale, sector size, image size, mtime (ns), sectors, signature hits
+INDEX_HEADER_SIZE = 64
+
+# Record flags
+FLAG_ZERO = 0x01
+FLAG_PATTERN = 0x02
+FLAG_BOOTSECTOR = 0x04      # 0x55AA in the last 2 bytes
+FLAG_EFI_PART = 0x08        # "EFI PART" at the start
+FLAG_UNKNOWN = 0x10         # Unreadable, skipped while indexing
+
+# Entropy is stored as floor(entropy * ENTROPY_SCALE). As the scale is a multiple of
+# 10, the 0.1 steps of the entropy graph come out the same as from the exact value.
+ENTROPY_SCALE = 8000
+
+RECORD_DTYPE = np.dtype([
+    ('flags', '<u1'),
+    ('entropy', '<u2'),
+    ('fingerprint', '<u8'),
+])
+
+
+_fingerprint_tables = {}
+
+
+def fingerprint_table(bs):
+    # Table of the fingerprint of every byte value at every position of a sector.
+    # Byte k of each entry is the byte value times a random coefficient of the
+    # position in GF(2^8), so the fingerprint is linear over XOR, fp(a ^ b) ==
+    # fp(a) ^ fp(b), and over the RAID6 multiplications: multiplying every byte of
+    # a sector by g multiplies every byte of its fingerprint by g. Equal sectors
+    # have equal fingerprints, the fingerprints of a stripe in parity XOR to 0 and
+    # those of a RAID6 stripe pass the Q check (see raid6.py).
+    table = _fingerprint_tables.get(bs)
+    if table is None:
+        coefficients = _splitmix64(bs, seed=0x52414944414C5A52, odd=False).view(np.uint8).reshape(bs, 8)
+        products = gf_mul_table()[coefficients].transpose(0, 2, 1)
+        table = np.ascontiguousarray(products).view('<u8').reshape(bs, 256).astype(np.uint64)
+        _fingerprint_tables[bs] = table
+    return table
+
+
+def linear_fingerprints(sectors):
+    # 64 bit linear fingerprint of each sector of a (sectors, bs) uint8 array
+    n, bs = sectors.shape
+    table = fingerprint_table(bs)
+    return np.bitwise_xor.reduce(table[np.arange(bs), sectors], axis=1)
+
+
+def sector_records(sectors):
+    # Index records of a (sectors, bs) uint8 array
+    zero, pattern, entropy = classify_sectors(sectors)
+
+    records = np.zeros(sectors.shape[0], dtype=RECORD_DTYPE)
+    flags = zero * FLAG_ZERO + pattern * FLAG_PATTERN
+    flags |= ((sectors[:, -2] == 0x55) & (sectors[:, -1] == 0xAA)) * FLAG_BOOTSECTOR
+    if sectors.shape[1] >= 8:
+        flags |= (sectors[:, :8] == np.frombuffer(b"EFI PART", dtype=np.uint8)).all(axis=1) * FLAG_EFI_PART
+
+    records['flags'] = flags
+    records['entropy'] = np.floor(entropy * ENTROPY_SCALE)
+    records['fingerprint'] = linear_fingerprints(sectors)
+    return records
+
+
+def index_paths(image):
+    # Candidate locations of the index of an image, the sidecar file first
+    return sidecar_paths(image, INDEX_SUFFIX)
+
+
+def image_identity(image):
+    st = os.stat(image)
+    return image_size(image), st.st_mtime_ns
+
+
+class SectorIndex:
+    # Read-only, memory mapped index of one image
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(INDEX_HEADER_SIZE)
+        if len(header) < INDEX_HEADER_SIZE or header[:8] != INDEX_MAGIC:
+            raise ValueError(f"Not a RaidAlyzer index: {path}")
+
+        magic, self.entropy_scale, self.bs, self.image_size, self.mtime_ns, self.sectors, self.hit_count = INDEX_HEADER.unpack_from(header)
+        hits_offset = INDEX_HEADER_SIZE + self.sectors * RECORD_DTYPE.itemsize
+        if os.path.getsize(path) < hits_offset + self.hit_count * HIT_DTYPE.itemsize:
+            raise ValueError(f"Truncated RaidAlyzer index: {path}")
+
+        self.records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=INDEX_HEADER_SIZE, shape=(self.sectors,)) if self.sectors else np.zeros(0, dtype=RECORD_DTYPE)
+        self.hits = np.memmap(path, dtype=HIT_DTYPE, mode="r", offset=hits_offset, shape=(self.hit_count,)) if self.hit_count else np.zeros(0, dtype=HIT_DTYPE)
+
+
+    def close(self):
+        self.records = None
+        self.hits = None
+
+
+    def matches(self, image, bs):
+        # True if the index was built for the current state of the image
+        try:
+            size, mtime_ns = image_identity(image)
+        except OSError:
+            return False
+        return self.bs == bs and self.image_size == size and self.mtime_ns == mtime_ns and self.entropy_scale == ENTROPY_SCALE
+
+
+    def entropy(self, start_sector, count):
+        return self.records['entropy'][start_sector:start_sector + count] / self.entropy_scale
+
+
+    def signature_hits(self, start_sector, count):
+        # Signature hits in the sector range, sorted by sector
+        first, last = np.searchsorted(self.hits['sector'], [start_sector, start_sector + count])
+        return np.array(self.hits[first:last])
+
+
+def load_index(image, bs=512):
+    # Valid index of the image or None
+    for path in index_paths(image):
+        if not os.path.exists(path):
+            continue
+        try:
+            index = SectorIndex(path)
+        except (OSError, ValueError):
+            continue
+        if index.matches(image, bs):
+            return index
+        index.close()
+    return None
+
+
+def has_index(image, bs=512):
+    index = load_index(image, bs)
+    if index is None:
+        return False
+    index.close()
+    return True
+
+
+def build_index(image, bs=512, chunk_sectors=16384, cancel_event=None, progress=None):
+    # Read the image once and write its index, returns the index path or None if
+    # cancelled. The index is written to a temporary file and renamed when complete.
+    size, mtime_ns = image_identity(image)
+    reader = ImageReader(image, bs=bs)
+    try:
+        last_error = None
+        for path in index_paths(image):
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                out = open(path + ".tmp", "wb")
+            except OSError as e:
+                last_error = e
+                continue
+            break
+        else:
+            raise last_error
+
+        try:
+            out.write(b"\0" * INDEX_HEADER_SIZE)
+            buffer = np.empty((chunk_sectors, bs), dtype=np.uint8)
+            unknown = np.zeros(chunk_sectors, dtype=bool)
+            hits = []
+            sector = 0
+            while sector < reader.sectors:
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+
+                # Holes of sparse images are zero sectors without reading them
+                holes = reader.hole_end(sector) - sector
+                if holes:
+                    count = min(holes, chunk_sectors)
+                    records = np.zeros(count, dtype=RECORD_DTYPE)
+                    records['flags'] = FLAG_ZERO
+                else:
+                    unknown[:] = False
+                    count = reader.readinto(sector, buffer, unknown)
+                    if count == 0:
+                        break
+                    records = sector_records(buffer[:count])
+                    if unknown[:count].any():
+                        # Zero filled by the reader, but not known to be zero
+                        records[unknown[:count]] = (FLAG_UNKNOWN, 0, 0)
+                    found = scan_signatures(buffer[:count])
+                    found['sector'] += np.uint64(sector)
+                    hits.append(found)
+
+                out.write(records.tobytes())
+                sector += count
+                if progress is not None:
+                    progress(sector, reader.sectors)
+
+            hits = np.concatenate(hits) if hits else np.zeros(0, dtype=HIT_DTYPE)
+            out.write(hits.tobytes())
+
+            complete = sector >= reader.sectors
+            out.seek(0)
+            out.write(INDEX_HEADER.pack(INDEX_MAGIC, ENTROPY_SCALE, bs, size, mtime_ns, sector, len(hits)).ljust(INDEX_HEADER_SIZE, b"\0"))
+        finally:
+            out.close()
+
+        if not complete:
+            os.remove(path + ".tmp")
+            return None
+
+        os.replace(path + ".tmp", path)
+        return path
+    finally:
+        reader.close()
+
+
+class IndexWorker:
+    # Builds the missing indexes of a set of images in background threads, one per image
+    def __init__(self, files, bs=512):
+        self.files = list(files)
+        self.bs = bs
+        self.cancel_event = threading.Event()
+        self.progress = [0 for x in self.files]
+        self.totals = [max(image_size(file) // bs, 1) for file in self.files]
+        self.errors = []
+        self.threads = []
+
+
+    def start(self):
+        for i, file in enumerate(self.files):
+            if has_index(file, self.bs):
+                self.progress[i] = self.totals[i]
+                continue
+
+            thread = threading.Thread(target=self.run, args=(i,), name=f"raidalyzer-index-{i}", daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+
+    def run(self, i):
+        def progress(sector, sectors):
+            self.progress[i] = sector
+
+        try:
+            build_index(self.files[i], bs=self.bs, cancel_event=self.cancel_event, progress=progress)
+        except Exception as e:
+            self.errors.append(e)
+
+
+    def fraction(self):
+        return sum(self.progress) / sum(self.totals) if self.totals else 1.0
+
+
+    def cancel(self):
+        self.cancel_event.set()
+
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+    def is_alive(self):
+        return any(thread.is_alive() for thread in self.threads)
+
+
+class MultiIndexReader:
+    # Serves (files, sectors) record arrays of the same sector range of all images,
+    # the index counterpart of reader.MultiImageReader, with last_unknown set
+    # from the sectors skipped as unreadable while indexing
+    def __init__(self, paths, bs=512, offsets=None):
+        self.bs = bs
+        self.last_unknown = None
+        self.indexes = []
+        for path in paths:
+            index = load_index(path, bs)
+            if index is None:
+                self.close()
+                raise ValueError(f"No valid index for {path}")
+            self.indexes.append(index)
+
+        self.offsets = list(offsets) if offsets is not None else [0 for x in self.indexes]
+        self.max_sectors = max(min((index.sectors - offset for index, offset in zip(self.indexes, self.offsets)), default=0), 0)
+
+
+    def close(self):
+        for index in self.indexes:
+            index.close()
+        self.indexes = []
+
+
+    def read_batch(self, start_sector, count):
+        end = min(start_sector + count, self.max_sectors)
+        if end <= start_sector:
+            self.last_unknown = None
+            return np.zeros((len(self.indexes), 0), dtype=RECORD_DTYPE)
+        return self.result(np.stack([index.records[start_sector + offset:end + offset] for index, offset in zip(self.indexes, self.offsets)]))
+
+
+    def read_stripes(self, positions):
+        positions = np.asarray(positions, dtype=np.int64)
+        positions = positions[:int(np.searchsorted(positions, self.max_sectors))]
+        return self.result(np.stack([index.records[positions + offset] for index, offset in zip(self.indexes, self.offsets)]))
+
+
+    def result(self, records):
+        unknown = (records['flags'] & FLAG_UNKNOWN) != 0
+        self.last_unknown = unknown if unknown.any() else None
+        return records
+
+
+    def signature_hits(self, start_sector, count):
+        # Signature hits of each image in the sector range, with sectors relative to start_sector
+        hits = []
+        for index, offset in zip(self.indexes, self.offsets):
+            found = index.signature_hits(start_sector + offset, min(count, self.max_sectors - start_sector))
+            found['sector'] -= np.uint64(start_sector + offset)
+            hits.append(found)
+        return hits
+
+
+    def zero_run(self, start_sector, count):
+        # All-zero stripes are recognized from the flags by the engine
+        return 0
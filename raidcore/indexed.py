@@ -0,0 +1,130 @@
+import numpy as np
+
+from .engine import RaidAnalysisEngine, zero_runs
+from .index import ENTROPY_SCALE, FLAG_BOOTSECTOR, FLAG_EFI_PART, FLAG_PATTERN, FLAG_ZERO, MultiIndexReader, has_index
+from .parity import parity_matches
+from .raid6 import q_matches
+from .reader import MultiImageReader
+from .signatures import SIGNATURE_NAMES
+
+
+def indexes_available(files, bs=512):
+    # True if every image has a valid index
+    return bool(files) and all(has_index(file, bs) for file in files)
+
+
+class IndexedAnalysisEngine(RaidAnalysisEngine):
+    # Answers the analysis from the sector indexes of the images (see index.py)
+    # instead of reading the images. Zero/pattern counts and signature hits are
+    # exact, the entropy is rounded down to 1/ENTROPY_SCALE. Mirrors, parity and the
+    # RAID6 Q check are computed on the linear fingerprints: a stripe in parity always
+    # has fingerprints XORing to 0 (and a valid Q), a false match needs a 64 bit
+    # collision. With verify_parity the (few) candidate stripes are read and confirmed.
+    def __init__(self, files, bs=512, verify_parity=False, **kwargs):
+        kwargs["processes"] = 1
+        super().__init__(files, bs=bs, **kwargs)
+        self.verify_parity = verify_parity
+        self.image_reader = None
+
+
+    def open_reader(self):
+        if self.verify_parity:
+            self.image_reader = MultiImageReader(self.files, bs=self.bs, batch_sectors=self.chunk_sectors, offsets=self.disk_offsets)
+        return MultiIndexReader(self.files, bs=self.bs, offsets=self.disk_offsets)
+
+
+    def close(self):
+        super().close()
+        if self.image_reader is not None:
+            self.image_reader.close()
+            self.image_reader = None
+
+
+    def status_text(self):
+        return super().status_text() + " from index"
+
+
+    def check_signatures(self, flags):
+        # The index holds every signature hit, the first ones are taken from the flags
+        start = self.analysis_start_sector + self.offset
+        recorded = [SIGNATURE_NAMES.index(name) for name in self.signatures]
+        for i, hits in enumerate(self.reader.signature_hits(start, flags.shape[1])):
+            self.signature_hits.add(i, hits[np.isin(hits['signature'], recorded)], self.sector_base + self.offset)
+
+        if self.bootsector_hit is None:
+            hits = (flags & FLAG_BOOTSECTOR) != 0
+            if hits.any():
+                sector, i = np.unravel_index(np.argmax(hits.T), hits.T.shape)
+                self.set_signature_hits(bootsector=(self.sector_base + self.offset + int(sector), int(i)))
+
+        if self.efi_part_hit is None:
+            hits = (flags & FLAG_EFI_PART) != 0
+            if hits.any():
+                sector, i = np.unravel_index(np.argmax(hits.T), hits.T.shape)
+                self.set_signature_hits(efi_part=(self.sector_base + self.offset + int(sector), int(i)))
+
+
+    def process_readable(self, records):
+        zero_stripes = ((records['flags'] & FLAG_ZERO) != 0).all(axis=0)
+        for start, end, zero in zero_runs(zero_stripes, self.min_zero_run):
+            if zero:
+                with self.timers.stage("zero_runs", sectors=(end - start) * len(self.files)):
+                    self.process_zero_run(end - start)
+            else:
+                self.process_stripes(records[:, start:end])
+
+
+    def process_unknown(self, records, unknown):
+        # Sectors skipped as unreadable while indexing
+        with self.timers.stage("signatures", sectors=records.shape[0] * records.shape[1], nbytes=records.nbytes):
+            self.check_signatures(records['flags'])
+        self.count_unknown(records, unknown)
+
+
+    def classify(self, records):
+        flags = records['flags']
+        return (flags & FLAG_ZERO) != 0, (flags & FLAG_PATTERN) != 0, records['entropy'] / ENTROPY_SCALE
+
+
+    def process_stripes(self, records):
+        files, sectors = records.shape
+        flags = records['flags']
+        with self.timers.stage("signatures", sectors=files * sectors, nbytes=records.nbytes):
+            self.check_signatures(flags)
+
+        with self.timers.stage("classify", sectors=files * sectors, nbytes=records.nbytes):
+            for i in range(files):
+                self.update_stats(i, *self.classify(records[i]))
+
+        # The 8 byte fingerprints stand in for the sectors
+        fingerprints = np.ascontiguousarray(records['fingerprint']).view(np.uint8).reshape(files, sectors, 8)
+        with self.timers.stage("mirrors", sectors=files * sectors, nbytes=fingerprints.nbytes):
+            self.update_mirrors(fingerprints)
+        with self.timers.stage("parity", sectors=files * sectors, nbytes=fingerprints.nbytes):
+            self.update_parity(fingerprints)
+        self.offset += sectors
+
+
+    def update_parity(self, fingerprints):
+        full, without = parity_matches(fingerprints)
+        q = q_matches(fingerprints, self.q_subsets) if self.checking_q() else None
+
+        if self.image_reader is not None:
+            # Only stripes matching on the fingerprints can be in parity
+            matching = full | without.any(axis=0)
+            if q is not None:
+                matching |= q.any(axis=0)
+            candidates = np.flatnonzero(matching)
+            if len(candidates):
+                positions = self.analysis_start_sector + self.offset + candidates
+                with self.timers.stage("read") as counts:
+                    batch = self.image_reader.read_stripes(positions)
+                    counts["sectors"] = batch.shape[0] * batch.shape[1]
+                    counts["bytes"] = batch.nbytes
+                confirmed_full, confirmed_without = parity_matches(batch)
+                done = candidates[:batch.shape[1]]
+                full[done] = confirmed_full
+                without[:, done] = confirmed_without
+                if q is not None:
+                    q[:, done] = q_matches(batch, self.q_subsets)
+        self.count_parity(full, without, q)
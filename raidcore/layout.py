@@ -0,0 +1,217 @@
+import itertools
+
+import numpy as np
+
+from .classify import classify_sectors
+from .index import ENTROPY_SCALE, MultiIndexReader
+from .indexed import indexes_available
+from .parity import parity_matches
+from .reader import MultiImageReader
+
+
+# Candidate stripe (chunk) sizes in bytes, 4 KiB to 4 MiB
+STRIPE_SIZES = [4096 << k for k in range(11)]
+
+# Parity rotations as named by Linux md
+RAID5_LAYOUTS = ["left-asymmetric", "left-symmetric", "right-asymmetric", "right-symmetric"]
+
+# Disk orders are searched exhaustively up to this many disks, a beam search is used above
+EXHAUSTIVE_DISKS = 8
+
+
+def layout_rows(level, layout, disks):
+    # One (parity position, [data positions in logical order]) entry per row of the
+    # rotation period, e.g. left-symmetric on 4 disks starts with (3, [0, 1, 2])
+    if level == "RAID0":
+        return [(None, list(range(disks)))]
+
+    rows = []
+    for row in range(disks):
+        parity = disks - 1 - row if layout.startswith("left") else row
+        if layout.endswith("asymmetric"):
+            data = [k if k < parity else k + 1 for k in range(disks - 1)]
+        else:
+            data = [(parity + 1 + k) % disks for k in range(disks - 1)]
+        rows.append((parity, data))
+    return rows
+
+
+def raid6_rows(layout, disks):
+    # One (P position, Q position, [data positions in logical order]) entry per row
+    # of the rotation period as Linux md places them: Q follows P, the data is
+    # ascending (asymmetric) or starts after Q (symmetric)
+    rows = []
+    for parity, data in layout_rows("RAID5", layout, disks):
+        q = (parity + 1) % disks
+        if layout.endswith("asymmetric"):
+            data = [k for k in range(disks) if k != parity and k != q]
+        else:
+            data = [(q + 1 + k) % disks for k in range(disks - 2)]
+        rows.append((parity, q, data))
+    return rows
+
+
+def layout_signals(files, bs=512, start_sector=0, sectors=1 << 21, chunk_sectors=16384, offsets=None):
+    # Per sector entropy (0 for zero and pattern sectors) of all images and the
+    # full parity flag of every stripe, from the sector indexes if available
+    if indexes_available(files, bs):
+        reader = MultiIndexReader(files, bs=bs, offsets=offsets)
+        try:
+            records = reader.read_batch(start_sector, sectors)
+            entropy = (records['entropy'] / ENTROPY_SCALE).astype(np.float32)
+            parity = ~np.bitwise_xor.reduce(records['fingerprint'], axis=0).astype(bool)
+            return entropy, parity
+        finally:
+            reader.close()
+
+    reader = MultiImageReader(files, bs=bs, batch_sectors=chunk_sectors, offsets=offsets)
+    try:
+        count = max(min(sectors, reader.max_sectors - start_sector), 0)
+        entropy = np.zeros((len(files), count), dtype=np.float32)
+        parity = np.zeros(count, dtype=bool)
+
+        done = 0
+        while done < count:
+            batch = reader.read_batch(start_sector + done, min(chunk_sectors, count - done))
+            if batch.shape[1] == 0:
+                break
+            for i in range(len(files)):
+                entropy[i, done:done + batch.shape[1]] = classify_sectors(batch[i])[2]
+            parity[done:done + batch.shape[1]] = parity_matches(batch)[0]
+            done += batch.shape[1]
+
+        return entropy[:, :done], parity[:done]
+    finally:
+        reader.close()
+
+
+def boundary_similarity(entropy, chunk):
+    # Similarity of the last sector of each chunk to the first sector of every chunk
+    # in the same and the next row, as (same, next) arrays of shape (files, files, rows - 1)
+    files, sectors = entropy.shape
+    rows = sectors // chunk
+    ends = entropy[:, chunk - 1:rows * chunk:chunk]
+    starts = entropy[:, 0:rows * chunk:chunk]
+
+    same = -np.abs(ends[:, None, :-1] - starts[None, :, :-1])
+    following = -np.abs(ends[:, None, :-1] - starts[None, :, 1:])
+    return same, following
+
+
+def residue_means(values, period):
+    # Mean over the rows of each residue of the row index modulo period, the rows
+    # are the last axis. Returns an array with the residue as last axis.
+    rows = values.shape[-1] // period * period
+    return values[..., :rows].reshape(values.shape[:-1] + (rows // period, period)).mean(axis=-2)
+
+
+def order_scores(orders, pairs, singles):
+    # Score of every candidate order (array of shape (candidates, disks) holding
+    # the image at each position): the sum of pairs[pa, pb][image at pa, image at pb]
+    # and singles[p][image at p]
+    scores = np.zeros(len(orders), dtype=np.float64)
+    for (pa, pb), matrix in pairs.items():
+        scores += matrix[orders[:, pa], orders[:, pb]]
+    for p, vector in singles.items():
+        scores += vector[orders[:, p]]
+    return scores
+
+
+def best_orders(disks, pairs, singles, top=5, beam=4096):
+    # Best disk orders, exhaustively for few disks, else by a beam search which
+    # assigns the positions one by one and keeps the best partial orders
+    if disks <= EXHAUSTIVE_DISKS:
+        orders = np.array(list(itertools.permutations(range(disks))), dtype=np.intp)
+        scores = order_scores(orders, pairs, singles)
+    else:
+        orders = np.arange(disks, dtype=np.intp)[:, None]
+        for position in range(1, disks):
+            used = np.zeros((len(orders), disks), dtype=bool)
+            np.put_along_axis(used, orders, True, axis=1)
+            parent, image = np.nonzero(~used)
+            orders = np.column_stack([orders[parent], image])
+
+            partial_pairs = {key: m for key, m in pairs.items() if max(key) <= position}
+            partial_singles = {key: v for key, v in singles.items() if key <= position}
+            scores = order_scores(orders, partial_pairs, partial_singles)
+            keep = np.argsort(-scores, kind='stable')[:beam]
+            orders, scores = orders[keep], scores[keep]
+
+    best = np.argsort(-scores, kind='stable')[:top]
+    return [(orders[i].tolist(), float(scores[i])) for i in best]
+
+
+def detect_layout(entropy, parity, bs=512, stripe_sizes=STRIPE_SIZES, top=10, parity_threshold=0.5, parity_weight=0.25):
+    # Rank (level, stripe size, rotation, disk order) hypotheses.
+    #
+    # Logically consecutive chunks usually continue the same kind of content (zeros,
+    # text, compressed data, ...), so the last sector of a chunk resembles the first
+    # sector of the chunk the hypothesis says comes next. Sectors on the same disk
+    # across a real chunk boundary are not consecutive, so the score of a hypothesis
+    # is its mean boundary similarity minus that of staying on the same disk. With
+    # parity, the parity chunks get a bonus for an entropy above the data chunks.
+    #
+    # The boundary similarities only depend on the row within the rotation period,
+    # so they are averaged into per position pair matrices once per stripe size and
+    # every disk order is scored with a few table lookups.
+    files, sectors = entropy.shape
+    levels = [("RAID0", None)]
+    if files > 2 and len(parity) and np.count_nonzero(parity) >= parity_threshold * len(parity):
+        levels += [("RAID5", layout) for layout in RAID5_LAYOUTS]
+
+    # How much above the other images each sector's entropy is
+    excess = entropy - (entropy.sum(axis=0) - entropy) / max(files - 1, 1)
+
+    hypotheses = []
+    for stripe_size in stripe_sizes:
+        chunk = stripe_size // bs
+        rows = sectors // chunk
+        if chunk < 1 or rows < 2 * files:
+            continue    # Too few rows for a reliable score, larger sizes have even fewer
+
+        same, following = boundary_similarity(entropy, chunk)
+        baseline = float(np.mean([following[i, i].mean() for i in range(files)]))
+        row_excess = excess[:, :rows * chunk].reshape(files, rows, chunk).mean(axis=2)
+
+        means = {}
+        for level, layout in levels:
+            period = layout_rows(level, layout, files)
+            if len(period) not in means:
+                means[len(period)] = (residue_means(same, len(period)), residue_means(following, len(period)), residue_means(row_excess, len(period)))
+            same_means, following_means, excess_means = means[len(period)]
+
+            pairs = {}
+            singles = {}
+            transitions = 0
+            weight = 1 / len(period)
+            for residue, (parity_position, data) in enumerate(period):
+                steps = [(a, b, same_means) for a, b in zip(data[:-1], data[1:])]
+                steps.append((data[-1], period[(residue + 1) % len(period)][1][0], following_means))
+                for a, b, similarity in steps:
+                    pairs[(a, b)] = pairs.get((a, b), 0) + weight * similarity[:, :, residue]
+                transitions += weight * len(steps)
+
+                if parity_position is not None:
+                    singles[parity_position] = singles.get(parity_position, 0) + parity_weight * weight * excess_means[:, residue]
+
+            pairs = {key: matrix / transitions for key, matrix in pairs.items()}
+            for order, score in best_orders(files, pairs, singles, top=top):
+                hypotheses.append({
+                    "level": level,
+                    "stripe_size": stripe_size,
+                    "layout": layout or "",
+                    "order": order,
+                    "score": score - baseline,
+                })
+
+    hypotheses.sort(key=lambda h: -h["score"])
+    return hypotheses[:top]
+
+
+def format_layouts(hypotheses, filenames):
+    text = " #  LEVEL  STRIPE SIZE  ROTATION             SCORE  DISK ORDER\n"
+    for idx, h in enumerate(hypotheses):
+        size = f"{h['stripe_size'] // 1024} KiB" if h['stripe_size'] < 1 << 20 else f"{h['stripe_size'] >> 20} MiB"
+        order = ", ".join(filenames[i] for i in h['order'])
+        text += f"{idx:>2}  {h['level']:<5}  {size:>11}  {h['layout']:<17}  {h['score']:>8.4f}  {order}\n"
+    return text
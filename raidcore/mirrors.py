@@ -0,0 +1,116 @@
+import numpy as np
+
+from .parity import as_words
+
+
+def _splitmix64(count, seed=0x9E3779B97F4A7C15, odd=True):
+    # Deterministic (by default odd) 64 bit constants, one per word position in a sector
+    values = []
+    state = seed
+    for _ in range(count):
+        state = (state + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        z = state
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+        z ^= z >> 31
+        values.append(z | 1 if odd else z)
+    return np.array(values, dtype=np.uint64)
+
+
+_constants = {}
+
+
+def fingerprint_sectors(words):
+    # 64 bit non-cryptographic fingerprint of every sector in a (files, sectors, words) array.
+    # Every word is multiplied with a constant for its position, so equal words at
+    # different positions do not cancel out when the products are XORed together.
+    words = words.astype(np.uint64, copy=False)
+    width = words.shape[-1]
+    constants = _constants.get(width)
+    if constants is None:
+        constants = _constants[width] = _splitmix64(width)
+
+    mixed = words * constants
+    mixed ^= mixed >> np.uint64(31)
+    h = np.bitwise_xor.reduce(mixed, axis=-1)
+
+    # Final avalanche so the low bits depend on all input bits
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xFF51AFD7ED558CCD)
+    h ^= h >> np.uint64(33)
+    return h
+
+
+def group_labels(fingerprints):
+    # For every (file, stripe) the lowest file index with the same fingerprint in that stripe
+    files, sectors = fingerprints.shape
+    order = np.argsort(fingerprints, axis=0, kind='stable')
+    ordered = np.take_along_axis(fingerprints, order, axis=0)
+
+    # Position of the first member of each group in sorted order. The stable sort
+    # keeps equal fingerprints in file order, so that member has the lowest index.
+    starts = np.ones((files, sectors), dtype=bool)
+    starts[1:] = ordered[1:] != ordered[:-1]
+    first = np.where(starts, np.arange(files)[:, None], 0)
+    first = np.maximum.accumulate(first, axis=0)
+
+    labels = np.empty_like(order)
+    np.put_along_axis(labels, order, np.take_along_axis(order, first, axis=0), axis=0)
+    return labels
+
+
+def pair_counts(labels):
+    # Sum up the mirror matrix for stripes given as label vectors (files, stripes)
+    files = labels.shape[0]
+    counts = np.zeros((files, files), dtype=np.int64)
+    if labels.shape[1] == 0:
+        return counts
+
+    # Stripes of a region usually share the same grouping, so each distinct
+    # grouping is only expanded to a pair matrix once
+    unique, occurrences = np.unique(labels.T, axis=0, return_counts=True)
+    for grouping, occurrence in zip(unique, occurrences):
+        counts += occurrence * (grouping[:, None] == grouping[None, :])
+
+    np.fill_diagonal(counts, 0)
+    return counts
+
+
+def exact_pair_counts(words):
+    # Byte for byte comparison of every pair, used for stripes with a fingerprint collision
+    files = words.shape[0]
+    counts = np.zeros((files, files), dtype=np.int64)
+    for i in range(files):
+        for j in range(i + 1, files):
+            same = int(np.count_nonzero((words[i] == words[j]).all(axis=-1)))
+            counts[i, j] += same
+            counts[j, i] += same
+    return counts
+
+
+def mirror_counts(batch, fingerprints=None):
+    # Mirror matrix increments for a (files, sectors, bs) batch: counts[i, j] is the
+    # number of stripes where file i and file j hold identical sectors
+    words = as_words(batch)
+    files = words.shape[0]
+    if fingerprints is None:
+        fingerprints = fingerprint_sectors(words)
+
+    # Only stripes with at least two equal fingerprints can contain mirrored sectors
+    ordered = np.sort(fingerprints, axis=0)
+    candidates = np.flatnonzero((ordered[1:] == ordered[:-1]).any(axis=0))
+    if len(candidates) == 0:
+        return np.zeros((files, files), dtype=np.int64)
+
+    labels = group_labels(fingerprints[:, candidates])
+    words = words[:, candidates]
+
+    # Confirm each group member against its representative with a real compare
+    representatives = np.take_along_axis(words, labels[:, :, None], axis=0)
+    confirmed = (words == representatives).all(axis=-1)
+    collisions = ~confirmed.all(axis=0)
+
+    counts = pair_counts(labels[:, ~collisions])
+    if collisions.any():
+        counts += exact_pair_counts(words[:, collisions])
+    return counts
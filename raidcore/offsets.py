@@ -0,0 +1,166 @@
+import numpy as np
+
+from .classify import classify_sectors
+from .index import FLAG_ZERO, ENTROPY_SCALE, MultiIndexReader, load_index
+from .indexed import indexes_available
+from .parity import parity_matches
+from .reader import ImageReader, MultiImageReader
+
+
+def sector_signals(file, bs=512, sectors=1 << 20, chunk_sectors=16384):
+    # Zero flags and entropy of the first sectors of one image, from its index if available
+    index = load_index(file, bs)
+    if index is not None:
+        try:
+            records = np.array(index.records[:sectors])
+            return (records['flags'] & FLAG_ZERO) != 0, (records['entropy'] / ENTROPY_SCALE).astype(np.float32)
+        finally:
+            index.close()
+
+    reader = ImageReader(file, bs=bs)
+    try:
+        count = min(sectors, reader.sectors)
+        zero = np.zeros(count, dtype=bool)
+        entropy = np.zeros(count, dtype=np.float32)
+        buffer = np.empty((chunk_sectors, bs), dtype=np.uint8)
+
+        done = 0
+        while done < count:
+            read = reader.readinto(done, buffer[:min(chunk_sectors, count - done)])
+            if read == 0:
+                break
+            chunk_zero, chunk_pattern, chunk_entropy = classify_sectors(buffer[:read])
+            zero[done:done + read] = chunk_zero
+            entropy[done:done + read] = chunk_entropy
+            done += read
+
+        return zero[:done], entropy[:done]
+    finally:
+        reader.close()
+
+
+def correlation_signal(zero, entropy):
+    # Standardized zero and entropy channels as a (2, sectors) array
+    channels = np.stack([zero.astype(np.float64), entropy.astype(np.float64)])
+    channels -= channels.mean(axis=1, keepdims=True)
+    deviation = channels.std(axis=1, keepdims=True)
+    deviation[deviation == 0] = 1
+    return channels / deviation
+
+
+def cross_correlation(reference, signal, max_lag):
+    # Correlation of reference sector t with sector t + lag of signal for every lag in
+    # [-max_lag, max_lag], summed over the channels and normalized by the overlap.
+    # Computed with one FFT per channel, so millions of lags cost about as much as one.
+    length = max(reference.shape[1], signal.shape[1])
+    size = 1 << int(2 * length - 1).bit_length()
+
+    spectrum = np.zeros(size // 2 + 1, dtype=np.complex128)
+    for a, b in zip(reference, signal):
+        spectrum += np.conj(np.fft.rfft(a, size)) * np.fft.rfft(b, size)
+    correlation = np.fft.irfft(spectrum, size)
+
+    lags = np.arange(-max_lag, max_lag + 1)
+    overlap = np.minimum(reference.shape[1], signal.shape[1] - lags) - np.maximum(0, -lags)
+    scores = correlation[lags % size] / np.maximum(overlap, 1) / len(reference)
+    scores[overlap < max(length // 4, 1)] = -np.inf    # Too little overlap to tell
+    return lags, scores
+
+
+def correlation_peaks(lags, scores, count=8, spacing=16):
+    # Best lags, each at least spacing sectors away from a better one
+    scores = scores.copy()
+    peaks = []
+    for x in range(count):
+        best = int(np.argmax(scores))
+        if not np.isfinite(scores[best]):
+            break
+        peaks.append((int(lags[best]), float(scores[best])))
+        scores[max(best - spacing, 0):best + spacing + 1] = -np.inf
+    return peaks
+
+
+def parity_rate(files, bs, offsets, samples=4096):
+    # Fraction of the non-zero stripes at sampled positions which are in XOR parity
+    # (with all images or one left out) when image i starts at offsets[i]
+    base = min(offsets)
+    offsets = [offset - base for offset in offsets]
+
+    if indexes_available(files, bs):
+        reader = MultiIndexReader(files, bs=bs, offsets=offsets)
+    else:
+        reader = MultiImageReader(files, bs=bs, batch_sectors=samples, offsets=offsets)
+    try:
+        if reader.max_sectors == 0:
+            return 0.0
+        positions = np.unique(np.linspace(0, reader.max_sectors - 1, samples).astype(np.int64))
+        batch = reader.read_stripes(positions)
+        if batch.dtype.names is not None:
+            # Index records, their fingerprints are linear over XOR
+            zero = ((batch['flags'] & FLAG_ZERO) != 0).all(axis=0)
+            batch = np.ascontiguousarray(batch['fingerprint']).view(np.uint8).reshape(batch.shape + (8,))
+        else:
+            zero = ~batch.any(axis=(0, 2))
+
+        full, without = parity_matches(batch)
+        hits = (full | without.any(axis=0)) & ~zero
+        return float(np.count_nonzero(hits)) / max(int(np.count_nonzero(~zero)), 1)
+    finally:
+        reader.close()
+
+
+def detect_offsets(files, bs=512, window=1 << 18, sectors=None, candidates=8, good_parity=0.95):
+    # Suggest a start offset in sectors for each image relative to the others.
+    #
+    # Zero regions and the kind of data usually line up across the members of an
+    # array, so the per sector zero/entropy signals of each image are correlated
+    # with those of the first image over lags of up to +/- window sectors. With 3
+    # or more images the best correlation peaks of each image are then compared by
+    # the share of sampled stripes in XOR parity, the other images held at their
+    # current best offset, until good_parity of the stripes are in parity. The
+    # images without any offset are tried as well.
+    if sectors is None:
+        sectors = 4 * window
+
+    signals = [correlation_signal(*sector_signals(file, bs=bs, sectors=sectors)) for file in files]
+    peaks = [[(0, 1.0)]]
+    correlations = [None]
+    for signal in signals[1:]:
+        lags, scores = cross_correlation(signals[0], signal, window)
+        peaks.append(correlation_peaks(lags, scores, count=candidates) or [(0, 0.0)])
+        correlations.append(scores)
+
+    lags = [p[0][0] for p in peaks]
+    rate = None
+    if len(files) >= 3:
+        # Images without any offset are the usual case, start from the better guess
+        rate = parity_rate(files, bs, lags)
+        aligned = parity_rate(files, bs, [0 for x in files])
+        if aligned >= rate:
+            lags, rate = [0 for x in files], aligned
+        for i in range(1, len(files)):
+            for lag, score in peaks[i][1:]:
+                if rate >= good_parity:
+                    break
+                trial = lags[:i] + [lag] + lags[i+1:]
+                trial_rate = parity_rate(files, bs, trial)
+                if trial_rate > rate:
+                    lags, rate = trial, trial_rate
+
+    base = min(lags)
+    result = []
+    for i, file in enumerate(files):
+        correlation = 1.0 if i == 0 else float(correlations[i][lags[i] + window])
+        result.append({"file": file, "offset": lags[i] - base, "correlation": correlation})
+
+    return {"offsets": [r["offset"] for r in result], "disks": result, "parity_rate": rate}
+
+
+def format_offsets(result, filenames):
+    text = " #  FILE                   OFFSET  CORRELATION\n"
+    for idx, disk in enumerate(result["disks"]):
+        text += f"{idx:>2}  {filenames[idx][:20]:<20}  {disk['offset']:>7}  {disk['correlation']:>11.3f}\n"
+
+    if result["parity_rate"] is not None:
+        text += f"\nStripes in parity with these offsets: {result['parity_rate'] * 100:.1f}%\n"
+    return text
@@ -0,0 +1,36 @@
+import numpy as np
+
+
+def as_words(batch):
+    # View a (files, sectors, bs) uint8 batch as machine words without copying
+    batch = np.ascontiguousarray(batch)
+    if batch.shape[-1] % 8 == 0:
+        return batch.view(np.uint64)
+    return batch
+
+
+def parity_matches(batch):
+    # XOR parity over a whole batch of stripes.
+    #
+    # Returns (full, without) where full[s] is True if the XOR of all files is zero
+    # for stripe s, and without[i, s] is True if the XOR of all files except file i
+    # is zero. Leaving one file out only needs the full XOR: the remaining files are
+    # in parity exactly when the total equals the excluded block.
+    words = as_words(batch)
+    files, sectors = words.shape[:2]
+
+    total = np.bitwise_xor.reduce(words, axis=0)
+    full = ~total.any(axis=1)
+
+    without = np.zeros((files, sectors), dtype=bool)
+    if files > 1:
+        for i in range(files):
+            without[i] = (total == words[i]).all(axis=1)
+
+    return full, without
+
+
+def match_matrix(full, without):
+    # Stack the results as (sectors, files + 1) with full parity in column 0
+    return np.column_stack([full] + list(without))
+
@@ -0,0 +1,222 @@
+import base64
+
+import numpy as np
+
+
+# One run of stripes with the same parity check pattern: its first sector (relative
+# to the analysis start) and the interned pattern, 10 bytes per run. A run ends
+# where the next one starts, the last one at the end of the analyzed range.
+RUN_DTYPE = np.dtype([
+    ('start', '<u8'),
+    ('pattern', '<u2'),
+])
+
+# Stripes where every combination is in parity, i.e. all sectors are zero
+ZERO_PATTERN = "ZERO STRIPE (all patterns)"
+
+# Stripes with an unreadable sector, not checked
+UNKNOWN_PATTERN = "UNKNOWN (unreadable sectors)"
+
+
+class ParityRunLog:
+    # Run-length encoded parity check log. The pattern names (e.g. "01.img + 02.img
+    # | Q: ...") are interned, the runs kept in a growing array, so millions of runs
+    # take a few ten MB and ranges are found by binary search.
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.runs = np.zeros(1024, dtype=RUN_DTYPE)
+        self.count = 0
+        self.end = 0
+
+
+    def __len__(self):
+        return self.count
+
+
+    def intern(self, name):
+        pattern = self.ids.get(name)
+        if pattern is None:
+            if len(self.names) > np.iinfo(RUN_DTYPE['pattern']).max:
+                raise ValueError("Too many parity check patterns")
+            pattern = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return pattern
+
+
+    def starts(self):
+        return self.runs['start'][:self.count]
+
+
+    def patterns(self):
+        return self.runs['pattern'][:self.count]
+
+
+    def last_pattern(self):
+        return int(self.runs['pattern'][self.count - 1]) if self.count else None
+
+
+    def append(self, starts, patterns, end):
+        # Add the stripes from starts[0] to end, stripe starts[k] and the following
+        # ones have patterns[k]. Runs continuing the previous pattern are dropped.
+        starts = np.asarray(starts, dtype=np.uint64)
+        patterns = np.asarray(patterns, dtype=np.uint16)
+        if len(starts):
+            previous = np.empty(len(patterns), dtype=np.int64)
+            previous[0] = -1 if self.count == 0 else self.last_pattern()
+            previous[1:] = patterns[:-1]
+            keep = patterns != previous
+            starts, patterns = starts[keep], patterns[keep]
+
+            if self.count + len(starts) > len(self.runs):
+                runs = np.zeros(max(2 * len(self.runs), self.count + len(starts)), dtype=RUN_DTYPE)
+                runs[:self.count] = self.runs[:self.count]
+                self.runs = runs
+            self.runs['start'][self.count:self.count + len(starts)] = starts
+            self.runs['pattern'][self.count:self.count + len(starts)] = patterns
+            self.count += len(starts)
+
+        self.end = max(self.end, end)
+
+
+    def extend(self, other):
+        # Append the log of the following sector range, e.g. of the next shard
+        remap = np.array([self.intern(name) for name in other.names], dtype=np.uint16)
+        self.append(other.starts(), remap[other.patterns()] if len(remap) else other.patterns(), other.end)
+
+
+    def ends(self):
+        ends = np.empty(self.count, dtype=np.uint64)
+        ends[:-1] = self.starts()[1:]
+        if self.count:
+            ends[-1] = self.end
+        return ends
+
+
+    def ranges(self, first=0, count=None):
+        # Runs first to first + count as (from_sector, to_sector, pattern) with the
+        # last sector included, e.g. one page of the report. As in the log files of
+        # earlier versions the sectors are numbered from 1 at the analysis start.
+        last = self.count if count is None else min(first + count, self.count)
+        starts, patterns = self.starts()[first:last], self.patterns()[first:last]
+        ends = self.starts()[first + 1:last + 1]
+        if last == self.count:
+            ends = np.append(ends, np.uint64(self.end))
+        return [(int(s) + 1, int(e), self.names[p]) for s, e, p in zip(starts, ends, patterns)]
+
+
+    def query(self, from_sector, to_sector):
+        # Runs overlapping the sectors from_sector to to_sector (included, numbered
+        # like ranges()), clipped to them
+        first = max(int(np.searchsorted(self.starts(), from_sector - 1, side='right')) - 1, 0)
+        last = int(np.searchsorted(self.starts(), to_sector - 1, side='right'))
+        return [(max(s, from_sector), min(e, to_sector), name) for s, e, name in self.ranges(first, last - first) if e >= from_sector]
+
+
+    def pattern_at(self, sector):
+        if not self.count or sector >= self.end:
+            return None
+        index = int(np.searchsorted(self.starts(), sector, side='right')) - 1
+        return self.names[self.runs['pattern'][index]] if index >= 0 else None
+
+
+    def merged(self, min_sectors):
+        # Copy with the noise removed: runs shorter than min_sectors count to the run
+        # before them (leading ones to the first longer run). This is done for twice
+        # the length each round, so the short runs within a long range of the same
+        # pattern join it before they could outweigh it.
+        merged = ParityRunLog()
+        merged.names, merged.ids = list(self.names), dict(self.ids)
+        merged.append(self.starts(), self.patterns(), self.end)
+
+        length = 1
+        while length < min_sectors and len(merged) > 1:
+            length = min(2 * length, min_sectors)
+            lengths = merged.ends().astype(np.int64) - merged.starts().astype(np.int64)
+            keep = lengths >= length
+            if not keep.any():
+                continue
+
+            owner = np.maximum.accumulate(np.where(keep, np.arange(len(merged)), -1))
+            owner[owner < 0] = np.argmax(keep)
+            starts, patterns = merged.starts().copy(), merged.patterns()[owner]
+            merged.count = 0
+            merged.append(starts, patterns, self.end)
+        return merged
+
+
+    def pattern_sectors(self):
+        # {pattern: sectors} over the whole log
+        lengths = self.ends().astype(np.int64) - self.starts().astype(np.int64)
+        totals = np.bincount(self.patterns(), weights=lengths, minlength=len(self.names))
+        return {name: int(total) for name, total in zip(self.names, totals) if total}
+
+
+    def nbytes(self):
+        return self.runs.nbytes
+
+
+    def format(self, first=0, count=None):
+        return "".join(f"{from_sec} - {to_sec} : {pattern}\n" for from_sec, to_sec, pattern in self.ranges(first, count))
+
+
+    def write(self, path, page=100000):
+        # Complete log as text, one "from - to : pattern" line per run
+        with open(path, "w") as f:
+            for first in range(0, self.count, page):
+                f.write(self.format(first, page))
+
+
+    def to_state(self):
+        # JSON serializable form, see load_parity_runs()
+        return {
+            "names": list(self.names),
+            "runs": base64.b64encode(self.runs[:self.count].tobytes()).decode("ascii"),
+            "end": self.end,
+        }
+
+
+def load_parity_runs(state):
+    # ParityRunLog from its to_state() form
+    log = ParityRunLog()
+    for name in state["names"]:
+        log.intern(name)
+    runs = np.frombuffer(base64.b64decode(state["runs"]), dtype=RUN_DTYPE)
+    log.append(runs['start'], runs['pattern'], state["end"])
+    return log
+
+
+def read_parity_log(path):
+    # ParityRunLog from the text written by ParityRunLog.write(), e.g. with
+    # analyze --parity-log. Runs of the same pattern are read in batches.
+    log = ParityRunLog()
+    starts, patterns = [], []
+    end = 0
+    with open(path, "r") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                sectors, name = line.rstrip("\n").split(" : ", 1)
+                from_sector, to_sector = (int(value) for value in sectors.split(" - "))
+            except ValueError:
+                raise ValueError(f"{path}, line {number}: no \"from - to : pattern\" parity check log line")
+            starts.append(from_sector - 1)
+            patterns.append(log.intern(name))
+            end = to_sector
+            if len(starts) >= 100000:
+                log.append(starts, patterns, end)
+                starts, patterns = [], []
+    log.append(starts, patterns, end)
+    return log
+
+
+def parity_runs_from_dict(data):
+    # ParityRunLog from the "parity_check_log" of RaidAnalysisEngine.to_dict(),
+    # numbered like ParityRunLog.ranges()
+    log = ParityRunLog()
+    for name in data["patterns"]:
+        log.intern(name)
+    runs = np.array(data["runs"], dtype=np.uint64).reshape(-1, 3)
+    log.append(runs[:, 0] - np.uint64(1), runs[:, 2], int(runs[-1, 1]) if len(runs) else 0)
+    return log
@@ -0,0 +1,209 @@
+import base64
+
+import numpy as np
+
+from .classify import classify_sectors
+from .index import ENTROPY_SCALE
+from .reader import ImageReader
+
+
+# Sectors per bin of the finest level, 2 MiB with 512 byte sectors. A bin of an
+# image takes 12 bytes, so the base level is about 6 MB per TB and image, the
+# coarser levels (LEVEL_FACTOR bins each) add a third to that.
+PYRAMID_BIN_SECTORS = 4096
+LEVEL_FACTOR = 4
+
+# Entropy in 1/ENTROPY_SCALE bits per byte, min/max/sum of the known sectors
+BIN_DTYPE = np.dtype([
+    ('min', '<u2'),
+    ('max', '<u2'),
+    ('sum', '<u4'),
+    ('zero', '<u2'),
+    ('known', '<u2'),
+])
+
+# Bins of the coarser levels, computed from the base level when viewed
+LEVEL_DTYPE = np.dtype([
+    ('min', '<u2'),
+    ('max', '<u2'),
+    ('sum', '<u8'),
+    ('zero', '<u8'),
+    ('known', '<u8'),
+])
+
+EMPTY_MIN = np.iinfo(BIN_DTYPE['min']).max
+
+# Ranges up to this many sectors are read from the images for the view
+RAW_VIEW_SECTORS = 16384
+
+
+def empty_bins(files, count, dtype=BIN_DTYPE):
+    bins = np.zeros((files, count), dtype=dtype)
+    bins['min'] = EMPTY_MIN
+    return bins
+
+
+class EntropyPyramid:
+    # Min/mean/max entropy and zero fraction of every image in bins of
+    # PYRAMID_BIN_SECTORS sectors (relative to the analysis start), filled during
+    # the full pass. The base level grows like the parity run log and is merged
+    # the same way for shards and checkpoints. Level l has bins of
+    # LEVEL_FACTOR ** l base bins, so any range is drawn from a few thousand bins.
+    # Unreadable sectors are no known sectors, a bin without any shows as a gap.
+    def __init__(self, files, bin_sectors=PYRAMID_BIN_SECTORS):
+        self.files = files
+        self.bin_sectors = bin_sectors
+        self.first_bin = 0
+        self.count = 0
+        self.bins = empty_bins(files, 256)
+        self.levels = {}                        # Level: (first bin, bins), cleared by every change
+
+
+    def __len__(self):
+        return self.count
+
+
+    def end_sector(self):
+        return (self.first_bin + self.count) * self.bin_sectors
+
+
+    def grow(self, first_bin, end_bin):
+        # Make room for the bins first_bin to end_bin, which can't be before the first one
+        if self.count == 0:
+            self.first_bin = first_bin
+        elif first_bin < self.first_bin:
+            raise ValueError("Entropy pyramid bins can only be added in order")
+        count = max(end_bin - self.first_bin, self.count)
+        if count > self.bins.shape[1]:
+            bins = empty_bins(self.files, max(2 * self.bins.shape[1], count))
+            bins[:, :self.count] = self.bins[:, :self.count]
+            self.bins = bins
+        self.count = count
+        self.levels = {}
+
+
+    def combine(self, rows, first_bin, bins):
+        # Add the bins of the images rows, starting at first_bin
+        self.grow(first_bin, first_bin + bins.shape[1])
+        target = self.bins[rows, first_bin - self.first_bin:first_bin - self.first_bin + bins.shape[1]]
+        target['min'] = np.minimum(target['min'], bins['min'])
+        target['max'] = np.maximum(target['max'], bins['max'])
+        for key in ('sum', 'zero', 'known'):
+            target[key] += bins[key]
+        self.bins[rows, first_bin - self.first_bin:first_bin - self.first_bin + bins.shape[1]] = target
+
+
+    def add(self, i, sector, zero, entropy, known=None):
+        # Sectors of image i from sector on, only those in the optional known mask
+        # if given (zero and entropy are then of the known sectors only)
+        positions = sector + (np.flatnonzero(known) if known is not None else np.arange(len(zero)))
+        if len(positions) == 0:
+            return
+        values = np.rint(np.asarray(entropy) * ENTROPY_SCALE).astype(np.uint32)
+        bins = positions // self.bin_sectors
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+        first, last = int(bins[0]), int(bins[-1])
+
+        added = empty_bins(1, last - first + 1)
+        index = bins[starts] - first
+        added['min'][0, index] = np.minimum.reduceat(values, starts)
+        added['max'][0, index] = np.maximum.reduceat(values, starts)
+        added['sum'][0, index] = np.add.reduceat(values, starts)
+        added['zero'][0, index] = np.add.reduceat(np.asarray(zero, dtype=np.uint32), starts)
+        added['known'][0, index] = np.diff(np.append(starts, len(positions)))
+        self.combine([i], first, added)
+
+
+    def add_zeros(self, sector, count):
+        # A run of stripes which are zero on all images
+        zero = np.ones(count, dtype=bool)
+        entropy = np.zeros(count)
+        for i in range(self.files):
+            self.add(i, sector, zero, entropy)
+
+
+    def extend(self, other):
+        # Add the pyramid of the following sector range, e.g. of the next shard
+        if other.count:
+            self.combine(slice(None), other.first_bin, other.bins[:, :other.count])
+
+
+    def level(self, level):
+        # (first bin, (files, bins) LEVEL_DTYPE array) of a level
+        if level not in self.levels:
+            size = LEVEL_FACTOR ** level
+            base = self.bins[:, :self.count]
+            groups = (self.first_bin + np.arange(self.count)) // size
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(groups)) + 1)) if self.count else np.zeros(0, dtype=np.intp)
+            bins = np.zeros((self.files, len(starts)), dtype=LEVEL_DTYPE)
+            if len(starts):
+                bins['min'] = np.minimum.reduceat(base['min'], starts, axis=1)
+                bins['max'] = np.maximum.reduceat(base['max'], starts, axis=1)
+                for key in ('sum', 'zero', 'known'):
+                    bins[key] = np.add.reduceat(base[key].astype(np.uint64), starts, axis=1)
+            first = int(groups[0]) if self.count else 0
+            self.levels[level] = (first, bins)
+        return self.levels[level]
+
+
+    def view(self, i, start, end, width):
+        # (edges, low, mean, high, zero fraction) of the bins of image i from start
+        # to end on the coarsest level with at least width bins there, edges holds
+        # the first sector of every bin and the end of the last, NaN for unknown bins
+        level = 0
+        while (end - start) // (self.bin_sectors * LEVEL_FACTOR ** (level + 1)) >= width and \
+                self.end_sector() > self.bin_sectors * LEVEL_FACTOR ** (level + 1):
+            level += 1
+
+        size = self.bin_sectors * LEVEL_FACTOR ** level
+        first, bins = self.level(level)
+        a = max(start // size, first)
+        b = min(-(-end // size), first + bins.shape[1])
+        rows = bins[i, a - first:max(b, a) - first]
+
+        known = rows['known'].astype(np.float64)
+        known[known == 0] = np.nan
+        low = np.where(rows['known'] > 0, rows['min'], np.nan) / ENTROPY_SCALE
+        high = np.where(rows['known'] > 0, rows['max'], np.nan) / ENTROPY_SCALE
+        return np.arange(a, max(b, a) + 1) * size, low, rows['sum'] / known / ENTROPY_SCALE, high, rows['zero'] / known
+
+
+    def nbytes(self):
+        return self.bins.nbytes
+
+
+    def to_state(self):
+        # JSON serializable form, see load_pyramid()
+        return {
+            "files": self.files,
+            "bin_sectors": self.bin_sectors,
+            "first_bin": self.first_bin,
+            "bins": base64.b64encode(np.ascontiguousarray(self.bins[:, :self.count]).tobytes()).decode("ascii"),
+        }
+
+
+def load_pyramid(state):
+    # EntropyPyramid from its to_state() form
+    pyramid = EntropyPyramid(state["files"], state["bin_sectors"])
+    bins = np.frombuffer(base64.b64decode(state["bins"]), dtype=BIN_DTYPE).reshape(state["files"], -1)
+    pyramid.combine(slice(None), state["first_bin"], bins)
+    return pyramid
+
+
+def raw_view(file, first_sector, start, end, bs=512):
+    # The deepest zoom: (edges, low, mean, high, zero fraction) like
+    # EntropyPyramid.view() with a bin per sector from start to end, read from the
+    # image where sector 0 is first_sector
+    count = max(end - start, 0)
+    reader = ImageReader(file, bs=bs)
+    try:
+        data = np.empty((count, bs), dtype=np.uint8)
+        unknown = np.zeros(count, dtype=bool)
+        count = reader.readinto(first_sector + start, data, unknown)
+    finally:
+        reader.close()
+
+    zero, pattern, entropy = classify_sectors(data[:count])
+    entropy = np.where(unknown[:count], np.nan, entropy)
+    zero = np.where(unknown[:count], np.nan, zero)
+    return np.arange(start, start + count + 1), entropy, entropy, entropy, zero
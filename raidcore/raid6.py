@@ -0,0 +1,112 @@
+import numpy as np
+
+from .parity import as_words
+
+
+# RAID6 Q syndrome as Linux md computes it: Q = sum of g**k * D_k over the data
+# blocks in GF(2^8) with the generator polynomial x^8 + x^4 + x^3 + x^2 + 1 (0x11d)
+# and g = 2. Multiplying by g is done for 8 bytes at once in 64 bit words, like
+# the int64 code of md, which needs no table lookups at all.
+GF_POLY = 0x11d
+
+_mul2_masks = {
+    np.dtype(np.uint64): (np.uint64(0x0101010101010101), np.uint64(0xFEFEFEFEFEFEFEFE), np.uint64(GF_POLY & 0xFF)),
+    np.dtype(np.uint8): (np.uint8(0x01), np.uint8(0xFE), np.uint8(GF_POLY & 0xFF)),
+}
+
+# The smallest RAID6 has two data blocks besides P and Q
+MIN_DISKS = 4
+
+
+def gf_mul2(words):
+    # Multiply every byte of a uint64 (or uint8) array by g
+    low, high, poly = _mul2_masks[words.dtype]
+    carry = (words >> words.dtype.type(7)) & low
+    return ((words << words.dtype.type(1)) & high) ^ (carry * poly)
+
+
+def gf_mul_table():
+    # Products of all pairs of bytes in GF(2^8), table[a, b] == a * b
+    table = np.zeros((256, 256), dtype=np.uint8)
+    values = np.arange(256)
+    power = np.arange(256, dtype=np.uint8)
+    for bit in range(8):
+        table[:, (values >> bit) & 1 == 1] ^= power[:, None]
+        power = gf_mul2(power)
+    return table
+
+
+def q_syndrome(data):
+    # Q syndrome of a sequence of (stripes, words) data blocks in data order
+    q = data[-1].copy()
+    for k in range(len(data) - 2, -1, -1):
+        q = gf_mul2(q)
+        q ^= data[k]
+    return q
+
+
+def q_subsets(files):
+    # Files left out of the Q check: none, each one and each pair, as far as at
+    # least MIN_DISKS files remain
+    subsets = [()]
+    subsets += [(i,) for i in range(files)]
+    subsets += [(i, j) for i in range(files) for j in range(i + 1, files)]
+    return [subset for subset in subsets if files - len(subset) >= MIN_DISKS]
+
+
+def q_matches(batch, subsets):
+    # For each subset of left out files and each stripe: True if the remaining files
+    # (in the given order) form a valid RAID6 stripe, i.e. one of them is a Q block
+    # over the data blocks with the P block right before it, as in all standard md
+    # layouts. The data order is tried ascending (asymmetric layouts) and starting
+    # after Q (symmetric layouts). Returns a (subsets, stripes) bool array.
+    words = as_words(batch)
+    files, stripes = words.shape[:2]
+
+    total = np.bitwise_xor.reduce(words, axis=0)
+    zero = ~words.any(axis=2)
+    zero_count = np.count_nonzero(zero, axis=0)
+    first = np.ascontiguousarray(words[:, :, 0])
+    total_first = np.ascontiguousarray(total[:, 0])
+
+    result = np.zeros((len(subsets), stripes), dtype=bool)
+    for k, excluded in enumerate(subsets):
+        members = [i for i in range(files) if i not in excluded]
+        count = len(members)
+
+        # Stripes of zeros are valid, the others need P and Q blocks
+        matched = zero_count - np.count_nonzero(zero[list(excluded)], axis=0) == count
+        subset_first = total_first ^ np.bitwise_xor.reduce(first[list(excluded)], axis=0)
+
+        # Q is the XOR of all members, P and the data cancel out. Compare the first
+        # word of all files and stripes at once before comparing whole blocks.
+        hits = first == subset_first
+        hits[list(excluded)] = False
+        for q in np.flatnonzero(hits.any(axis=1)):
+            candidates = np.flatnonzero(hits[q])
+            candidates = candidates[~matched[candidates]]
+            if len(candidates) == 0:
+                continue
+
+            subset_total = total[candidates]
+            for i in excluded:
+                subset_total ^= words[i, candidates]
+            candidates = candidates[(subset_total == words[q, candidates]).all(axis=1)]
+            if len(candidates) == 0:
+                continue
+
+            j = members.index(q)
+            p = members[j - 1]
+            q_block = words[q, candidates]
+            ascending = [i for i in members if i != p and i != q]
+            after_q = [members[(j + 1 + x) % count] for x in range(count - 2)]
+
+            blocks = {i: words[i, candidates] for i in ascending}
+            valid = (q_syndrome([blocks[i] for i in ascending]) == q_block).all(axis=1)
+            if after_q != ascending:
+                valid |= (q_syndrome([blocks[i] for i in after_q]) == q_block).all(axis=1)
+            matched[candidates[valid]] = True
+
+        result[k] = matched
+
+    return result
@@ -0,0 +1,533 @@
+import os
+import mmap
+import stat
+import queue
+import errno
+import threading
+
+import numpy as np
+
+from .compressed import CompressedImage, compressed_format, compressed_size
+
+
+# A failing read is tried this many more times before its sectors are skipped
+READ_RETRIES = 2
+
+# Sectors given up at once after a read failed, like a rescue imager skipping ahead
+SKIP_SECTORS = 128
+
+# O_DIRECT reads need buffers, offsets and lengths aligned to the logical block
+# size of the device, 4096 covers all of them
+DIRECT_ALIGNMENT = 4096
+DIRECT_BUFFER_SIZE = 4 << 20
+
+# Read ahead of the analysis: buffers per image and the size of each
+PREFETCH_DEPTH = 2
+PREFETCH_BUFFER_SIZE = 8 << 20
+
+
+def aligned_buffer(nbytes, alignment=DIRECT_ALIGNMENT):
+    # uint8 array of nbytes starting at a multiple of alignment in memory
+    raw = np.empty(nbytes + alignment, dtype=np.uint8)
+    skip = -raw.ctypes.data % alignment
+    return raw[skip:skip + nbytes]
+
+
+def is_block_device(path):
+    try:
+        return stat.S_ISBLK(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+def image_size(path):
+    # Size in bytes of an image file or a block device (whose st_size is 0), the
+    # uncompressed size of a compressed image
+    if is_block_device(path):
+        with open(path, 'rb', buffering=0) as f:
+            return f.seek(0, os.SEEK_END)
+    if compressed_format(path) is not None:
+        return compressed_size(path)
+    return os.path.getsize(path)
+
+
+class ImageReader:
+    # Positional sector reader for one image file or block device. Reads go straight
+    # into caller supplied buffers (readinto) or are served as views of a memory map,
+    # so no per-sector bytes objects are created.
+    #
+    # Block devices (or any image with direct=True) are read with O_DIRECT where
+    # available, through an aligned buffer, so the analysis doesn't push the page
+    # cache of e.g. a concurrently running imager out. Unreadable sectors don't
+    # stop the reading: see read_sectors().
+    #
+    # gzip, xz and bzip2 images are decompressed on the fly (see compressed.py),
+    # damaged compressed data reads like unreadable sectors.
+    def __init__(self, path, bs=512, use_mmap=False, direct=None, retries=READ_RETRIES, skip_sectors=SKIP_SECTORS):
+        self.path = path
+        self.bs = bs
+        self.device = is_block_device(path)
+        self.retries = retries
+        self.skip_sectors = max(skip_sectors, 1)
+        self.unreadable = []                    # [start sector, sectors] of the skipped ranges
+
+        self.direct = False
+        self.direct_buffer = None
+        self.compressed = not self.device and compressed_format(path) is not None
+        if self.compressed:
+            self.handle = CompressedImage(path)
+        elif getattr(os, "O_DIRECT", 0) and (direct or (direct is None and self.device)):
+            try:
+                self.handle = open(os.open(path, os.O_RDONLY | os.O_DIRECT), 'rb', buffering=0)
+                self.direct = True
+            except OSError as e:
+                if e.errno != errno.EINVAL:     # Not supported by the file system
+                    raise
+        if not self.direct and not self.compressed:
+            self.handle = open(path, 'rb', buffering=0)
+
+        if self.compressed:
+            self.size = self.handle.size
+        else:
+            self.size = self.handle.seek(0, os.SEEK_END) if self.device else os.fstat(self.handle.fileno()).st_size
+        self.sectors = self.size // bs
+
+        # Holes of sparse files are found with SEEK_DATA/SEEK_HOLE where available
+        self.sparse = hasattr(os, "SEEK_DATA") and hasattr(os, "SEEK_HOLE") and not self.device and not self.compressed
+
+        self.map = None
+        if use_mmap and self.size > 0 and not self.direct and not self.device and not self.compressed:
+            self.map = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+    def close(self):
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # Views handed out are still alive, the map goes away with them
+                pass
+            self.map = None
+        self.handle.close()
+
+
+    def hole_end(self, start_sector):
+        # End (exclusive) of the run of sectors from start_sector which lie completely
+        # in a hole of a sparse file, start_sector if it holds data
+        if not self.sparse or start_sector >= self.sectors:
+            return start_sector
+
+        try:
+            data = os.lseek(self.handle.fileno(), start_sector * self.bs, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                self.sparse = False     # Not supported by the file system
+                return start_sector
+            data = self.size            # No data up to the end of the file
+
+        return max(min(data // self.bs, self.sectors), start_sector)
+
+
+    def data_end(self, start_sector):
+        # End (exclusive) of the sectors from start_sector up to the next hole
+        if not self.sparse:
+            return self.sectors
+
+        try:
+            hole = os.lseek(self.handle.fileno(), start_sector * self.bs, os.SEEK_HOLE)
+        except OSError:
+            self.sparse = False
+            return self.sectors
+
+        return min(-(-hole // self.bs), self.sectors)
+
+
+    def readinto(self, start_sector, out, unknown=None):
+        # Fill a (sectors, bs) uint8 array from start_sector, returns the number of complete
+        # sectors read. Skipped unreadable sectors are zero and True in the optional
+        # bool array unknown.
+        count = min(out.shape[0], max(self.sectors - start_sector, 0))
+        if count == 0:
+            return 0
+
+        if self.map is not None:
+            start = start_sector * self.bs
+            out[:count] = np.frombuffer(self.map, dtype=np.uint8, count=count * self.bs, offset=start).reshape(count, self.bs)
+            return count
+
+        # Holes are filled with zeros instead of being read
+        end = start_sector + count
+        sector = start_sector
+        while sector < end:
+            hole_end = min(self.hole_end(sector), end)
+            if hole_end > sector:
+                out[sector - start_sector:hole_end - start_sector] = 0
+                sector = hole_end
+                continue
+
+            data_end = min(max(self.data_end(sector), sector + 1), end)
+            a, b = sector - start_sector, data_end - start_sector
+            done = self.read_sectors(sector, out[a:b], unknown[a:b] if unknown is not None else None)
+            sector += done
+            if sector < data_end:
+                break
+
+        return sector - start_sector
+
+
+    def read_bytes(self, position, out):
+        # Read into the uint8 array out from byte position, returns the bytes read,
+        # fewer only at the end of the image or on a short read
+        if self.compressed:
+            return self.handle.read_at(position, out)
+        if not self.direct:
+            target = memoryview(out)
+            self.handle.seek(position)
+            done = 0
+            while done < len(target):
+                n = self.handle.readinto(target[done:])
+                if not n:
+                    break
+                done += n
+            return done
+
+        # O_DIRECT: read the aligned range around the requested one in pieces
+        if self.direct_buffer is None:
+            self.direct_buffer = aligned_buffer(DIRECT_BUFFER_SIZE)
+        done = 0
+        while done < len(out):
+            start = position + done
+            aligned = start - start % DIRECT_ALIGNMENT
+            length = min(-(-(start + len(out) - done - aligned) // DIRECT_ALIGNMENT) * DIRECT_ALIGNMENT, len(self.direct_buffer))
+            target = memoryview(self.direct_buffer[:length])
+            self.handle.seek(aligned)
+            n = 0
+            while n < length:
+                read = self.handle.readinto(target[n:])
+                if not read:
+                    break
+                n += read
+
+            skip = start - aligned
+            count = min(max(n - skip, 0), len(out) - done)
+            out[done:done + count] = self.direct_buffer[skip:skip + count]
+            done += count
+            if n < length:
+                break
+        return done
+
+
+    def read_sectors(self, start_sector, out, unknown=None):
+        # Read all sectors of out, returns how many were read or skipped: fewer only
+        # at the end of the image. A read failing with an I/O error or ending short
+        # within the image is continued in ranges of skip_sectors, each tried up to
+        # 1 + retries times. A range still failing is zero filled, marked in unknown
+        # and recorded in self.unreadable, then the reading goes on after it.
+        flat = out.reshape(-1)
+        count = out.shape[0]
+        done = 0
+        while done < count:
+            try:
+                done += self.read_bytes((start_sector + done) * self.bs, flat[done * self.bs:]) // self.bs
+            except OSError:
+                pass
+            if done >= count or start_sector + done >= self.sectors:
+                break
+
+            piece = min(self.skip_sectors, count - done, self.sectors - start_sector - done)
+            if not self.read_retrying(start_sector + done, flat[done * self.bs:(done + piece) * self.bs]):
+                out[done:done + piece] = 0
+                if unknown is not None:
+                    unknown[done:done + piece] = True
+                self.skipped(start_sector + done, piece)
+            done += piece
+
+        return done
+
+
+    def read_retrying(self, start_sector, out):
+        # True if the range could be read completely in 1 + retries attempts
+        for attempt in range(1 + self.retries):
+            try:
+                if self.read_bytes(start_sector * self.bs, out) == len(out):
+                    return True
+            except OSError:
+                pass
+        return False
+
+
+    def skipped(self, start_sector, count):
+        # Record an unreadable range, joining it to the one before
+        if self.unreadable and self.unreadable[-1][0] + self.unreadable[-1][1] == start_sector:
+            self.unreadable[-1][1] += count
+        else:
+            self.unreadable.append([start_sector, count])
+
+
+    def gather(self, positions, out, unknown=None):
+        # Read the sectors at the sorted positions into out, consecutive positions are
+        # read at once. Returns the number of leading positions read completely.
+        positions = np.asarray(positions, dtype=np.int64)
+        if self.map is not None:
+            valid = int(np.searchsorted(positions, self.sectors))
+            sectors = np.frombuffer(self.map, dtype=np.uint8, count=self.sectors * self.bs).reshape(self.sectors, self.bs)
+            out[:valid] = sectors[positions[:valid]]
+            return valid
+
+        breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+        for start, end in zip(np.concatenate(([0], breaks)).tolist(), np.concatenate((breaks, [len(positions)])).tolist()):
+            done = self.readinto(int(positions[start]), out[start:end], unknown[start:end] if unknown is not None else None)
+            if done < end - start:
+                return start + done
+        return len(positions)
+
+
+    def view(self, start_sector, count):
+        # (sectors, bs) array of up to count sectors, a zero-copy view when memory mapped
+        count = min(count, max(self.sectors - start_sector, 0))
+        if self.map is not None:
+            return np.frombuffer(self.map, dtype=np.uint8, count=count * self.bs, offset=start_sector * self.bs).reshape(count, self.bs)
+
+        out = np.empty((count, self.bs), dtype=np.uint8)
+        return out[:self.readinto(start_sector, out)]
+
+
+class MultiImageReader:
+    # Reads the same sector range of all images into one reused (files, sectors, bs) buffer.
+    # Sector s of the array is sector s + offsets[i] of image i. After each read,
+    # last_unknown is the (files, sectors) mask of the skipped unreadable sectors of
+    # the returned stripes, None if all were read.
+    def __init__(self, paths, bs=512, batch_sectors=10000, use_mmap=False, offsets=None, direct=None,
+                 retries=READ_RETRIES, skip_sectors=SKIP_SECTORS):
+        self.bs = bs
+        self.readers = []
+        try:
+            for path in paths:
+                self.readers.append(ImageReader(path, bs=bs, use_mmap=use_mmap, direct=direct, retries=retries, skip_sectors=skip_sectors))
+        except OSError:
+            self.close()
+            raise
+
+        self.offsets = list(offsets) if offsets is not None else [0 for x in self.readers]
+        self.max_sectors = max(min((reader.sectors - offset for reader, offset in zip(self.readers, self.offsets)), default=0), 0)
+        self.buffer = np.empty((len(self.readers), batch_sectors, bs), dtype=np.uint8)
+        self.unknown = np.zeros((len(self.readers), batch_sectors), dtype=bool)
+        self.last_unknown = None
+
+
+    def close(self):
+        for reader in self.readers:
+            reader.close()
+        self.readers = []
+
+
+    def read_batch(self, start_sector, count):
+        # View of the buffer with up to count stripes from start_sector, it is
+        # overwritten by the next call. Fewer stripes are returned at the end of
+        # the shortest image.
+        self.grow(count)
+
+        complete = count
+        for i, reader in enumerate(self.readers):
+            complete = min(complete, reader.readinto(start_sector + self.offsets[i], self.buffer[i, :complete], self.unknown[i, :complete]))
+            if complete == 0:
+                break
+
+        return self.result(complete)
+
+
+    def read_stripes(self, positions):
+        # Like read_batch() for the stripes at the given sorted sector positions
+        positions = np.asarray(positions, dtype=np.int64)
+        count = len(positions)
+        self.grow(count)
+
+        complete = count
+        for i, reader in enumerate(self.readers):
+            complete = min(complete, reader.gather(positions[:complete] + self.offsets[i], self.buffer[i, :complete], self.unknown[i, :complete]))
+            if complete == 0:
+                break
+
+        return self.result(complete)
+
+
+    def grow(self, count):
+        # Room for count stripes, with a cleared unknown mask
+        if count > self.buffer.shape[1]:
+            self.buffer = np.empty((len(self.readers), count, self.bs), dtype=np.uint8)
+            self.unknown = np.zeros((len(self.readers), count), dtype=bool)
+        else:
+            self.unknown[:, :count] = False
+
+
+    def result(self, complete):
+        unknown = self.unknown[:, :complete]
+        self.last_unknown = unknown if unknown.any() else None
+        return self.buffer[:, :complete]
+
+
+    def unreadable(self):
+        # Skipped unreadable ranges of each image as [start sector, sectors] lists
+        return [reader.unreadable for reader in self.readers]
+
+
+    def zero_run(self, start_sector, count):
+        # Number of stripes from start_sector (up to count) which are holes in all images
+        end = min(start_sector + count, self.max_sectors)
+        for reader, offset in zip(self.readers, self.offsets):
+            end = min(end, reader.hole_end(start_sector + offset) - offset)
+            if end <= start_sector:
+                return 0
+        return end - start_sector
+
+
+class MemberPrefetcher:
+    # Reads one image ahead of the analysis with an I/O thread of its own, into a
+    # ring of depth buffers of buffer_sectors each. The images of a set read the
+    # same sector ranges, so their buffers line up stripe by stripe. A read
+    # elsewhere than at the next sector (e.g. behind a hole) restarts the reading
+    # there, the buffers read before are dropped.
+    def __init__(self, reader, offset, depth, buffer_sectors):
+        self.reader = reader
+        self.offset = offset
+        self.buffer_sectors = buffer_sectors
+        self.buffers = [aligned_buffer(buffer_sectors * reader.bs).reshape(buffer_sectors, reader.bs) for x in range(depth)]
+        self.unknown = [np.zeros(buffer_sectors, dtype=bool) for x in range(depth)]
+        self.free = queue.Queue()
+        self.filled = queue.Queue()
+        for slot in range(depth):
+            self.free.put(slot)
+
+        self.lock = threading.Condition()
+        self.generation = 0                     # Counts the restarts, buffers of older ones are dropped
+        self.position = None                    # Next sector the thread reads, None before the first read
+        self.ended = None                       # Generation which reached the end of the image
+        self.stopped = False
+        self.current = None                     # (start sector, sectors, slot) of the buffer being used
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        while True:
+            slot = self.free.get()
+            with self.lock:
+                while not self.stopped and (self.position is None or self.ended == self.generation):
+                    self.lock.wait()
+                if self.stopped:
+                    return
+                generation, start = self.generation, self.position
+                self.position += self.buffer_sectors
+
+            self.unknown[slot][:] = False
+            try:
+                count, error = self.reader.readinto(start + self.offset, self.buffers[slot], self.unknown[slot]), None
+            except Exception as e:
+                count, error = 0, e
+            if count < self.buffer_sectors:
+                with self.lock:
+                    if generation == self.generation:
+                        self.ended = generation
+            self.filled.put((generation, start, count, slot, error))
+
+
+    def restart(self, sector):
+        with self.lock:
+            self.generation += 1
+            self.position = sector
+            self.lock.notify_all()
+        if self.current is not None:
+            self.free.put(self.current[2])
+            self.current = None
+
+
+    def next_buffer(self):
+        # Next buffer of the current generation, those of older ones go back to the ring
+        while True:
+            generation, start, count, slot, error = self.filled.get()
+            if generation != self.generation:
+                self.free.put(slot)
+                continue
+            if error is not None:
+                self.free.put(slot)
+                raise error
+            return start, count, slot
+
+
+    def readinto(self, start_sector, out, unknown):
+        # Like ImageReader.readinto() with sector 0 at the offset of the image
+        count = out.shape[0]
+        done = 0
+        while done < count:
+            sector = start_sector + done
+            current = self.current
+            if current is None or not current[0] <= sector < current[0] + current[1]:
+                if current is not None and sector == current[0] + current[1]:
+                    if current[1] < self.buffer_sectors:
+                        break                   # End of the image
+                    self.free.put(current[2])
+                    self.current = None
+                else:
+                    self.restart(sector)
+                self.current = self.next_buffer()
+                continue
+
+            a = sector - current[0]
+            n = min(current[1] - a, count - done)
+            out[done:done + n] = self.buffers[current[2]][a:a + n]
+            unknown[done:done + n] = self.unknown[current[2]][a:a + n]
+            done += n
+        return done
+
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.lock.notify_all()
+        self.free.put(None)
+        self.thread.join()
+        self.reader.close()
+
+
+class PrefetchImageReader(MultiImageReader):
+    # MultiImageReader reading ahead of sequential batches with a MemberPrefetcher
+    # per image, so the images (e.g. on separate disks or network shares) are read
+    # at the same time instead of one after the other while the analysis works on
+    # the batch before. read_stripes() and zero_run() use the readers of the base
+    # class, the prefetchers have their own.
+    def __init__(self, paths, bs=512, batch_sectors=10000, offsets=None, direct=None, retries=READ_RETRIES,
+                 skip_sectors=SKIP_SECTORS, depth=PREFETCH_DEPTH, buffer_size=PREFETCH_BUFFER_SIZE):
+        super().__init__(paths, bs=bs, batch_sectors=batch_sectors, offsets=offsets, direct=direct, retries=retries, skip_sectors=skip_sectors)
+        buffer_sectors = max(buffer_size // bs, 1)
+        self.prefetchers = []
+        try:
+            for path, offset in zip(paths, self.offsets):
+                reader = ImageReader(path, bs=bs, direct=direct, retries=retries, skip_sectors=skip_sectors)
+                self.prefetchers.append(MemberPrefetcher(reader, offset, max(depth, 1), buffer_sectors))
+        except OSError:
+            self.close()
+            raise
+
+
+    def close(self):
+        for prefetcher in self.prefetchers:
+            prefetcher.stop()
+        self.prefetchers = []
+        super().close()
+
+
+    def read_batch(self, start_sector, count):
+        self.grow(count)
+
+        complete = count
+        for i, prefetcher in enumerate(self.prefetchers):
+            complete = min(complete, prefetcher.readinto(start_sector, self.buffer[i, :complete], self.unknown[i, :complete]))
+            if complete == 0:
+                break
+
+        return self.result(complete)
+
+
+    def unreadable(self):
+        return [sorted(reader.unreadable + prefetcher.reader.unreadable) for reader, prefetcher in zip(self.readers, self.prefetchers)]
@@ -0,0 +1,258 @@
+import html
+import zlib
+import base64
+import struct
+
+import numpy as np
+
+
+# Points per chart line and runs per parity check log listing, so the report of a
+# large run stays small and opens quickly. The charts are inline SVG and the
+# heatmaps inline PNG images, the report needs no network access.
+CHART_POINTS = 1000
+CHART_WIDTH = 1000
+CHART_HEIGHT = 120
+REPORT_MAX_RUNS = 20000
+
+# Heatmap colors from 0 to 1 (viridis), unknown regions are gray
+HEATMAP_COLORS = np.array([(68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)], dtype=np.float64)
+UNKNOWN_COLOR = (70, 70, 70)
+
+
+def lttb(x, y, threshold=CHART_POINTS):
+    # Indices of the points kept by Largest-Triangle-Three-Buckets downsampling:
+    # the first and last point and from each bucket in between the point forming
+    # the largest triangle with the point kept before and the mean of the next
+    # bucket, which keeps peaks and the shape of the line
+    n = len(x)
+    if n <= threshold or threshold < 3:
+        return np.arange(n)
+
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.intp)
+    keep = np.empty(threshold, dtype=np.intp)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for k in range(threshold - 2):
+        lo, hi = edges[k], edges[k + 1]
+        next_lo, next_hi = edges[k + 1], edges[k + 2] if k + 2 < len(edges) else n
+        mean_x, mean_y = x[next_lo:next_hi].mean(), y[next_lo:next_hi].mean()
+        area = np.abs((x[a] - mean_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (mean_y - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[k + 1] = a
+    return keep
+
+
+def svg_points(x, y, x_range, y_max):
+    # "x,y x,y ..." in the chart coordinates, y up
+    x0, x1 = x_range
+    px = (np.asarray(x, dtype=np.float64) - x0) * CHART_WIDTH / max(x1 - x0, 1)
+    py = CHART_HEIGHT - np.clip(np.asarray(y, dtype=np.float64), 0, y_max) * CHART_HEIGHT / y_max
+    return " ".join(f"{a:.1f},{b:.1f}" for a, b in zip(px, py))
+
+
+def svg_chart(x, y, x_range, y_max, color, low=None, high=None):
+    # Line chart of y over x (downsampled with LTTB), with an optional min-max band.
+    # Points with NaN values (nothing known there) are left out.
+    valid = ~np.isnan(y)
+    x, y = np.asarray(x)[valid], np.asarray(y)[valid]
+    svg = f'<svg class="chart" viewBox="0 0 {CHART_WIDTH} {CHART_HEIGHT}" preserveAspectRatio="none">'
+    if low is not None and len(x):
+        # The band keeps the extremes of each bucket of the line
+        low, high = np.asarray(low)[valid], np.asarray(high)[valid]
+        starts = np.linspace(0, len(x), min(len(x), CHART_POINTS) + 1).astype(np.intp)[:-1]
+        band_x = x[starts]
+        band_low, band_high = np.minimum.reduceat(low, starts), np.maximum.reduceat(high, starts)
+        points = svg_points(np.concatenate((band_x, band_x[::-1])), np.concatenate((band_high, band_low[::-1])), x_range, y_max)
+        svg += f'<polygon points="{points}" fill="{color}" fill-opacity="0.25" stroke="none"/>'
+    keep = lttb(x, y)
+    svg += f'<polyline points="{svg_points(x[keep], y[keep], x_range, y_max)}" fill="none" stroke="{color}" stroke-width="1.5" vector-effect="non-scaling-stroke"/>'
+    return svg + "</svg>"
+
+
+def write_chart_rows(report, filenames, charts, first, last):
+    # One row per image with its chart and the sector range below it
+    for filename, chart in zip(filenames, charts):
+        report.write(f'<div class="disk-row"><div class="disk-header">FILE: {html.escape(filename)}</div>\n')
+        report.write(f'<div class="chart-wrapper">{chart}</div>\n')
+        report.write(f'<div class="axis"><span>{first}</span><span>{last}</span></div></div>\n')
+
+
+def write_entropy_graph(report, engine):
+    # The first block with data (entropy * 10 + 1 per sector, 1 for zero sectors)
+    charts = []
+    for values in engine.analysis_block_entropy:
+        values = np.asarray(values, dtype=np.float64)
+        charts.append(svg_chart(np.arange(len(values)), values, (0, max(len(values) - 1, 1)), 100, "#ff6384"))
+    count = max((len(values) for values in engine.analysis_block_entropy), default=0)
+    write_chart_rows(report, engine.filenames, charts, "sector 0", f"sector {max(count - 1, 0)} of the block")
+
+
+def write_entropy_map(report, engine):
+    # Mean entropy of every image over the whole range with its min-max band,
+    # from the entropy pyramid
+    pyramid = engine.pyramid
+    end = min(engine.offset, pyramid.end_sector())
+    charts = []
+    for i in range(len(engine.files)):
+        edges, low, mean, high, zero = pyramid.view(i, 0, end, CHART_POINTS)
+        charts.append(svg_chart(edges[:-1], mean, (0, max(end, 1)), 8, "#4bc0c0", low, high))
+    write_chart_rows(report, engine.filenames, charts, f"sector {engine.analysis_start_sector}", f"sector {engine.analysis_start_sector + end}")
+
+
+def png_bytes(rgb):
+    # PNG file of a (height, width, 3) uint8 image
+    height, width = rgb.shape[:2]
+    raw = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgb.reshape(height, -1)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw.tobytes(), 9)) + chunk(b"IEND", b""))
+
+
+def heatmap_png(values):
+    # Colored image of a (rows, regions) array of 0..1 values as a PNG data URI
+    positions = np.linspace(0, 1, len(HEATMAP_COLORS))
+    scaled = np.nan_to_num(np.clip(values, 0, 1))
+    rgb = np.stack([np.interp(scaled, positions, HEATMAP_COLORS[:, c]) for c in range(3)], axis=-1)
+    rgb[np.isnan(values)] = UNKNOWN_COLOR
+    return "data:image/png;base64," + base64.b64encode(png_bytes(np.rint(rgb).astype(np.uint8))).decode("ascii")
+
+
+def write_heatmaps(report, engine):
+    # Zero, pattern and entropy share of every image and the parity matches per
+    # LBA region, each row one image (or parity combination) from the start sector
+    # on the left to the end of the range on the right
+    heatmap = engine.heatmap
+    fractions = heatmap.fractions()
+    first = engine.analysis_start_sector
+    last = first + heatmap.regions * heatmap.region_sectors
+    report.write(f"<p>{heatmap.regions} regions of {heatmap.region_sectors} sectors, dark = 0%, yellow = 100%, gray = not analyzed or unreadable.</p>\n")
+
+    parity_rows = ["ALL FILES"] + [f"WITHOUT {filename}" for filename in engine.filenames]
+    for title, key, rows in (("Zero sectors", "zero", engine.filenames), ("Pattern sectors", "pattern", engine.filenames),
+                             ("Entropy (of 8 bits per byte)", "entropy", engine.filenames), ("Stripes in parity", "parity", parity_rows)):
+        report.write(f"<h3>{title}</h3>\n")
+        report.write(f'<div class="heatmap" style="grid-template-rows: repeat({len(rows)}, 14px);">\n')
+        for row, name in enumerate(rows):
+            report.write(f'<div class="heatmap-label" style="grid-row: {row + 1};">{html.escape(name)}</div>\n')
+        report.write(f'<img src="{heatmap_png(fractions[key])}" style="grid-row: 1 / span {len(rows)};" alt="{title}">\n')
+        report.write("</div>\n")
+        report.write(f'<div class="axis heatmap-axis"><span>sector {first}</span><span>sector {last}</span></div>\n')
+
+
+def write_run_pages(report, runs, page=1000, open_first=False, max_runs=REPORT_MAX_RUNS, log_path=None):
+    # The runs of a parity check log (up to max_runs), page by page in collapsible sections
+    for first in range(0, min(len(runs), max_runs), page):
+        ranges = runs.ranges(first, page)
+        state = " open" if open_first and first == 0 else ""
+        report.write(f"<details{state}><summary>Runs {first + 1} - {first + len(ranges)} (sectors {ranges[0][0]} - {ranges[-1][1]})</summary>\n")
+        report.write("<pre>\n")
+        for from_sec, to_sec, pattern in ranges:
+            report.write(f"{from_sec} - {to_sec} : {html.escape(pattern)}\n")
+        report.write("</pre></details>\n")
+    if len(runs) > max_runs:
+        holder = html.escape(log_path) if log_path is not None else "the parity log file (analyze --parity-log)"
+        report.write(f"<p>{len(runs) - max_runs} more runs are not shown here, {holder} holds all.</p>\n")
+
+
+def write_parity_runs(report, runs, noise_sectors, log_path=None):
+    # Sectors per pattern, the runs without noise and the complete log
+    report.write("<pre>\n")
+    for pattern, sectors in sorted(runs.pattern_sectors().items(), key=lambda item: -item[1]):
+        report.write(f"{sectors * 100 / max(runs.end, 1):>5.1f}%  {sectors:>12}  {html.escape(pattern)}\n")
+    report.write("</pre>\n")
+
+    merged = runs.merged(noise_sectors)
+    report.write(f"<p>{len(merged)} runs with the runs shorter than {noise_sectors} sectors counted to the run before:</p>\n")
+    write_run_pages(report, merged, open_first=True)
+
+    report.write(f"<p>Complete log, {len(runs)} runs of {len(runs.names)} patterns (sectors counted from 1 at the start sector):</p>\n")
+    write_run_pages(report, runs, log_path=log_path)
+
+
+def write_html_report(engine, report_file):
+    # Written section by section through a large buffer, the size only grows with
+    # the (capped) parity check log listings
+    with open(report_file, "w", buffering=1 << 20) as report:
+        h1 = f"RaidAlyzer v{engine.version} Report"
+        report.write("<!DOCTYPE html>\n")
+        report.write("<html lang=\"en\">\n")
+        report.write("<head>\n")
+        report.write(f"<title>{h1}</title>\n")
+
+        # Styles
+        report.write("<style>\n")
+        report.write("body { font-family: monospace; background-color: #1e1e1e; color: #ffffff; padding: 20px; } \n")
+        report.write("h2 { color: #4bc0c0; } \n")
+        report.write(".chart-container { width: 90%; margin: auto; background-color: #2d2d2d; padding: 20px; border-radius: 8px; box-shadow: 0 4px 15px rgba(0,0,0,0.5); } \n")
+        report.write(".disk-row { background-color: #1e1e1e; margin-bottom: 15px; padding: 10px; border-radius: 4px; border-left: 4px solid #4bc0c0; } \n")
+        report.write(".disk-header { font-size: 0.9em; color: #4bc0c0; margin-bottom: 5px; display: flex; justify-content: space-between; } \n")
+        report.write(".chart-wrapper { height: 120px; position: relative; width: 100%; background-color: #2d2d2d; } \n")
+        report.write(".chart { width: 100%; height: 100%; display: block; } \n")
+        report.write(".axis { display: flex; justify-content: space-between; font-size: 0.8em; color: #888; } \n")
+        report.write(".heatmap { display: grid; grid-template-columns: 16em 1fr; } \n")
+        report.write(".heatmap-label { font-size: 0.8em; line-height: 14px; overflow: hidden; white-space: nowrap; } \n")
+        report.write(".heatmap img { grid-column: 2; width: 100%; height: 100%; image-rendering: pixelated; } \n")
+        report.write(".heatmap-axis { margin-left: 16em; margin-bottom: 15px; } \n")
+        report.write("</style>\n")
+        report.write("</head>\n")
+
+        # Body
+        report.write("<body>\n")
+        report.write(f"<h1>{h1}</h1>\n")
+        report.write("<hr><br><br>\n\n")
+        report.write(f"<h2>Analyzed files:</h2><hr><br>\n")
+        report.write("<ul>\n")
+        for file in engine.filenames:
+            report.write(f"<li>{file}</li>\n")
+        report.write("</ul><br><br>\n\n")
+
+        report.write(f"<b>Start sector:</b> {engine.analysis_start_sector}<br><br><hr><br>\n\n")
+
+        report.write("<h2>Statistics:</h2><hr><br>\n")
+        report.write("<pre>\n")
+        report.write(engine.format_stats())
+        report.write("</pre><br><br>\n\n")
+
+        report.write("<h2>Signature Analysis:</h2><hr><br>\n")
+        report.write("<pre>\n")
+        report.write(engine.format_signatures())
+        report.write("</pre><br><br>\n\n")
+
+        report.write("<h2>Mirror Analysis:</h2><hr><br>\n")
+        report.write("<pre>\n")
+        report.write(engine.format_mirrors())
+        report.write("</pre><br><br>\n\n")
+
+        report.write("<h2>Parity Analysis:</h2><hr><br>\n")
+        report.write("<pre>\n")
+        report.write(engine.format_parity())
+        report.write("</pre><br><br>\n\n")
+
+        report.write("<h2>Performance:</h2><hr><br>\n")
+        report.write("<pre>\n")
+        report.write(engine.timers.format())
+        report.write("</pre><br><br>\n\n")
+
+        # create entropy graph from first analysis block
+        report.write("<h2>Entropy graph for first block potentially containing data:</h2><hr><br>\n")
+        write_entropy_graph(report, engine)
+        report.write("<br><br>\n\n")
+
+        if engine.pyramid is not None and len(engine.pyramid):
+            report.write("<h2>Entropy map of the analyzed range (mean, min - max):</h2><hr><br>\n")
+            write_entropy_map(report, engine)
+            report.write("<br><br>\n\n")
+
+        if engine.heatmap is not None:
+            report.write("<h2>Region heatmaps:</h2><hr><br>\n")
+            write_heatmaps(report, engine)
+            report.write("<br><br>\n\n")
+
+        report.write("<h2>Parity Check Log:</h2><hr><br>\n")
+        if engine.parity_runs is not None:
+            write_parity_runs(report, engine.parity_runs, engine.parity_noise_sectors, engine.parity_log_path)
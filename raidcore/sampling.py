@@ -0,0 +1,260 @@
+import math
+import time
+
+import numpy as np
+
+from statistics import NormalDist
+
+from .engine import RaidAnalysisEngine
+
+
+def wilson_interval(hits, samples, z):
+    # Wilson score interval of a proportion, returns (low, high) in percent
+    if samples == 0:
+        return 0.0, 100.0
+
+    p = hits / samples
+    denominator = 1 + z * z / samples
+    center = (p + z * z / (2 * samples)) / denominator
+    margin = z * math.sqrt(p * (1 - p) / samples + z * z / (4 * samples * samples)) / denominator
+    return max(center - margin, 0.0) * 100, min(center + margin, 1.0) * 100
+
+
+class SamplingAnalysisEngine(RaidAnalysisEngine):
+    # Estimates the statistics, mirror matrix and parity percentages from stripes
+    # chosen randomly (or one per stratum of the LBA range) instead of reading
+    # every sector. Each step adds samples_per_step stripes, the estimates are
+    # refined until every confidence interval is within the precision target
+    # (in percentage points) or the analysis is stopped.
+    def __init__(self, files, bs=512, samples_per_step=1024, precision=1.0, confidence=0.95,
+                 strategy="stratified", seed=None, max_seconds=None, **kwargs):
+        kwargs["processes"] = 1
+        super().__init__(files, bs=bs, **kwargs)
+        self.record_parity_runs = False             # Random stripes have no runs
+        self.record_pyramid = False                 # nor a map of the whole range
+        self.record_heatmap = False                 # or regions
+        self.prefetch_depth = 0                     # Reading ahead doesn't help random stripes
+
+        self.samples_per_step = samples_per_step
+        self.precision = precision
+        self.confidence = confidence
+        self.strategy = strategy
+        self.max_seconds = max_seconds
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+        self.rng = np.random.default_rng(seed)
+
+        self.entropy_squares = []
+        self.precision_reached = False
+
+
+    def open(self, offset=0, run_only_one_block=False, sector_count=None, sector_base=0):
+        super().open(offset=offset, sector_count=sector_count)
+        self.first_analysis_block = False
+        self.precision_reached = False
+        self.entropy_squares = [0.0 for x in self.files]
+
+
+    def sample_range(self):
+        end = self.max_sectors
+        if self.sector_count is not None:
+            end = min(end, self.analysis_start_sector + self.sector_count)
+        return self.analysis_start_sector, max(end - self.analysis_start_sector, 0)
+
+
+    def next_positions(self):
+        # Sorted absolute sector positions of the next samples
+        start, total = self.sample_range()
+        count = min(self.samples_per_step, total)
+
+        if self.strategy == "random":
+            positions = self.rng.integers(0, total, size=count)
+        else:
+            # One random stripe out of each of count equally sized strata
+            strata = np.arange(count, dtype=np.float64) + self.rng.random(count)
+            positions = (strata * total / count).astype(np.int64)
+
+        return np.sort(positions) + start
+
+
+    def step(self):
+        if not self.running:
+            return False
+
+        start, total = self.sample_range()
+        if self.cancel_requested() or total == 0:
+            self.running = False
+        else:
+            with self.timers.stage("read") as counts:
+                batch = self.reader.read_stripes(self.next_positions())
+                if self.reader.last_unknown is not None:
+                    # Samples with an unreadable sector are left out
+                    readable = ~self.reader.last_unknown.any(axis=0)
+                    self.unknown_stripes += int(np.count_nonzero(~readable))
+                    batch = batch[:, readable]
+                counts["sectors"] = batch.shape[0] * batch.shape[1]
+                counts["bytes"] = batch.nbytes
+            if batch.shape[1] > 0:
+                self.init_stats()
+                self.process_stripes(batch)
+
+            # Done when precise enough, out of time or (more than) every stripe was sampled
+            self.precision_reached = self.max_half_width() <= self.precision
+            out_of_time = self.max_seconds is not None and time.time() - self.start_time >= self.max_seconds
+            if self.precision_reached or out_of_time or self.offset + self.unknown_stripes >= total:
+                self.running = False
+
+        self.timers.record(self.offset)
+        self.notify("progress")
+
+        if not self.running:
+            self.stop()
+            return False
+
+        return True
+
+
+    def check_signatures(self, batch):
+        # The first signature hit needs a sequential scan, samples can't tell
+        pass
+
+
+    def update_stats(self, i, zero, pattern, entropy, graph=True):
+        super().update_stats(i, zero, pattern, entropy, graph)
+        self.entropy_squares[i] += float(np.dot(entropy, entropy))
+
+
+    def interval(self, hits):
+        return wilson_interval(hits, self.offset, self.z)
+
+
+    def half_width(self, hits):
+        low, high = self.interval(hits)
+        return (high - low) / 2
+
+
+    def entropy_half_width(self, i):
+        # Confidence interval half width of the mean entropy of a file
+        n = self.offset
+        if n < 2:
+            return float("inf")
+        mean = self.stats[i]['entropy'] / n
+        variance = max(self.entropy_squares[i] / n - mean * mean, 0.0) * n / (n - 1)
+        return self.z * math.sqrt(variance / n)
+
+
+    def max_half_width(self):
+        # Largest interval of all reported percentages
+        if not self.stats:
+            return float("inf")
+
+        counts = []
+        for s in self.stats:
+            counts += [s['zero_blocks'], s['pattern_blocks']]
+        for i in range(len(self.mirrors)):
+            counts += [self.mirrors[i][j] for j in range(len(self.mirrors)) if i != j]
+        counts += self.parity
+        if self.checking_q():
+            counts += self.q_parity
+
+        # The maximum of the Wilson interval width is at the proportion closest to 50%
+        sample = min(counts, key=lambda c: abs(c - self.offset / 2))
+        return self.half_width(sample)
+
+
+    def status_text(self):
+        return f"Sampled {self.offset} stripes: max. ±{self.max_half_width():.2f}% at {self.confidence * 100:.0f}% confidence (target ±{self.precision:.2f}%, {self.sectors_per_second():.1f} samples/sec.)"
+
+
+    def format_stats(self):
+        sectors = max(self.offset, 1)
+        stats = f" #  FILE                   ZERO %           PATTERN %        ENTROPY        ({self.offset} samples, {self.confidence * 100:.0f}% confidence)\n"
+        for idx in range(len(self.stats)):
+            file = self.filenames[idx]
+            zero = self.stats[idx]['zero_blocks']
+            pattern = self.stats[idx]['pattern_blocks']
+            entropy = self.stats[idx]['entropy'] / sectors
+            stats += (
+                f"{idx:>2}  {file[:20]:<20}  {zero * 100 / sectors:>5.1f} % ±{self.half_width(zero):>4.1f}  "
+                f"{pattern * 100 / sectors:>7.1f} % ±{self.half_width(pattern):>4.1f}  "
+                f"{entropy:>7.1f} ±{self.entropy_half_width(idx):>4.2f}\n"
+            )
+
+        stats += "\n---\n\n"
+        if self.unknown_stripes:
+            stats += f"{self.unknown_stripes} sampled stripes with unreadable sectors were left out\n"
+        return stats
+
+
+    def format_signatures(self):
+        return "Signature hits need a full analysis, samples can't tell.\n"
+
+
+    def format_mirrors(self):
+        sectors = max(self.offset, 1)
+        mirrors = " " * 22
+        for file in self.filenames:
+            mirrors += f"{file[:20]:>20}  "
+        mirrors += "\n"
+
+        for i in range(len(self.mirrors)):
+            mirrors += f"{self.filenames[i][:20]:>20}  "
+            for j in range(len(self.mirrors)):
+                if i == j:
+                    mirrors += " " * 17 + "---  "
+                else:
+                    hits = self.mirrors[i][j]
+                    mirrors += f"{hits * 100 / sectors:>13.0f}% ±{self.half_width(hits):>4.1f}  "
+            mirrors += "\n"
+
+        return mirrors
+
+
+    def format_parity(self):
+        if not self.parity:
+            return ""
+
+        sectors = max(self.offset, 1)
+        file = "ALL FILES"
+        parity = f"{file:<28}  {self.parity[0] * 100 / sectors:>3.0f}% ±{self.half_width(self.parity[0]):.1f}\n"
+        for i in range(len(self.filenames)):
+            file = self.filenames[i][:20]
+            parity += f"WITHOUT {file:<20}  {self.parity[i+1] * 100 / sectors:>3.0f}% ±{self.half_width(self.parity[i+1]):.1f}\n"
+
+        if self.checking_q() and self.q_parity:
+            parity += "\n"
+            for name, hits in zip(self.q_pattern_names(), self.q_parity):
+                parity += f"{name[:60]:<60}  {hits * 100 / sectors:>3.0f}% ±{self.half_width(hits):.1f}\n"
+
+        return parity
+
+
+    def confidence_intervals(self):
+        # All estimates with their intervals as (percent, low, high)
+        sectors = max(self.offset, 1)
+
+        def estimate(hits):
+            low, high = self.interval(hits)
+            return [hits * 100 / sectors, low, high]
+
+        return {
+            "samples": self.offset,
+            "confidence": self.confidence,
+            "stats": [
+                {
+                    "file": self.filenames[i],
+                    "zero_percent": estimate(s['zero_blocks']),
+                    "pattern_percent": estimate(s['pattern_blocks']),
+                    "entropy": [s['entropy'] / sectors, s['entropy'] / sectors - self.entropy_half_width(i), s['entropy'] / sectors + self.entropy_half_width(i)],
+                }
+                for i, s in enumerate(self.stats)
+            ],
+            "mirrors": [[estimate(hits) for hits in row] for row in self.mirrors],
+            "parity": [estimate(hits) for hits in self.parity],
+            "q_parity": [estimate(hits) for hits in self.q_parity],
+        }
+
+
+    def to_dict(self):
+        result = super().to_dict()
+        result["sampling"] = self.confidence_intervals()
+        return result
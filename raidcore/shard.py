@@ -0,0 +1,263 @@
+import queue
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .classify import entropy_value
+from .heatmap import merge_heatmaps
+from .paritylog import ParityRunLog
+from .pyramid import EntropyPyramid
+from .signatures import HIT_DTYPE
+
+
+# Set in each worker process by _init_worker()
+_progress_queue = None
+_cancel_event = None
+
+
+def _init_worker(progress_queue, cancel_event):
+    global _progress_queue, _cancel_event
+    _progress_queue = progress_queue
+    _cancel_event = cancel_event
+
+
+def analyze_shard(index, files, bs, analysis_block_size, start_sector, sector_base, sector_count, check_q=True, disk_offsets=None, signatures=None, block_entropy=None,
+                  reading=None):
+    # Analyze one sector range in a worker process and return its partial result.
+    # block_entropy continues the entropy graph block a resumed analysis stopped in,
+    # reading holds the (direct_io, read_retries, skip_sectors, prefetch_depth,
+    # prefetch_buffer_size) of the engine.
+    from .engine import RaidAnalysisEngine
+
+    engine = RaidAnalysisEngine(files, bs=bs, analysis_block_size=analysis_block_size, parity_log_path=None)
+    engine.check_q = check_q
+    engine.disk_offsets = disk_offsets
+    if signatures is not None:
+        engine.signatures = signatures
+    if reading is not None:
+        engine.direct_io, engine.read_retries, engine.skip_sectors, engine.prefetch_depth, engine.prefetch_buffer_size = reading
+
+    def report_progress(event, engine):
+        if event == "progress":
+            _progress_queue.put((index, engine.offset))
+
+    engine.subscribe(report_progress)
+    engine.cancel_event = _cancel_event
+    engine.open(offset=start_sector + sector_base, sector_count=sector_count, sector_base=sector_base)
+    if block_entropy is not None:
+        engine.analysis_block_entropy = [list(values) for values in block_entropy]
+    try:
+        while engine.step():
+            pass
+    finally:
+        engine.stop()
+
+    return engine.partial_result()
+
+
+def combine_results(results, files):
+    # Partial result of consecutive sector ranges from their partial results
+    combined = {
+        "offset": 0,
+        "unknown_stripes": 0,
+        "stats": [],
+        "entropy_sums": [],
+        "mirrors": [],
+        "parity": [],
+        "q_parity": [],
+        "first_analysis_block": True,
+        "analysis_block_entropy": [[] for x in range(files)],
+        "bootsector_hit": None,
+        "efi_part_hit": None,
+        "signature_hits": [],
+        "parity_runs": ParityRunLog(),
+        "pyramid": EntropyPyramid(files),
+        "heatmap": None,
+        "reached_end": False,
+    }
+    if not results:
+        combined["signature_hits"] = [np.zeros(0, dtype=HIT_DTYPE) for x in range(files)]
+        return combined
+
+    combined["entropy_sums"] = [0 for x in range(files)]
+    combined["mirrors"] = [[0 for x in range(files)] for y in range(files)]
+    combined["parity"] = [0 for x in range(files + 1)]
+    combined["q_parity"] = [0 for x in results[0]['q_parity']]
+    stats = [{'zero_blocks': 0, 'pattern_blocks': 0, 'unknown_blocks': 0} for x in range(files)]
+
+    for result in results:
+        # Counters and exact entropy sums simply add up
+        combined["offset"] += result['offset']
+        combined["unknown_stripes"] += result['unknown_stripes']
+        for i in range(files):
+            stats[i]['zero_blocks'] += result['stats'][i]['zero_blocks']
+            stats[i]['pattern_blocks'] += result['stats'][i]['pattern_blocks']
+            stats[i]['unknown_blocks'] += result['stats'][i]['unknown_blocks']
+            combined["entropy_sums"][i] += result['entropy_sums'][i]
+            for j in range(files):
+                combined["mirrors"][i][j] += result['mirrors'][i][j]
+
+        for i in range(files + 1):
+            combined["parity"][i] += result['parity'][i]
+        for i in range(len(combined["q_parity"])):
+            combined["q_parity"][i] += result['q_parity'][i]
+
+        # The entropy graph shows the first block with data of the whole range
+        if combined["first_analysis_block"]:
+            combined["analysis_block_entropy"] = result['analysis_block_entropy']
+            combined["first_analysis_block"] = result['first_analysis_block']
+
+        # First signature hits of the whole range
+        for key in ("bootsector_hit", "efi_part_hit"):
+            if combined[key] is None:
+                combined[key] = result[key]
+
+        # The runs of a range continue those of the range before
+        combined["parity_runs"].extend(result['parity_runs'])
+        if result['pyramid'] is not None:
+            combined["pyramid"].extend(result['pyramid'])
+        combined["reached_end"] = result['reached_end']
+
+    # A single range keeps its sequential float sum, several ranges give the
+    # correctly rounded exact sum
+    ranges = [result for result in results if result['offset']]
+    for i in range(files):
+        if len(ranges) == 1:
+            stats[i]['entropy'] = ranges[0]['stats'][i]['entropy']
+        else:
+            stats[i]['entropy'] = entropy_value(combined["entropy_sums"][i])
+    combined["stats"] = stats
+    combined["heatmap"] = merge_heatmaps(result['heatmap'] for result in results)
+    combined["signature_hits"] = [np.concatenate([result['signature_hits'][i] for result in results]) for i in range(files)]
+    return combined
+
+
+class ShardedAnalysis:
+    def __init__(self, engine, processes, shards_per_process=4):
+        # A resumed analysis continues after the state restored in the engine (the prefix)
+        self.engine = engine
+        self.processes = processes
+        self.shards_per_process = shards_per_process
+        self.prefix = engine.partial_result() if engine.offset > 0 else None
+
+        self.ranges = []
+        self.futures = []
+        self.progress = []
+        self.executor = None
+        self.merged = False
+
+
+    def start(self):
+        engine = self.engine
+        total = max(engine.max_sectors - engine.analysis_start_sector, 0)
+        begin = engine.offset
+
+        # Shard boundaries are multiples of the analysis block size, so the analysis
+        # blocks (and the entropy graph block) are the same as in a sequential run.
+        # A resumed analysis starts with the rest of its shard.
+        block = engine.analysis_block_size
+        shard_size = -(-(total - begin) // (self.processes * self.shards_per_process))
+        shard_size = max(-(-shard_size // block) * block, block)
+        self.ranges = []
+        base = begin
+        while base < total:
+            end = min((base // shard_size + 1) * shard_size, total)
+            self.ranges.append((base, end - base))
+            base = end
+        self.progress = [0 for x in self.ranges]
+
+        context = multiprocessing.get_context()
+        self.progress_queue = context.Queue()
+        self.cancel_event = context.Event()
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(self.progress_queue, self.cancel_event),
+        )
+
+        block_entropy = None
+        if self.prefix is not None and self.prefix['first_analysis_block']:
+            block_entropy = self.prefix['analysis_block_entropy']
+
+        for index, (base, count) in enumerate(self.ranges):
+            self.futures.append(self.executor.submit(
+                analyze_shard, index, engine.files, engine.bs, block,
+                engine.analysis_start_sector, base, count, engine.check_q, engine.disk_offsets, engine.signatures,
+                block_entropy if index == 0 else None,
+                (engine.direct_io, engine.read_retries, engine.skip_sectors, engine.prefetch_depth, engine.prefetch_buffer_size),
+            ))
+
+
+    def poll(self, timeout=0.25):
+        # Collect progress messages, returns True once all shards are done
+        try:
+            index, sectors = self.progress_queue.get(timeout=timeout)
+            self.progress[index] = sectors
+            while True:
+                index, sectors = self.progress_queue.get_nowait()
+                self.progress[index] = sectors
+        except queue.Empty:
+            pass
+
+        return all(future.done() for future in self.futures)
+
+
+    def sectors_done(self):
+        return sum(self.progress) + (self.prefix['offset'] if self.prefix is not None else 0)
+
+
+    def cancel(self):
+        if self.executor is not None:
+            self.cancel_event.set()
+            for future in self.futures:
+                future.cancel()
+
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+
+    def results(self, wait=True):
+        # Partial results of the contiguous range of shards from the start sector,
+        # a cancelled or short shard (or without wait, a running one) ends the range
+        results = []
+        for future, (base, count) in zip(self.futures, self.ranges):
+            if future.cancelled() or (not wait and not future.done()):
+                break
+
+            result = future.result()
+            if result['offset'] > 0:
+                results.append(result)
+            if result['offset'] < count:
+                break
+
+        return results
+
+
+    def merge(self):
+        if self.merged:
+            return
+        self.merged = True
+
+        engine = self.engine
+        results = self.results()
+        prefix = [self.prefix] if self.prefix is not None else []
+        engine.restore(combine_results(prefix + results, len(engine.files)))
+
+        # Stage times of the workers add up although they ran in parallel
+        for result in results:
+            engine.timers.merge(result['timers'])
+
+        engine.reached_end = engine.analysis_start_sector + engine.offset >= engine.max_sectors
+
+
+    def checkpoint(self):
+        # State of the prefix and the contiguous range of shards done so far
+        results = self.results(wait=False)
+        prefix = [self.prefix] if self.prefix is not None else []
+        return combine_results(prefix + results, len(self.engine.files))
@@ -0,0 +1,169 @@
+import numpy as np
+
+
+# Partition, filesystem and RAID metadata markers, each as (name, [(offset, bytes), ...]).
+# The offsets are relative to the start of a 512 byte unit: sectors larger than
+# 512 bytes are scanned unit by unit, as e.g. the ext superblock starts 1024 bytes
+# into a 4096 byte sector. All checks of a signature must match.
+SIGNATURES = [
+    ("MBR", [(510, b"\x55\xAA")]),                                  # Partition table, see _valid_mbr()
+    ("GPT", [(0, b"EFI PART")]),                                    # GPT header
+    ("NTFS", [(3, b"NTFS    "), (510, b"\x55\xAA")]),               # NTFS boot sector
+    ("FAT12/16", [(54, b"FAT1"), (510, b"\x55\xAA")]),              # FAT12/FAT16 boot sector
+    ("FAT32", [(82, b"FAT32   "), (510, b"\x55\xAA")]),             # FAT32 boot sector
+    ("exFAT", [(3, b"EXFAT   "), (510, b"\x55\xAA")]),              # exFAT boot sector
+    ("ext", [(56, b"\x53\xEF"), (25, b"\0\0\0"), (77, b"\0\0\0")]), # ext2/3/4 superblock: magic, block size and revision < 256
+    ("XFS", [(0, b"XFSB")]),                                        # XFS superblock
+    ("Btrfs", [(64, b"_BHRfS_M")]),                                 # Btrfs superblock
+    ("md", [(0, b"\xFC\x4E\x2B\xA9")]),                             # Linux md superblock (0.90 and 1.x)
+    ("LVM", [(0, b"LABELONE"), (24, b"LVM2 001")]),                 # LVM2 physical volume label
+    ("DDF", [(0, b"\xDE\x11\xDE\x11")]),                            # SNIA DDF RAID header
+]
+
+SIGNATURE_NAMES = [name for name, checks in SIGNATURES]
+SIGNATURE_UNIT = 512
+
+# Boot sectors of filesystems end with 0x55AA as well but are no partition table
+BOOT_SECTOR_NAMES = ["NTFS", "FAT12/16", "FAT32", "exFAT"]
+
+# Compact record of one hit: the sector and the position of the signature in SIGNATURES
+HIT_DTYPE = np.dtype([
+    ('sector', '<u8'),
+    ('signature', '<u1'),
+])
+
+
+def _unit_view(sectors):
+    # (units, 512) view of a (sectors, bs) uint8 array and the number of units per sector
+    n, bs = sectors.shape
+    if bs % SIGNATURE_UNIT == 0:
+        per_sector = bs // SIGNATURE_UNIT
+        return sectors.reshape(n * per_sector, SIGNATURE_UNIT), per_sector
+    return sectors, 1
+
+
+def _matching(units, checks, candidates):
+    # Candidate units (indexes) matching all checks
+    for offset, magic in checks:
+        if len(candidates) == 0:
+            break
+        expected = np.frombuffer(magic, dtype=np.uint8)
+        candidates = candidates[(units[candidates, offset:offset + len(magic)] == expected).all(axis=1)]
+    return candidates
+
+
+def _valid_mbr(units, candidates):
+    # Partition entries have a status byte of 0x00 or 0x80 and the sector is no boot sector
+    status = units[candidates][:, [446, 462, 478, 494]]
+    valid = ((status & 0x7F) == 0).all(axis=1)
+    for name, checks in SIGNATURES:
+        if name in BOOT_SECTOR_NAMES:
+            valid &= ~np.isin(candidates, _matching(units, checks, candidates))
+    return candidates[valid]
+
+
+def scan_signatures(sectors, names=SIGNATURE_NAMES):
+    # All hits of the named signatures in a (sectors, bs) uint8 array as a sorted
+    # HIT_DTYPE array with sector numbers relative to the array start. The first
+    # byte of every signature is compared over the whole buffer, the few candidate
+    # units are then checked completely.
+    units, per_sector = _unit_view(sectors)
+    hits = []
+    if units.shape[1] >= SIGNATURE_UNIT:
+        for signature, (name, checks) in enumerate(SIGNATURES):
+            if name not in names:
+                continue
+
+            offset, magic = checks[0]
+            candidates = _matching(units, checks, np.flatnonzero(units[:, offset] == magic[0]))
+            if name == "MBR" and len(candidates):
+                candidates = _valid_mbr(units, candidates)
+            if len(candidates):
+                found = np.zeros(len(candidates), dtype=HIT_DTYPE)
+                found['sector'] = candidates // per_sector
+                found['signature'] = signature
+                hits.append(found)
+
+    if not hits:
+        return np.zeros(0, dtype=HIT_DTYPE)
+
+    # Several units of one sector can hold the same signature, it counts once.
+    # Structured arrays sort by their first field, the sector.
+    return np.unique(np.concatenate(hits))
+
+
+class SignatureHits:
+    # Every signature hit of each image as a compact HIT_DTYPE array, 9 bytes per hit
+    def __init__(self, files, names=SIGNATURE_NAMES):
+        self.files = files
+        self.names = list(names)
+        self.chunks = [[] for x in range(files)]
+
+
+    def add(self, i, hits, base=0):
+        # Add hits of image i with sector numbers relative to base
+        if len(hits) == 0:
+            return
+        hits = hits.copy()
+        hits['sector'] += np.uint64(base)
+        self.chunks[i].append(hits)
+
+
+    def hits(self, i):
+        # Hits of image i sorted by sector
+        if not self.chunks[i]:
+            return np.zeros(0, dtype=HIT_DTYPE)
+        if len(self.chunks[i]) > 1:
+            hits = np.concatenate(self.chunks[i])
+            self.chunks[i] = [hits[np.argsort(hits['sector'], kind='stable')]]
+        return self.chunks[i][0]
+
+
+    def arrays(self):
+        return [self.hits(i) for i in range(self.files)]
+
+
+    def counts(self):
+        # Hits per signature (rows, in SIGNATURES order) and image (columns)
+        counts = np.zeros((len(SIGNATURES), self.files), dtype=np.int64)
+        for i in range(self.files):
+            counts[:, i] = np.bincount(self.hits(i)['signature'], minlength=len(SIGNATURES))
+        return counts
+
+
+    def first_hits(self):
+        # {name: (sector, image)} of the first hit of each signature found
+        first = {}
+        for i in range(self.files):
+            hits = self.hits(i)
+            for signature in np.unique(hits['signature']):
+                name = SIGNATURES[signature][0]
+                sector = int(hits['sector'][np.argmax(hits['signature'] == signature)])
+                if name not in first or sector < first[name][0]:
+                    first[name] = (sector, i)
+        return first
+
+
+    def format(self, filenames):
+        # Per disk hit distribution of the recorded signatures
+        counts = self.counts()
+        text = f"{'SIGNATURE':<10}" + "".join(f"  {name[:12]:>12}" for name in filenames) + "\n"
+        for signature, (name, checks) in enumerate(SIGNATURES):
+            if name in self.names:
+                text += f"{name:<10}" + "".join(f"  {count:>12}" for count in counts[signature]) + "\n"
+
+        first = self.first_hits()
+        if first:
+            text += "\nFirst hits (sectors relative to the start sector):\n"
+            for name in SIGNATURE_NAMES:
+                if name in first:
+                    sector, i = first[name]
+                    text += f"{name:<10}  {filenames[i]} at sector {sector}\n"
+        return text
+
+
+    def to_dict(self, filenames):
+        return {
+            filenames[i]: [[int(hit['sector']), SIGNATURES[hit['signature']][0]] for hit in self.hits(i)]
+            for i in range(self.files)
+        }
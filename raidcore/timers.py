@@ -0,0 +1,151 @@
+import csv
+import json
+import time
+import cProfile
+import threading
+
+from contextlib import contextmanager
+
+
+# Stages in pipeline order, others are listed after them
+STAGE_ORDER = ["read", "zero_runs", "signatures", "classify", "mirrors", "parity", "parity_log", "shards", "snapshot", "ui_render"]
+
+
+class StageTimers:
+    # Counters and timers of the analysis stages: calls, wall and CPU time (of the
+    # calling thread), sectors and bytes per stage, plus gauges like the depth of
+    # the snapshot queue. A trace row with the totals so far is added on every
+    # progress event. Safe to update from the worker and the UI thread.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_time = time.perf_counter()
+        self.stages = {}
+        self.gauges = {}
+        self.trace = []
+
+
+    def add(self, name, wall, cpu=0.0, sectors=0, nbytes=0, calls=1):
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {"calls": 0, "wall": 0.0, "cpu": 0.0, "sectors": 0, "bytes": 0}
+            stage["calls"] += calls
+            stage["wall"] += wall
+            stage["cpu"] += cpu
+            stage["sectors"] += sectors
+            stage["bytes"] += nbytes
+
+
+    @contextmanager
+    def stage(self, name, sectors=0, nbytes=0):
+        # Time the body as stage name. The times are exclusive: a stage timed within
+        # another one is not counted for the outer stage as well. The yielded dict
+        # can be updated with the sectors and bytes known only after the body ran.
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        counts = {"sectors": sectors, "bytes": nbytes}
+        inner = [0.0, 0.0]
+        stack.append(inner)
+
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield counts
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            stack.pop()
+            if stack:
+                stack[-1][0] += wall
+                stack[-1][1] += cpu
+            self.add(name, wall - inner[0], cpu - inner[1], counts["sectors"], counts["bytes"])
+
+
+    def gauge(self, name, value):
+        # Current and maximum value of a gauge
+        with self.lock:
+            current = self.gauges.setdefault(name, {"value": 0, "max": 0})
+            current["value"] = value
+            current["max"] = max(current["max"], value)
+
+
+    def merge(self, other):
+        # Add the totals of another StageTimers.to_dict(), e.g. of a shard worker
+        for name, stage in other["stages"].items():
+            self.add(name, stage["wall"], stage["cpu"], stage["sectors"], stage["bytes"], stage["calls"])
+        for name, gauge in other["gauges"].items():
+            self.gauge(name, gauge["value"])
+
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+
+    def record(self, sectors):
+        # Add a trace row with the totals so far
+        with self.lock:
+            row = {"time": self.elapsed(), "sectors": sectors}
+            for name, stage in self.stages.items():
+                row[f"{name}_wall"] = stage["wall"]
+                row[f"{name}_cpu"] = stage["cpu"]
+                row[f"{name}_bytes"] = stage["bytes"]
+            for name, gauge in self.gauges.items():
+                row[name] = gauge["value"]
+            self.trace.append(row)
+
+
+    def ordered(self):
+        with self.lock:
+            names = [name for name in STAGE_ORDER if name in self.stages]
+            names += sorted(name for name in self.stages if name not in STAGE_ORDER)
+            return [(name, dict(self.stages[name])) for name in names]
+
+
+    def to_dict(self):
+        stages = dict(self.ordered())
+        with self.lock:
+            return {"elapsed": self.elapsed(), "stages": stages, "gauges": {k: dict(v) for k, v in self.gauges.items()}}
+
+
+    def format(self):
+        elapsed = max(self.elapsed(), 1e-9)
+        text = "STAGE          CALLS    WALL S   CPU S  WALL %      MIB/S  SECTORS/S\n"
+        for name, stage in self.ordered():
+            wall = stage["wall"]
+            rate = stage["bytes"] / wall / (1 << 20) if wall > 0 and stage["bytes"] else 0.0
+            sectors = stage["sectors"] / wall if wall > 0 and stage["sectors"] else 0.0
+            text += f"{name:<12}  {stage['calls']:>7}  {wall:>8.2f}  {stage['cpu']:>6.2f}  {wall * 100 / elapsed:>5.1f}%  {rate:>9.1f}  {sectors:>9.0f}\n"
+
+        with self.lock:
+            if "shards" in self.stages:
+                text += "\nThe stages of the worker processes are summed up, they ran in parallel.\n"
+            for name, gauge in self.gauges.items():
+                text += f"\n{name}: {gauge['value']} (max. {gauge['max']})"
+        return text + f"\nElapsed: {elapsed:.2f} s\n"
+
+
+    def write_trace(self, path):
+        # Trace as CSV (by the file extension) or JSON with the totals
+        with self.lock:
+            trace = list(self.trace)
+
+        if path.lower().endswith(".csv"):
+            columns = []
+            for row in trace:
+                columns += [key for key in row if key not in columns]
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=columns, restval=0)
+                writer.writeheader()
+                writer.writerows(trace)
+        else:
+            with open(path, "w") as f:
+                json.dump({"totals": self.to_dict(), "trace": trace}, f, indent=2)
+
+
+def run_profiled(function, path):
+    # Run function under cProfile and write the statistics to path (see pstats)
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function)
+    finally:
+        profile.dump_stats(path)
@@ -0,0 +1,62 @@
+import queue
+import threading
+
+
+class AnalysisWorker:
+    # Runs an engine in a background thread and posts rendered snapshots of its
+    # progress to a queue, so a UI can poll at its own pace and never blocks on
+    # the analysis.
+    def __init__(self, engine):
+        self.engine = engine
+        self.queue = queue.Queue()
+        self.thread = None
+        self.error = None
+
+
+    def start(self, offset=0, run_only_one_block=False):
+        # Open in the calling thread so errors opening the images surface right away
+        self.engine.subscribe(self.on_engine_event)
+        self.engine.open(offset=offset, run_only_one_block=run_only_one_block)
+
+        self.thread = threading.Thread(target=self.run, name="raidalyzer-analysis", daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        try:
+            self.engine.run_steps()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.engine.stop()
+
+
+    def on_engine_event(self, event, engine):
+        with engine.timers.stage("snapshot"):
+            snapshot = engine.snapshot()
+        self.queue.put((event, snapshot))
+        engine.timers.gauge("queue_depth", self.queue.qsize())
+
+
+    def cancel(self):
+        self.engine.request_stop()
+
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+
+    def events(self):
+        # Drain all queued (event, snapshot) pairs
+        events = []
+        try:
+            while True:
+                events.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return events
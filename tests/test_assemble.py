@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+from raidcore.assemble import ArrayAssembler, open_volume, write_volume
+from raidcore.layout import RAID5_LAYOUTS
+from raidcore.raid6 import q_syndrome
+
+
+BS = 512
+CHUNK = 4               # Sectors per chunk
+ROWS = 13
+
+
+def md_row(level, layout, disks, row):
+    # (P position, Q position or None, data positions in logical order) of a row
+    # as Linux md lays it out
+    parity = disks - 1 - row % disks if layout.startswith("left") else row % disks
+    q = (parity + 1) % disks if level == "RAID6" else None
+    skip = [parity] if q is None else [parity, q]
+    if layout.endswith("asymmetric"):
+        data = [k for k in range(disks) if k not in skip]
+    else:
+        data = [(skip[-1] + 1 + k) % disks for k in range(disks - len(skip))]
+    return parity, q, data
+
+
+def write_members(directory, level, layout, disks, seed):
+    # Member images of a random volume, returns (paths, volume bytes)
+    rng = np.random.default_rng(seed)
+    data_disks = disks - (2 if level == "RAID6" else 1)
+    volume = rng.integers(0, 256, (ROWS, data_disks, CHUNK * BS), dtype=np.uint8)
+    volume[2] = 0                                   # A zero row
+    members = np.zeros((disks, ROWS, CHUNK * BS), dtype=np.uint8)
+    for row in range(ROWS):
+        parity, q, data = md_row(level, layout, disks, row)
+        members[data, row] = volume[row]
+        members[parity, row] = np.bitwise_xor.reduce(volume[row], axis=0)
+        if q is not None:
+            members[q, row] = q_syndrome([chunk.view(np.uint64) for chunk in volume[row]]).view(np.uint8)
+
+    paths = []
+    for i in range(disks):
+        path = directory / f"disk{i}.img"
+        members[i].tofile(path)
+        paths.append(str(path))
+    return paths, volume.tobytes()
+
+
+def read_all(assembler):
+    return b"".join(assembler.read_batch(batch).tobytes() for batch in range(assembler.batches))
+
+
+@pytest.mark.parametrize("level,disks", [("RAID5", 4), ("RAID6", 5)])
+@pytest.mark.parametrize("layout", RAID5_LAYOUTS)
+def test_missing_member_is_rebuilt(tmp_path, level, disks, layout):
+    paths, volume = write_members(tmp_path, level, layout, disks, seed=disks)
+    for missing in [None] + list(range(disks)):
+        files = [None if i == missing else path for i, path in enumerate(paths)]
+        # Batches of 3 rows, the last one shorter
+        assembler = ArrayAssembler(files, level=level, stripe_size=CHUNK * BS, layout=layout,
+                                   batch_size=3 * (disks - (2 if level == "RAID6" else 1)) * CHUNK * BS)
+        try:
+            assert assembler.size == len(volume)
+            assert assembler.batches == 5
+            assert read_all(assembler) == volume, f"member {missing} missing"
+        finally:
+            assembler.close()
+
+
+def test_locate_follows_the_layout(tmp_path):
+    paths, volume = write_members(tmp_path, "RAID6", "left-symmetric", 5, seed=1)
+    assembler = ArrayAssembler(paths, level="RAID6", stripe_size=CHUNK * BS, layout="left-symmetric")
+    try:
+        for sector in (0, CHUNK - 1, CHUNK, 3 * CHUNK + 1, assembler.sectors - 1):
+            position, member_sector = assembler.locate(sector)
+            with open(paths[position], "rb") as f:
+                f.seek(member_sector * BS)
+                assert f.read(BS) == volume[sector * BS:(sector + 1) * BS]
+    finally:
+        assembler.close()
+
+
+def test_volume_file_reads_and_seeks(tmp_path):
+    paths, volume = write_members(tmp_path, "RAID5", "right-symmetric", 4, seed=2)
+    paths[1] = None
+    with open_volume(paths, level="RAID5", stripe_size=CHUNK * BS, layout="right-symmetric", batch_size=CHUNK * BS) as f:
+        rng = np.random.default_rng(3)
+        for position, length in rng.integers(0, len(volume), (20, 2)).tolist():
+            f.seek(position)
+            assert f.read(length) == volume[position:position + length]
+        f.seek(-100, 2)
+        assert f.read() == volume[-100:]
+
+
+def test_write_volume(tmp_path):
+    paths, volume = write_members(tmp_path, "RAID6", "right-asymmetric", 5, seed=4)
+    paths[3] = None
+    assembler = ArrayAssembler(paths, level="RAID6", stripe_size=CHUNK * BS, layout="right-asymmetric")
+    try:
+        output = tmp_path / "volume.img"
+        assert write_volume(assembler, str(output)) == len(volume) // BS
+        assert output.read_bytes() == volume
+    finally:
+        assembler.close()
+
+
+def test_two_missing_members_are_rejected(tmp_path):
+    paths, volume = write_members(tmp_path, "RAID6", "left-symmetric", 5, seed=5)
+    with pytest.raises(ValueError):
+        ArrayAssembler([None, None] + paths[2:], level="RAID6", stripe_size=CHUNK * BS)
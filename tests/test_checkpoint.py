@@ -0,0 +1,103 @@
+import pytest
+
+from raidcore.bench.synthetic import generate_raid
+from raidcore.checkpoint import check_checkpoint, load_checkpoint
+from raidcore.engine import RaidAnalysisEngine
+
+
+@pytest.fixture(scope="module")
+def raid6(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("raid6")
+    return generate_raid(str(directory), level="RAID6", disks=5, sectors=1 << 14, stripe_size=8192,
+                         zero_regions=[(3000, 1500)], seed=3)["files"]
+
+
+def new_engine(files, checkpoint=None, processes=1):
+    engine = RaidAnalysisEngine(files, analysis_block_size=2000, parity_log_path=None, processes=processes)
+    engine.checkpoint_path = checkpoint
+    return engine
+
+
+def results(engine):
+    result = engine.to_dict()
+    del result["timers"]
+    result["pyramid"] = engine.pyramid.to_state()
+    result["heatmap"] = engine.heatmap.to_state()
+    return result
+
+
+def interrupted_run(files, checkpoint, blocks):
+    # Analyze the first blocks and stop as the GUI and the CLI do, with a checkpoint
+    engine = new_engine(files, checkpoint)
+    engine.open()
+    for _ in range(blocks):
+        engine.step()
+    engine.stop(save_checkpoint=True)
+    return engine
+
+
+def test_resume_gives_uninterrupted_results(raid6, tmp_path):
+    full = new_engine(raid6)
+    full.run()
+
+    checkpoint = str(tmp_path / "run.ckpt")
+    first = interrupted_run(raid6, checkpoint, 3)
+    assert first.offset == 6000 and not first.reached_end
+
+    resumed = new_engine(raid6, checkpoint)
+    resumed.resume_from(checkpoint)
+    resumed.run()
+    assert resumed.reached_end
+    assert results(resumed) == results(full)
+
+
+def test_resume_twice(raid6, tmp_path):
+    full = new_engine(raid6)
+    full.run()
+
+    checkpoint = str(tmp_path / "run.ckpt")
+    interrupted_run(raid6, checkpoint, 2)
+    second = new_engine(raid6, checkpoint)
+    second.resume_from(checkpoint)
+    second.open()
+    for _ in range(3):
+        second.step()
+    second.stop(save_checkpoint=True)
+    assert load_checkpoint(checkpoint)["state"]["offset"] == 10000
+
+    resumed = new_engine(raid6, checkpoint)
+    resumed.resume_from(checkpoint)
+    resumed.run()
+    assert results(resumed) == results(full)
+
+
+def test_resume_with_several_processes(raid6, tmp_path):
+    full = new_engine(raid6)
+    full.run()
+
+    checkpoint = str(tmp_path / "run.ckpt")
+    interrupted_run(raid6, checkpoint, 3)
+    resumed = new_engine(raid6, checkpoint, processes=2)
+    resumed.resume_from(checkpoint)
+    resumed.run()
+
+    # Several processes merge exact entropy sums, one process adds them up in order
+    expected, actual = results(full), results(resumed)
+    for s in expected["stats"]:
+        s["entropy_sum"] = pytest.approx(s["entropy_sum"], rel=1e-12)
+        s["entropy"] = pytest.approx(s["entropy"], rel=1e-12)
+    assert actual == expected
+
+
+def test_checkpoint_of_other_settings_is_rejected(raid6, tmp_path):
+    checkpoint = str(tmp_path / "run.ckpt")
+    interrupted_run(raid6, checkpoint, 1)
+
+    engine = new_engine(raid6)
+    engine.analysis_block_size = 4000
+    with pytest.raises(ValueError, match="analysis_block_size"):
+        check_checkpoint(load_checkpoint(checkpoint), engine)
+
+    engine = new_engine(raid6[:4])
+    with pytest.raises(ValueError):
+        check_checkpoint(load_checkpoint(checkpoint), engine)
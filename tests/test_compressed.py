@@ -0,0 +1,156 @@
+import os
+import bz2
+import gzip
+import lzma
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from raidcore import compressed
+from raidcore.compressed import CompressedImage, chunk_index, load_chunk_index
+from raidcore.reader import ImageReader
+
+
+SIZE = (3 << 20) + 1234          # Not a multiple of the sector size
+
+
+@pytest.fixture(autouse=True)
+def small_spans(monkeypatch):
+    # Many spans and pieces in a few MB of data, bzip2 magic numbers across scans
+    monkeypatch.setattr(compressed, "SPAN_SIZE", 256 << 10)
+    monkeypatch.setattr(compressed, "PIECE_SIZE", 96 << 10)
+    monkeypatch.setattr(compressed, "INPUT_SIZE", 64 << 10)
+    monkeypatch.setattr(compressed, "SCAN_SIZE", 100003)
+
+
+@pytest.fixture(scope="module")
+def data():
+    # Random, text-like and zero stretches, so every format has work to do
+    rng = np.random.default_rng(11)
+    parts = []
+    size = 0
+    while size < SIZE:
+        kind = rng.integers(0, 3)
+        length = int(rng.integers(1, 200)) << 10
+        if kind == 0:
+            part = rng.integers(0, 256, length, dtype=np.uint8)
+        elif kind == 1:
+            part = rng.choice(np.frombuffer(b"abcdefghij klmnop\n", dtype=np.uint8), length)
+        else:
+            part = np.zeros(length, dtype=np.uint8)
+        parts.append(part)
+        size += length
+    return np.concatenate(parts)[:SIZE].tobytes()
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def check_random_reads(path, data, points=None):
+    index = chunk_index(str(path))
+    assert index.size == len(data)
+    if points is not None:
+        assert len(index) >= points
+
+    image = CompressedImage(str(path), threads=2)
+    try:
+        rng = np.random.default_rng(len(data))
+        reads = [(int(p), int(n)) for p, n in zip(rng.integers(0, len(data), 40), rng.integers(1, 600 << 10, 40))]
+        reads += [(0, 4096), (len(data) - 100, 4096), (len(data), 10), (len(data) // 2, 10)]
+        for position, length in reads:
+            out = np.zeros(length, dtype=np.uint8)
+            done = image.read_at(position, out)
+            expected = data[position:position + length]
+            assert done == len(expected)
+            assert out[:done].tobytes() == expected, f"read of {length} bytes at {position}"
+
+        # Sequentially from the start, with read ahead, and backwards
+        out = np.zeros(len(data), dtype=np.uint8)
+        assert image.read_at(0, out) == len(data) and out.tobytes() == data
+        for position in range(len(data) - 70000, 0, -700000):
+            out = np.zeros(70000, dtype=np.uint8)
+            image.read_at(position, out)
+            assert out.tobytes() == data[position:position + 70000]
+    finally:
+        image.close()
+
+
+def test_gzip_members(tmp_path, data):
+    path = tmp_path / "disk.img.gz"
+    path.write_bytes(b"".join(gzip.compress(part, compresslevel=1) for part in split(data, 100 << 10)))
+    check_random_reads(path, data, points=10)
+    assert load_chunk_index(str(path)) is not None
+
+
+def test_gzip_single_member(tmp_path, data):
+    # One span, decoded in pieces in order and started over to go back
+    path = tmp_path / "disk.img.gz"
+    path.write_bytes(gzip.compress(data, compresslevel=1))
+    assert len(chunk_index(str(path))) == 1
+    check_random_reads(path, data)
+
+
+@pytest.mark.skipif(shutil.which("xz") is None, reason="needs the xz tool")
+def test_xz_threaded_blocks(tmp_path, data):
+    # xz -T writes independent blocks, found in the index at the end of the stream
+    path = tmp_path / "disk.img"
+    path.write_bytes(data)
+    subprocess.run(["xz", "-T2", "-1", "--block-size=200KiB", "-k", str(path)], check=True)
+    check_random_reads(tmp_path / "disk.img.xz", data, points=8)
+
+
+def test_xz_concatenated_streams(tmp_path, data):
+    path = tmp_path / "disk.img.xz"
+    path.write_bytes(b"".join(lzma.compress(part, preset=1) for part in split(data, 300 << 10)))
+    check_random_reads(path, data, points=8)
+
+
+def test_bzip2_blocks(tmp_path, data):
+    # 100k blocks, which start at any bit of the stream
+    path = tmp_path / "disk.img.bz2"
+    path.write_bytes(bz2.compress(data, compresslevel=1))
+    check_random_reads(path, data, points=8)
+
+
+def test_bzip2_concatenated_streams(tmp_path, data):
+    path = tmp_path / "disk.img.bz2"
+    path.write_bytes(b"".join(bz2.compress(part, compresslevel=1) for part in split(data, 250 << 10)))
+    check_random_reads(path, data, points=8)
+
+
+def test_image_reader_reads_sectors(tmp_path, data):
+    path = tmp_path / "disk.img.gz"
+    path.write_bytes(b"".join(gzip.compress(part, compresslevel=1) for part in split(data, 300 << 10)))
+    reader = ImageReader(str(path), bs=512)
+    try:
+        assert reader.sectors == len(data) // 512
+        out = np.zeros((100, 512), dtype=np.uint8)
+        assert reader.readinto(1000, out) == 100
+        assert out.tobytes() == data[1000 * 512:1100 * 512]
+    finally:
+        reader.close()
+
+
+def test_damaged_data_raises_oserror(tmp_path, data):
+    compressed_data = bytearray(b"".join(gzip.compress(part, compresslevel=1) for part in split(data, 300 << 10)))
+    path = tmp_path / "disk.img.gz"
+    path.write_bytes(compressed_data)
+    chunk_index(str(path))
+
+    # Damage the last member after indexing, keeping size and mtime
+    stat = path.stat()
+    compressed_data[-2000:-1000] = bytes(1000)
+    path.write_bytes(compressed_data)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    image = CompressedImage(str(path), threads=2)
+    try:
+        out = np.zeros(4096, dtype=np.uint8)
+        with pytest.raises(OSError):
+            image.read_at(len(data) - 4096, out)
+        assert image.read_at(0, out) == 4096 and out.tobytes() == data[:4096]
+    finally:
+        image.close()
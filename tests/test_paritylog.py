@@ -0,0 +1,111 @@
+import numpy as np
+
+from raidcore.paritylog import ZERO_PATTERN, ParityRunLog, load_parity_runs, parity_runs_from_dict, read_parity_log
+
+
+def sample_log():
+    # Sectors 0 - 99 A, 100 - 102 B (noise), 103 - 299 A, 300 - 499 C
+    log = ParityRunLog()
+    a, b, c = log.intern("A"), log.intern("B"), log.intern("C")
+    log.append([0, 50], [a, a], 100)
+    log.append([100, 103], [b, a], 300)
+    log.append([300], [c], 500)
+    return log
+
+
+def test_append_drops_repeated_patterns():
+    log = sample_log()
+    assert len(log) == 4
+    assert log.starts().tolist() == [0, 100, 103, 300]
+    assert log.ends().tolist() == [100, 103, 300, 500]
+    assert log.end == 500
+
+    # A batch continuing the last pattern adds no run, only extends the end
+    log.append([500, 510], [log.intern("C"), log.intern("C")], 600)
+    assert len(log) == 4 and log.end == 600
+
+
+def test_intern_keeps_ids():
+    log = ParityRunLog()
+    assert log.intern("A") == 0
+    assert log.intern("B") == 1
+    assert log.intern("A") == 0
+    assert log.names == ["A", "B"]
+
+
+def test_ranges_are_numbered_from_one():
+    log = sample_log()
+    assert log.ranges() == [(1, 100, "A"), (101, 103, "B"), (104, 300, "A"), (301, 500, "C")]
+    assert log.ranges(1, 2) == [(101, 103, "B"), (104, 300, "A")]
+    assert log.format(3) == "301 - 500 : C\n"
+
+
+def test_query_clips_to_range():
+    log = sample_log()
+    assert log.query(1, 1) == [(1, 1, "A")]
+    assert log.query(50, 150) == [(50, 100, "A"), (101, 103, "B"), (104, 150, "A")]
+    assert log.query(400, 1000) == [(400, 500, "C")]
+    assert log.query(102, 102) == [(102, 102, "B")]
+
+
+def test_pattern_sectors():
+    assert sample_log().pattern_sectors() == {"A": 297, "B": 3, "C": 200}
+
+
+def test_merged_removes_noise():
+    log = sample_log()
+    merged = log.merged(10)
+    assert merged.ranges() == [(1, 300, "A"), (301, 500, "C")]
+
+    # Leading short runs go to the first longer one
+    log = ParityRunLog()
+    log.append([0, 2, 4], [log.intern("X"), log.intern("Y"), log.intern("Z")], 100)
+    assert log.merged(10).ranges() == [(1, 100, "Z")]
+
+    # The log itself is left alone
+    assert len(log) == 3
+
+
+def test_extend_remaps_patterns():
+    first = sample_log()
+    second = ParityRunLog()
+    second.append([500, 700], [second.intern("C"), second.intern(ZERO_PATTERN)], 800)
+    first.extend(second)
+    assert first.ranges()[-2:] == [(301, 700, "C"), (701, 800, ZERO_PATTERN)]
+
+
+def test_write_read_round_trip(tmp_path):
+    log = sample_log()
+    log.append([500], [log.intern("D / E | Q: 01.img + 02.img")], 501)
+    path = tmp_path / "parity_check.log"
+    log.write(path, page=2)
+
+    text = path.read_text()
+    assert text.startswith("1 - 100 : A\n101 - 103 : B\n")
+    assert text.endswith("501 - 501 : D / E | Q: 01.img + 02.img\n")
+
+    read = read_parity_log(path)
+    assert read.ranges() == log.ranges()
+    assert read.starts().tolist() == log.starts().tolist()
+    assert read.end == log.end
+
+
+def test_state_and_dict_round_trip():
+    log = sample_log()
+    assert load_parity_runs(log.to_state()).ranges() == log.ranges()
+
+    # As in RaidAnalysisEngine.to_dict()
+    data = {
+        "patterns": log.names,
+        "runs": [[int(s) + 1, int(e), int(p)] for s, e, p in zip(log.starts(), log.ends(), log.patterns())],
+    }
+    assert parity_runs_from_dict(data).ranges() == log.ranges()
+
+
+def test_grows_past_initial_capacity():
+    log = ParityRunLog()
+    a, b = log.intern("A"), log.intern("B")
+    starts = np.arange(5000, dtype=np.uint64)
+    log.append(starts, np.where(starts % 2 == 0, a, b), 5000)
+    assert len(log) == 5000
+    assert log.query(4000, 4001) == [(4000, 4000, "B"), (4001, 4001, "A")]
@@ -0,0 +1,146 @@
+import numpy as np
+
+from raidcore.index import linear_fingerprints
+from raidcore.layout import RAID5_LAYOUTS, raid6_rows
+from raidcore.raid6 import gf_mul2, gf_mul_table, q_matches, q_subsets, q_syndrome
+
+
+# Scalar GF(2^8) reference with the md polynomial 0x11d, one byte at a time
+def ref_mul2(x):
+    x <<= 1
+    return x ^ 0x11d if x & 0x100 else x
+
+
+def ref_mul(a, b):
+    product = 0
+    while b:
+        if b & 1:
+            product ^= a
+        a = ref_mul2(a)
+        b >>= 1
+    return product
+
+
+def ref_q(blocks):
+    # Q = sum of g**k * D_k, the data blocks as lists of ints in data order
+    q = [0] * len(blocks[0])
+    power = 1
+    for block in blocks:
+        q = [qb ^ ref_mul(power, db) for qb, db in zip(q, block)]
+        power = ref_mul2(power)
+    return q
+
+
+def ref_q_matches(stripes, subsets):
+    # q_matches() of a (files, stripes, bs) array, stripe by stripe
+    files, count = stripes.shape[:2]
+    result = np.zeros((len(subsets), count), dtype=bool)
+    for k, excluded in enumerate(subsets):
+        members = [i for i in range(files) if i not in excluded]
+        for s in range(count):
+            blocks = {i: stripes[i, s].tolist() for i in members}
+            if not any(any(block) for block in blocks.values()):
+                result[k, s] = True
+                continue
+            for j, q in enumerate(members):
+                p = members[j - 1]
+                xor = [0] * stripes.shape[2]
+                for i in members:
+                    if i != q:
+                        xor = [a ^ b for a, b in zip(xor, blocks[i])]
+                if any(xor):
+                    continue
+                ascending = [i for i in members if i != p and i != q]
+                after_q = [members[(j + 1 + x) % len(members)] for x in range(len(members) - 2)]
+                if any(ref_q([blocks[i] for i in order]) == blocks[q] for order in (ascending, after_q)):
+                    result[k, s] = True
+                    break
+    return result
+
+
+def raid6_stripes(rng, disks, layout, count, bs=16):
+    # count stripes of a RAID6 in the md layout, the rows rotating as on disk
+    stripes = np.zeros((disks, count, bs), dtype=np.uint8)
+    rows = raid6_rows(layout, disks)
+    for s in range(count):
+        p, q, data = rows[s % len(rows)]
+        blocks = [rng.integers(0, 256, bs, dtype=np.uint8) for x in data]
+        for i, block in zip(data, blocks):
+            stripes[i, s] = block
+        stripes[p, s] = np.bitwise_xor.reduce(blocks, axis=0)
+        stripes[q, s] = ref_q([block.tolist() for block in blocks])
+    return stripes
+
+
+def test_gf_mul2_matches_scalar_reference():
+    values = np.arange(256, dtype=np.uint8)
+    expected = [ref_mul2(x) for x in range(256)]
+    assert gf_mul2(values).tolist() == expected
+
+    words = np.frombuffer(np.random.default_rng(1).integers(0, 256, 64, dtype=np.uint8).tobytes(), dtype=np.uint64)
+    assert gf_mul2(words).view(np.uint8).tolist() == [ref_mul2(x) for x in words.view(np.uint8).tolist()]
+
+
+def test_gf_mul_table_matches_scalar_reference():
+    table = gf_mul_table()
+    rng = np.random.default_rng(2)
+    for a, b in rng.integers(0, 256, (500, 2)).tolist():
+        assert table[a, b] == ref_mul(a, b)
+    assert (table[1] == np.arange(256)).all()
+    assert not table[0].any()
+
+
+def test_q_syndrome_matches_scalar_reference():
+    rng = np.random.default_rng(3)
+    blocks = [rng.integers(0, 256, (4, 32), dtype=np.uint8) for x in range(5)]
+    expected = [ref_q([block[s].tolist() for block in blocks]) for s in range(4)]
+    assert q_syndrome([block.view(np.uint64) for block in blocks]).view(np.uint8).tolist() == expected
+    assert q_syndrome(blocks).tolist() == expected
+
+
+def test_q_matches_complete_raid6():
+    rng = np.random.default_rng(4)
+    for layout in RAID5_LAYOUTS:
+        stripes = raid6_stripes(rng, 6, layout, 12)
+        subsets = q_subsets(6)
+        result = q_matches(stripes, subsets)
+        assert result[0].all()
+        assert (result == ref_q_matches(stripes, subsets)).all()
+
+
+def test_q_matches_member_left_out():
+    # A RAID6 of 5 disks with a sixth unrelated image: only the subset leaving
+    # just that image out matches
+    rng = np.random.default_rng(5)
+    stripes = raid6_stripes(rng, 5, "left-symmetric", 10)
+    stripes = np.insert(stripes, 2, rng.integers(0, 256, (10, 16), dtype=np.uint8), axis=0)
+    subsets = q_subsets(6)
+    result = q_matches(stripes, subsets)
+    assert (result == ref_q_matches(stripes, subsets)).all()
+    for k, excluded in enumerate(subsets):
+        assert result[k].all() == (excluded == (2,))
+
+
+def test_q_matches_mixed_stripes():
+    # Zero stripes, damaged stripes, noise and a sector of zeros in a stripe
+    rng = np.random.default_rng(6)
+    stripes = raid6_stripes(rng, 5, "right-asymmetric", 40)
+    stripes[:, 0] = 0
+    stripes[1, 5, 3] ^= 0x40
+    stripes[:, 10:15] = rng.integers(0, 256, (5, 5, 16), dtype=np.uint8)
+    stripes[3, 20] = 0
+    subsets = q_subsets(5)
+    result = q_matches(stripes, subsets)
+    assert (result == ref_q_matches(stripes, subsets)).all()
+    assert result[0, 0] and not result[0, 5] and not result[0, 10:15].any()
+
+
+def test_q_matches_on_index_fingerprints():
+    # The index fingerprints are GF(2^8)-linear, so the Q check works on them
+    rng = np.random.default_rng(7)
+    stripes = raid6_stripes(rng, 6, "left-asymmetric", 12, bs=512)
+    stripes[:, 4:6] = rng.integers(0, 256, (6, 2, 512), dtype=np.uint8)
+    fingerprints = np.stack([linear_fingerprints(image) for image in stripes])
+    fingerprints = fingerprints.view(np.uint8).reshape(6, 12, 8)
+    subsets = q_subsets(6)
+    assert (q_matches(fingerprints, subsets) == q_matches(stripes, subsets)).all()